@@ -0,0 +1,116 @@
+"""
+Placement of jobs on CPUs. A CpuPlacer hands out a CPU for every job,
+preferring idle ones and NUMA nodes with the most idle CPUs, and the runner
+pins the job's process to it (see PriorityRunner's `placer`).
+
+Only supported on platforms with os.sched_setaffinity (ie. Linux).
+"""
+
+import glob
+import logging
+import os
+import re
+import threading
+
+NODE_PATH = '/sys/devices/system/node'
+
+# The CPUs of the jobs, on a thread pinned to reserved ones (see CpuPlacer)
+_reserving = threading.local()
+
+def _unpin_child():
+    """
+    Runs on the children forked by this process. A child forked from a thread
+    pinned to the reserved CPUs inherits that affinity, so it's moved to the
+    CPUs of the jobs right away, instead of competing with the scheduler until
+    the runner pins it.
+    """
+    cpus = getattr(_reserving, 'cpus', None)
+    if cpus is not None:
+        _reserving.cpus = None
+        os.sched_setaffinity(0, cpus)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_unpin_child)
+
+def parse_cpulist(text):
+    "Parses a list of CPUs in the kernel's format (eg. '0-3,8,10-11') into a set"
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def numa_nodes():
+    """
+    Returns a dictionary of NUMA node number -> set of CPUs in the node. If the
+    topology can't be read, all the CPUs are considered to be in node 0.
+    """
+    nodes = {}
+    for path in glob.glob(os.path.join(NODE_PATH, 'node*', 'cpulist')):
+        number = re.search(r'node(\d+)', path).group(1)
+        with open(path) as cpulist:
+            nodes[int(number)] = parse_cpulist(cpulist.read())
+    return nodes or {0: set(os.sched_getaffinity(0))}
+
+class CpuPlacer:
+    """
+    Keeps the count of jobs running on each CPU available to us (or on `cpus`,
+    if given), to place new ones where there's less contention: on the least
+    loaded NUMA node and, within it, on the least loaded CPU.
+
+    If `reserve` is > 0, that many CPUs are taken out of the placement and the
+    calling thread (which should be the one running the event loop) is pinned
+    to them, so that jobs don't compete with the scheduler itself. There's
+    always at least a CPU left for the jobs, though. The processes forked by
+    that thread start on the CPUs of the jobs, not on the reserved ones. Call
+    `unreserve` (on that same thread) to give them back.
+    """
+    def __init__(self, cpus=None, reserve=0):
+        available = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+        if reserve >= len(available):
+            logging.warning(f"Can't reserve {reserve} out of {len(available)} CPUs. Not reserving any")
+            reserve = 0
+        self.reserved = available[:reserve]
+        self.load = {cpu: 0 for cpu in available[reserve:]}
+        self.node_of = {cpu: node for node, node_cpus in numa_nodes().items()
+                                  for cpu in node_cpus if cpu in self.load}
+        self.nodes = {}
+        for cpu in self.load:
+            self.nodes.setdefault(self.node_of.setdefault(cpu, 0), []).append(cpu)
+        if self.reserved:
+            os.sched_setaffinity(0, self.reserved)
+            _reserving.cpus = set(self.load)
+
+    def __repr__(self):
+        return f"CpuPlacer({sorted(self.load)}, reserved={self.reserved})"
+
+    def unreserve(self):
+        "Pins the calling thread back to all the CPUs, if it was pinned to the reserved ones"
+        if self.reserved:
+            _reserving.cpus = None
+            os.sched_setaffinity(0, [*self.reserved, *self.load])
+
+    def acquire(self):
+        "Returns the set of CPUs for a new job, and accounts for it"
+        node = min(self.nodes, key=lambda n: (sum(self.load[c] for c in self.nodes[n]) / len(self.nodes[n]), n))
+        cpu = min(self.nodes[node], key=lambda c: (self.load[c], c))
+        self.load[cpu] += 1
+        return {cpu}
+
+    def release(self, cpus):
+        "Accounts for a job that is not running on `cpus` any longer"
+        for cpu in cpus:
+            self.load[cpu] -= 1
+
+    def pin(self, pid, cpus):
+        """
+        Pins process `pid` to `cpus`. Returns False if the process doesn't exist
+        (any longer).
+        """
+        try:
+            os.sched_setaffinity(pid, cpus)
+        except ProcessLookupError:
+            return False
+        return True
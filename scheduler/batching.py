@@ -0,0 +1,234 @@
+"""
+Coalescing of short tasks. Spawning and reaping a process for every task
+dominates the cost of the short ones, so a SchedulerBin can gather them into
+batches instead, that run on a single process, one task after the other.
+
+A Coalescer keeps an open Batch for every priority band. Tasks join the one
+of their band, and the batch is closed (and handed to the bin as a single
+task) once it's full, or once its first task has waited for a while: the
+BatchWindow trades throughput (larger batches) for latency.
+
+A batch holds a single slot of the runner, and it's evicted, suspended and
+timed out as a whole. The outcome of every task is reported as soon as it's
+done, though (see BatchTask), and the tasks that didn't get to start when the
+batch is cut short are queued again on their own.
+
+Tasks are only coalesced while the runner has no free slot for them: with room
+to spare, they run right away on a process each.
+"""
+
+import asyncio
+import dataclasses
+import logging
+import multiprocessing
+import signal
+
+from .pool import run_target
+from .process import ProcessTask, Result, spawning
+
+DEFAULT_BATCH_SIZE = 32
+# Seconds that a batch waits for more tasks, after the first one
+DEFAULT_BATCH_LATENCY = 0.005
+# Longest runtime hint (in seconds) of the tasks worth coalescing
+DEFAULT_MAX_RUNTIME = 0.1
+
+@dataclasses.dataclass
+class BatchWindow:
+    """
+    When to close a batch: once it has `size` tasks, or `latency` seconds after
+    its first one arrived. Tasks go to the same batch if their priorities fall
+    in the same `band` (eg. with 2, priorities 0 and 1 go together).
+
+    Only tasks with a `runtime` hint of up to `max_runtime` seconds are worth
+    coalescing. The others (and those with no hint) run on their own.
+    """
+    size: int=DEFAULT_BATCH_SIZE
+    latency: float=DEFAULT_BATCH_LATENCY
+    band: int=1
+    max_runtime: float=DEFAULT_MAX_RUNTIME
+
+class Batch:
+    """
+    Tasks coalesced to run on a single process. It's the `target` of the task
+    that stands for them in the bin.
+    """
+    def __init__(self, band):
+        self.band = band
+        self.tasks = []
+        # To close it, while it's open
+        self.deadline = None
+        # In the bin's pending queue, while it's waiting for a slot
+        self.handle = None
+        # The BatchTask running it, once started
+        self.ptask = None
+
+    def __repr__(self):
+        return f"Batch({len(self.tasks)} tasks)"
+
+    def remove(self, task):
+        "Takes the task out of the batch. Raises ValueError if it's not there"
+        for index, member in enumerate(self.tasks):
+            if member is task:
+                del self.tasks[index]
+                return
+        raise ValueError(f"{task} is not in {self}")
+
+class Coalescer:
+    """
+    Gathers tasks into batches, as specified by a BatchWindow, and calls
+    `flush(batch)` for every batch that is closed. The timers that close them
+    are set on `deadlines` (see the `deadlines` module). Full batches are
+    closed by whoever added the last task (see `add`).
+    """
+    def __init__(self, window, flush, deadlines):
+        self.window = window
+        self.flush = flush
+        self.deadlines = deadlines
+        # Band -> open Batch
+        self.open = {}
+        self.count = 0
+
+    def __len__(self):
+        "How many tasks are waiting in open batches"
+        return self.count
+
+    def eligible(self, task):
+        "True if the task may be coalesced"
+        return task.runtime is not None and task.runtime <= self.window.max_runtime
+
+    def room(self):
+        "How many more tasks the open batches can take"
+        return sum(self.window.size - len(batch.tasks) for batch in self.open.values())
+
+    def add(self, task):
+        """
+        Adds the task to the open batch of its band, and returns the batch. It
+        should be closed right away if it's `full`.
+        """
+        band = task.priority // self.window.band
+        batch = self.open.get(band)
+        if batch is None:
+            batch = self.open[band] = Batch(band)
+            batch.deadline = self.deadlines.add(self.window.latency, self.close, batch)
+        batch.tasks.append(task)
+        self.count += 1
+        return batch
+
+    def full(self, batch):
+        return len(batch.tasks) >= self.window.size
+
+    def remove(self, batch, task):
+        """
+        Takes a task out of an open batch, forgetting about the batch if it's
+        left empty. Raises ValueError if it's not there
+        """
+        batch.remove(task)
+        self.count -= 1
+        if not batch.tasks:
+            self.deadlines.cancel(batch.deadline)
+            batch.deadline = None
+            del self.open[batch.band]
+
+    def is_open(self, batch):
+        return self.open.get(batch.band) is batch
+
+    def close(self, batch):
+        "Closes an open batch, and hands it to `flush`"
+        if batch.deadline is not None:
+            self.deadlines.cancel(batch.deadline)
+            batch.deadline = None
+        del self.open[batch.band]
+        self.count -= len(batch.tasks)
+        self.flush(batch)
+
+    def stop(self):
+        "Stops closing batches. The tasks in open ones are left there"
+        for batch in self.open.values():
+            if batch.deadline is not None:
+                self.deadlines.cancel(batch.deadline)
+                batch.deadline = None
+
+class BatchTarget:
+    """
+    The target of a batch process: runs the targets one by one, and sends the
+    exit status of each one (see `run_target`) through `conn` as it's done.
+    """
+    def __init__(self, targets):
+        self.targets = targets
+        self.conn = None
+
+    def __repr__(self):
+        return f"BatchTarget({len(self.targets)} targets)"
+
+    def __call__(self):
+        # As the pool workers: the batch is interrupted by the runner, not by Ctrl-C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for target in self.targets:
+            self.conn.send(run_target(target))
+        self.conn.close()
+
+class BatchTask(ProcessTask):
+    """
+    Runs the targets of several `tasks` on a single process, offering the same
+    interface as ProcessTask (ie. for the process as a whole).
+
+    The outcome of every task (SUCCESS or ERROR) is in `results`, in the same
+    order, or None for the ones that didn't get to finish. The targets run in
+    order, so the one at `received` (if any) was running when the process
+    exited, and the ones after it never started. Callbacks added with
+    `add_result_callback` are invoked as `callback(ptask, task, result)` as
+    soon as every task is done, before the ones added with `add_done_callback`.
+    """
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self.target = BatchTarget([task.target for task in self.tasks])
+        super().__init__(multiprocessing.Process(target=self.target))
+        self.results = [None] * len(self.tasks)
+        self.result_callbacks = []
+        self.reader = None
+        self.received = 0
+
+    def __repr__(self):
+        return f"BatchTask({len(self.tasks)} tasks)"
+
+    def add_result_callback(self, callback):
+        self.result_callbacks.append(callback)
+        return self
+
+    def start(self):
+        with spawning():
+            self.reader, self.target.conn = multiprocessing.Pipe(duplex=False)
+            try:
+                super().start()
+            finally:
+                # Only the child writes. This way, we get an EOF once it's gone
+                self.target.conn.close()
+        asyncio.get_running_loop().add_reader(self.reader.fileno(), self._read_result)
+
+    def _read_result(self):
+        try:
+            status = self.reader.recv()
+        except EOFError:
+            self._stop_reading()
+            return
+        index = self.received
+        self.received += 1
+        result = self.results[index] = Result.SUCCESS if status == 0 else Result.ERROR
+        for callback in self.result_callbacks:
+            callback(self, self.tasks[index], result)
+
+    def _stop_reading(self):
+        if self.reader is not None:
+            asyncio.get_running_loop().remove_reader(self.reader.fileno())
+            self.reader.close()
+            self.reader = None
+
+    async def _set_done(self):
+        # Whatever the process sent before exiting may still be unread
+        try:
+            while self.reader is not None and self.reader.poll():
+                self._read_result()
+        except OSError as exc:
+            logging.warning(f"  - Lost the results of {self}", exc_info=exc)
+        self._stop_reading()
+        await super()._set_done()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Compares the throughput (jobs/s) of CPU-bound jobs left to the OS scheduler,
+against pinning each one of them to a CPU chosen by a CpuPlacer.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from .affinity import CpuPlacer
+from .runner import PriorityRunner
+from .scheduler_bin import SchedulerBin, TaskDescription
+
+DEFAULT_JOBS = 200
+DEFAULT_WORK = 2000000
+
+class Spinner:
+    "A CPU-bound job: counts up to `work`"
+    def __init__(self, work):
+        self.work = work
+
+    def __call__(self):
+        n = 0
+        for _ in range(self.work):
+            n += 1
+
+async def run_jobs(njobs, size, work, placer):
+    runner = PriorityRunner(size, placer=placer)
+    sbin = SchedulerBin(runner)
+
+    finished = 0
+    all_done = asyncio.Event()
+    def count_job():
+        nonlocal finished
+        finished += 1
+        if finished == njobs:
+            all_done.set()
+    runner.add_done_callback(count_job)
+
+    start = time.perf_counter()
+    for _ in range(njobs):
+        sbin.schedule(TaskDescription(priority=0, timeout=None, target=Spinner(work)))
+    await all_done.wait()
+    elapsed = time.perf_counter() - start
+
+    sbin.shutdown()
+    return elapsed
+
+async def main(args):
+    cpus = os.sched_getaffinity(0)
+    size = args.size or len(cpus)
+    print(f"{len(cpus)} CPUs, {size} concurrent jobs")
+    for label, reserve in (('unpinned', None), ('pinned', 0), ('reserved', 1)):
+        # Built right before its run: reserving pins this thread to the
+        # reserved CPU, until the placer gives it back
+        placer = CpuPlacer(cpus, reserve=reserve) if reserve is not None else None
+        try:
+            elapsed = await run_jobs(args.jobs, size, args.work, placer)
+        finally:
+            if placer is not None:
+                placer.unreserve()
+        print(f"{label:>8}: {args.jobs} jobs in {elapsed:.3f}s ({args.jobs / elapsed:,.1f} jobs/s)")
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='jobs', type=int, default=DEFAULT_JOBS,
+            help=f"number of jobs to run. Default: {DEFAULT_JOBS}")
+    parser.add_argument('-s', dest='size', type=int,
+            help="maximum number of concurrent jobs. Default: one per CPU")
+    parser.add_argument('-w', dest='work', type=int, default=DEFAULT_WORK,
+            help=f"iterations of the busy loop run by each job. Default: {DEFAULT_WORK}")
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(args))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Measures the throughput (jobs/s) of the bus relaying jobs from producers to
+the schedulers, for each of the encodings: one JSON message per job, JSON
+batches, and binary batches.
+
+The bus runs on its own processes: as many workers as given with `-w`, and
+the benchmark is repeated for every number of them, to see how it scales. The
+producers (as many connections as given with `-c`, sending the jobs round
+robin) and the schedulers (which just decode and count the jobs they get) run
+on a process each as well, not to be the bottleneck. Every run gets a bus of
+its own: in dispatch mode, the jobs of the schedulers that leave are
+dispatched again, and they would be counted by the next run.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import websockets
+
+from . import bus, wire
+from .producer import get_new_payload
+
+DEFAULT_JOBS = 100000
+DEFAULT_BATCH = 100
+DEFAULT_SCHEDULERS = 1
+DEFAULT_PRODUCERS = 1
+PORT = 8102
+
+def run_bus(dispatch, workers):
+    # Silence the bus' reports on (dis)connections
+    logging.disable(logging.CRITICAL)
+    sys.stdout = open(os.devnull, 'w')
+    if workers > 1:
+        asyncio.run(bus.serve_workers(dispatch, workers, PORT))
+    else:
+        asyncio.run(bus.serve(dispatch, PORT))
+
+def encode(payloads, encoding, batch):
+    if encoding == 'json':
+        return [bus.create_message('job_request', payload=p) for p in payloads]
+
+    batches = [payloads[k:k + batch] for k in range(0, len(payloads), batch)]
+    if encoding == 'batch':
+        return [bus.create_message('job_batch', payloads=b) for b in batches]
+    return [wire.encode_jobs(b) for b in batches]
+
+async def sink(url, expected, dispatch, ready, done):
+    "A fake scheduler, counting the jobs it receives"
+    received = 0
+    async with websockets.connect(url, max_size=None) as websocket:
+        await websocket.send(bus.create_message('register', type='scheduler'))
+        if dispatch:
+            await websocket.send(bus.create_message('credit', credits=expected))
+        ready.set()
+        async for message in websocket:
+            received += len(wire.decode_message(message))
+            if received >= expected:
+                break
+    done.put(time.monotonic())
+
+async def produce(url, messages, ready, go):
+    async with websockets.connect(url) as websocket:
+        await websocket.send(bus.create_message('register', type='producer'))
+        ready.set()
+        await asyncio.to_thread(go.wait)
+        for message in messages:
+            await websocket.send(message)
+        # Closing right away could drop what's still on its way
+        await asyncio.Future()
+
+def run_sink(*args):
+    "Only internal use, as the target of the process of a sink"
+    asyncio.run(sink(*args))
+
+def run_producer(url, count, encoding, batch, ready, go):
+    "Only internal use, as the target of the process of a producer"
+    messages = encode([get_new_payload() for _ in range(count)], encoding, batch)
+    asyncio.run(produce(url, messages, ready, go))
+
+def run(args, workers, encoding):
+    url = f'ws://localhost:{PORT}'
+    # With broadcasting, every scheduler gets every job
+    expected = args.jobs // args.schedulers if args.dispatch else args.jobs
+    # Jobs sent by every producer
+    shares = [args.jobs * (k + 1) // args.producers - args.jobs * k // args.producers
+              for k in range(args.producers)]
+    messages = sum(shares) if encoding == 'json' else sum(-(-share // args.batch) for share in shares)
+
+    done = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    readies = []
+    clients = []
+    for _ in range(args.schedulers):
+        readies.append(multiprocessing.Event())
+        clients.append(multiprocessing.Process(target=run_sink,
+                                               args=(url, expected, args.dispatch, readies[-1], done)))
+        clients[-1].start()
+    # Registered before the producers, so they don't miss any job
+    for ready in readies:
+        ready.wait()
+    # Let the bus process the registrations
+    time.sleep(0.5)
+    for share in shares:
+        readies.append(multiprocessing.Event())
+        clients.append(multiprocessing.Process(target=run_producer,
+                                               args=(url, share, encoding, args.batch, readies[-1], go)))
+        clients[-1].start()
+    for ready in readies:
+        ready.wait()
+    time.sleep(0.5)
+
+    start = time.monotonic()
+    go.set()
+    elapsed = max(done.get() for _ in range(args.schedulers)) - start
+    for client in clients:
+        client.terminate()
+        client.join()
+
+    print(f"{workers:>7} {encoding:>6}: {messages} messages, {args.jobs} jobs in {elapsed:.3f}s "
+          f"({messages / elapsed:,.0f} messages/s, {args.jobs / elapsed:,.0f} jobs/s)")
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='jobs', type=int, default=DEFAULT_JOBS,
+            help=f"number of jobs to send. Default: {DEFAULT_JOBS}")
+    parser.add_argument('-b', dest='batch', type=int, default=DEFAULT_BATCH,
+            help=f"jobs per batch. Default: {DEFAULT_BATCH}")
+    parser.add_argument('-s', dest='schedulers', type=int, default=DEFAULT_SCHEDULERS,
+            help=f"number of schedulers. Default: {DEFAULT_SCHEDULERS}")
+    parser.add_argument('-c', dest='producers', type=int, default=DEFAULT_PRODUCERS,
+            help=f"number of producer connections. Default: {DEFAULT_PRODUCERS}")
+    parser.add_argument('-w', dest='workers', type=int, nargs='+', default=[1],
+            help="numbers of bus workers to benchmark, one after the other. Default: 1")
+    parser.add_argument('--dispatch', dest='dispatch', action='store_true',
+            help="run the bus in dispatch mode")
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(f"{args.producers} producers, {args.schedulers} schedulers")
+    print("workers encoding")
+    for workers in args.workers:
+        for encoding in ('json', 'batch', 'binary'):
+            bus_process = multiprocessing.Process(target=run_bus, args=(args.dispatch, workers))
+            bus_process.start()
+            time.sleep(1)
+            try:
+                run(args, workers, encoding)
+            finally:
+                bus_process.terminate()
+                bus_process.join()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark of the pending queues of SchedulerBin for large backlogs:
+PendingQueue (a heap of entries, each one holding a TaskDescription) against
+CompactPendingQueue (a heap of integers, with the tasks kept as columns).
+
+It measures the memory held by the queue per task, and the throughput of
+pushing, removing (ie. cancelling) and popping the tasks. The tasks are like
+the ones made by the `test_scheduler`: with a job id, a shared target and
+timing hints.
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+import uuid
+from random import Random
+
+from .pending import CompactPendingQueue, PendingQueue
+from .scheduler_bin import TaskDescription
+from .sleeper import Sleeper
+
+DEFAULT_TASKS = 1000000
+# Fraction of the tasks that are removed before popping the rest
+DEFAULT_REMOVE = 0.1
+
+QUEUES = {
+    'heap': lambda: PendingQueue(key=rank),
+    'compact': lambda: CompactPendingQueue(TaskDescription, key=rank),
+}
+
+def rank(task):
+    task.rank = task.priority
+    return task.rank
+
+def make_specs(count, seed):
+    "Returns what's needed to make `count` tasks: their job id, priority and runtime"
+    rnd = Random(seed)
+    return [(uuid.UUID(int=rnd.getrandbits(128)).hex, rnd.randint(0, 10), rnd.randint(3, 15))
+            for _ in range(count)]
+
+def push_all(queue, specs, sleepers):
+    return [queue.push(TaskDescription(priority=priority, timeout=10.0, target=sleepers[runtime],
+                                       job_id=job_id, runtime=runtime, deadline=0.0))
+            for job_id, priority, runtime in specs]
+
+def measure_memory(make_queue, specs, sleepers):
+    "Bytes held by the queue (and its tasks) per task"
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queue = make_queue()
+    handles = push_all(queue, specs, sleepers)
+    del handles
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held / len(specs)
+
+def measure_speed(make_queue, specs, sleepers, remove, seed):
+    "Returns the push, remove and pop throughput, in ops/s"
+    queue = make_queue()
+    start = time.perf_counter()
+    handles = push_all(queue, specs, sleepers)
+    pushed = time.perf_counter() - start
+
+    removed = Random(seed).sample(handles, int(len(handles) * remove))
+    start = time.perf_counter()
+    for handle in removed:
+        queue.remove(handle)
+    removing = time.perf_counter() - start
+
+    count = len(queue)
+    start = time.perf_counter()
+    while queue:
+        queue.pop()
+    popping = time.perf_counter() - start
+
+    return len(specs) / pushed, len(removed) / removing if removed else 0, count / popping
+
+def main(args):
+    specs = make_specs(args.tasks, args.seed)
+    sleepers = {runtime: Sleeper(runtime) for runtime in range(3, 16)}
+    print(f"{args.tasks:,} tasks, removing {args.remove:.0%} of them before popping the rest")
+    print(f"{'queue':>8} {'bytes/task':>10} {'push/s':>11} {'remove/s':>11} {'pop/s':>11}")
+    for name in args.queues:
+        memory = measure_memory(QUEUES[name], specs, sleepers)
+        push, remove, pop = measure_speed(QUEUES[name], specs, sleepers, args.remove, args.seed)
+        print(f"{name:>8} {memory:>10,.0f} {push:>11,.0f} {remove:>11,.0f} {pop:>11,.0f}")
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='tasks', type=int, default=DEFAULT_TASKS,
+            help=f"number of tasks to queue. Default: {DEFAULT_TASKS}")
+    parser.add_argument('-r', dest='remove', type=float, default=DEFAULT_REMOVE,
+            help=f"fraction of the tasks to remove before popping the rest. Default: {DEFAULT_REMOVE}")
+    parser.add_argument('-q', dest='queues', nargs='+', choices=QUEUES, default=list(QUEUES),
+            help="queues to benchmark. Default: all")
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+            help="seed for the random tasks. Default: 0")
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main(parse_args())
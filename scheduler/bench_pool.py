@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+Compares the throughput (jobs/s) of running short jobs with a new process
+each, against running them on a WorkerPool, on threads and as coroutines.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .pool import WorkerPool
+from .runner import PriorityRunner
+from .scheduler_bin import Backend, SchedulerBin, TaskDescription
+
+DEFAULT_JOBS = 1000
+DEFAULT_POOL_SIZE = 8
+
+def short_job():
+    ...
+
+async def short_coroutine():
+    ...
+
+async def run_jobs(njobs, size, use_pool, backend):
+    pool = WorkerPool(size) if use_pool else None
+    executor = ThreadPoolExecutor(size) if backend == Backend.THREAD else None
+    runner = PriorityRunner(size)
+    sbin = SchedulerBin(runner, pool=pool, executor=executor)
+    target = short_coroutine if backend == Backend.COROUTINE else short_job
+
+    finished = 0
+    all_done = asyncio.Event()
+    def count_job():
+        nonlocal finished
+        finished += 1
+        if finished == njobs:
+            all_done.set()
+    runner.add_done_callback(count_job)
+
+    start = time.perf_counter()
+    for _ in range(njobs):
+        sbin.schedule(TaskDescription(priority=0, timeout=None, target=target, backend=backend))
+    await all_done.wait()
+    elapsed = time.perf_counter() - start
+
+    sbin.shutdown()
+    if executor is not None:
+        executor.shutdown()
+    return elapsed
+
+async def main(args):
+    for label, use_pool, backend in (('process', False, Backend.PROCESS),
+                                     ('pool', True, Backend.PROCESS),
+                                     ('thread', False, Backend.THREAD),
+                                     ('coroutine', False, Backend.COROUTINE)):
+        elapsed = await run_jobs(args.jobs, args.size, use_pool, backend)
+        print(f"{label:>9}: {args.jobs} jobs in {elapsed:.3f}s ({args.jobs / elapsed:,.0f} jobs/s)")
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='jobs', type=int, default=DEFAULT_JOBS,
+            help=f"number of jobs to run. Default: {DEFAULT_JOBS}")
+    parser.add_argument('-s', dest='size', type=int, default=DEFAULT_POOL_SIZE,
+            help=f"maximum number of concurrent jobs. Default: {DEFAULT_POOL_SIZE}")
+    parser.add_argument('-m', dest='method', choices=multiprocessing.get_all_start_methods(),
+            help="multiprocessing start method. Default: the platform's")
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.method:
+        multiprocessing.set_start_method(args.method)
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(args))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark for the bookkeeping done by PriorityRunner when scheduling,
+evicting and completing jobs. No actual processes are involved: jobs are
+backed by NullTask, which just pretends to run.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from random import randint
+
+from .process import BaseTask, Result
+from .runner import PriorityRunner
+
+DEFAULT_SLOTS = 10000
+
+class NullTask(BaseTask):
+    "Offers the ProcessTask interface, without running anything"
+    pid = None
+    suspendable = False
+
+    def start(self):
+        ...
+
+    def terminate(self, result=Result.TERMINATED):
+        if self.result is None:
+            self.result = result
+
+    async def finish(self):
+        if self.result is None:
+            self.result = Result.SUCCESS
+        await self._set_done()
+
+def report(label, count, elapsed):
+    print(f"{label:>10}: {count} ops in {elapsed:.3f}s ({count / elapsed:,.0f} ops/s)")
+
+async def main(slots):
+    runner = PriorityRunner(slots)
+
+    # Fill every slot with low priority jobs
+    tasks = [NullTask() for _ in range(slots)]
+    start = time.perf_counter()
+    for task in tasks:
+        runner.schedule(task, randint(5, 10), None)
+    report('schedule', slots, time.perf_counter() - start)
+
+    # Higher priority jobs, each one of them evicting a running one
+    tasks = [NullTask() for _ in range(slots)]
+    start = time.perf_counter()
+    for task in tasks:
+        runner.schedule(task, randint(0, 4), None)
+    report('evict', slots, time.perf_counter() - start)
+
+    # Every job finishes, freeing its slot
+    start = time.perf_counter()
+    for task in tasks:
+        await task.finish()
+    report('complete', slots, time.perf_counter() - start)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='slots', type=int, default=DEFAULT_SLOTS,
+            help=f"number of concurrent slots. Default: {DEFAULT_SLOTS}")
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    # Otherwise we'd be measuring the logging
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(args.slots))
@@ -1,19 +1,311 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
+import heapq
 import json
 import logging
+import multiprocessing
+import os
 import signal
+import tempfile
+import time
 import websockets
+from itertools import count
+
+from .hub import Hub, HubLink
+from .wire import BATCH_MAGIC, FINAL_EVENTS, BinaryBatch, JsonBatch, batch_from_frame
+
+PORT = 8101
 
 def create_message(command, **kw):
     msg = {'cmd': command, **kw}
     return json.dumps(msg)
 
 class Bus:
-    def __init__(self):
+    """
+    Relays the jobs submitted by producers to the schedulers.
+
+    In the default mode, every job is broadcast to all the schedulers. With
+    `dispatch=True`, each job is delivered to exactly one scheduler instead,
+    using credit-based flow control: schedulers advertise how many more jobs
+    they can take with `credit` messages, and every job sent to one of them
+    consumes one of its credits. Jobs that can't be delivered because no
+    scheduler has credits left are held in a priority queue until one does.
+    If a scheduler goes away, the jobs (with an id) sent to it that it didn't
+    report to have started are dispatched again, and those that started are
+    reported to their producers as 'lost'.
+
+    Producers can cancel jobs by their id with a `cancel` message, which is
+    relayed to all the schedulers. In dispatch mode, cancelled jobs that are
+    still queued on the bus are discarded as they come up, instead of being
+    delivered.
+
+    Producers that register with `'events': True` get the events of the jobs
+    they submitted (with an id), as the schedulers report them in `job_events`
+    frames. Each frame is split by producer, so that every one of them only
+    gets the events of its own jobs.
+
+    Jobs may come one per message, or in batches (see the `wire` module for
+    the encodings). Whenever possible, the frames are relayed to the schedulers
+    as they were received, without decoding and encoding them again.
+
+    A bus may also be one of several workers serving the same port, linked
+    through a hub (see the `hub` module), so that producers and schedulers
+    connected to different workers work as if they were on the same one. The
+    `remote_*` methods handle what the other workers send. Jobs dispatched to a
+    worker whose schedulers don't have the credits any longer (they were taken
+    by others in the meantime) are given back to the sender.
+    """
+    def __init__(self, dispatch=False):
         self.producers = set()
         self.schedulers = set()
+        self.dispatching = dispatch
+        self.credits = {}
+        self.queued = []
+        self.sequence = count()
+        # Ids of the jobs in `queued`, and of those among them that were cancelled
+        self.queued_ids = set()
+        self.cancelled = set()
+        # Scheduler -> {job id: [payload, started]}, for the jobs sent to it that
+        # are not done yet
+        self.inflight = {}
+        # Producers that want events, and job id -> the producer that submitted it
+        self.subscribers = set()
+        self.owners = {}
+        # HubLink, when the bus is one of several workers
+        self.link = None
+        # Worker -> credits of its schedulers, and job id -> worker of the
+        # producer that submitted it, for the other workers
+        self.remote_credits = {}
+        self.remote_owners = {}
+
+    def relay(self, batch, origin):
+        "Delivers a batch of jobs to the schedulers, according to the bus mode"
+        if origin in self.subscribers:
+            owned = [job_id for job_id in batch.ids() if job_id is not None]
+            for job_id in owned:
+                self.owners[job_id] = origin
+            if owned and self.link is not None:
+                # Ahead of the jobs, so that the other workers know where their events go
+                self.link.own(owned)
+        if self.dispatching:
+            self.dispatch(batch)
+        else:
+            websockets.broadcast(self.schedulers - {origin}, batch.frame)
+            if self.link is not None:
+                self.link.broadcast(batch.frame)
+
+    def dispatch(self, batch):
+        """
+        Sends the jobs to the schedulers with credits, splitting the batch if
+        needed. With other workers, the jobs that no scheduler of this one can
+        take are sent to those with credits. Jobs that can't be sent anywhere are
+        queued.
+        """
+        batch = self.deliver(batch)
+        if len(batch) and self.link is not None:
+            batch = self.forward(batch)
+        if len(batch):
+            for prio, job_id, job in zip(batch.priorities(), batch.ids(), batch.singles()):
+                heapq.heappush(self.queued, (prio, next(self.sequence), job_id, job))
+                if job_id is not None:
+                    self.queued_ids.add(job_id)
+
+    def deliver(self, batch):
+        """
+        Sends the jobs to the schedulers of this worker with the most credits,
+        as far as they go. Returns the jobs left (maybe an empty tuple).
+        """
+        consumed = 0
+        while len(batch):
+            scheduler = max(self.credits, key=self.credits.get, default=None)
+            if scheduler is None or self.credits[scheduler] == 0:
+                break
+            taken = min(self.credits[scheduler], len(batch))
+            if taken < len(batch):
+                sent, batch = batch.split(taken)
+            else:
+                sent, batch = batch, ()
+            self.credits[scheduler] -= taken
+            consumed += taken
+            self.send_jobs(scheduler, sent)
+        if consumed:
+            self.credits_changed()
+        return batch
+
+    def send_jobs(self, scheduler, batch):
+        "Sends jobs to a scheduler, keeping those with an id until they're done"
+        if isinstance(batch, JsonBatch):
+            inflight = self.inflight.setdefault(scheduler, {})
+            for payload in batch.payloads:
+                job_id = payload.get('id')
+                if job_id is not None:
+                    inflight[job_id] = [payload, False]
+        websockets.broadcast({scheduler}, batch.frame)
+
+    def settle(self, scheduler, events):
+        "Follows the jobs sent to a scheduler, from the events that it reports"
+        inflight = self.inflight.get(scheduler)
+        if not inflight:
+            return
+        for entry in events:
+            job = inflight.get(entry[0])
+            if job is None:
+                continue
+            if entry[1] in FINAL_EVENTS:
+                del inflight[entry[0]]
+            elif entry[1] == 'started':
+                job[1] = True
+
+    def scheduler_gone(self, scheduler):
+        """
+        Dispatches again the jobs sent to a scheduler that went away before
+        starting them, and reports the ones that it started as 'lost' (they may
+        or may not have finished).
+        """
+        jobs = self.inflight.pop(scheduler, {})
+        pending = [payload for payload, started in jobs.values() if not started]
+        lost = [[job_id, 'lost', time.time()] for job_id, (_, started) in jobs.items() if started]
+        if pending:
+            logging.warning(f"Dispatching again {len(pending)} jobs of a scheduler that went away")
+            self.dispatch(JsonBatch(pending))
+        if lost:
+            self.route_events(lost)
+
+    def forward(self, batch):
+        """
+        Sends the jobs to the other workers with the most credits, as far as
+        they go. Returns the jobs left (maybe an empty tuple).
+        """
+        while len(batch):
+            worker = max(self.remote_credits, key=self.remote_credits.get, default=None)
+            if worker is None or self.remote_credits[worker] == 0:
+                break
+            taken = min(self.remote_credits[worker], len(batch))
+            if taken < len(batch):
+                sent, batch = batch.split(taken)
+            else:
+                sent, batch = batch, ()
+            # Until the worker advertises its credits again
+            self.remote_credits[worker] -= taken
+            self.link.dispatch(worker, sent.frame)
+        return batch
+
+    def unqueue(self, count):
+        """
+        Pops up to `count` queued jobs, highest priority first, discarding the
+        cancelled ones on the way.
+        """
+        jobs = []
+        while len(jobs) < count and self.queued:
+            _, _, job_id, job = heapq.heappop(self.queued)
+            if job_id is not None:
+                self.queued_ids.discard(job_id)
+                if job_id in self.cancelled:
+                    self.cancelled.discard(job_id)
+                    continue
+            jobs.append(job)
+        return jobs
+
+    def add_credits(self, scheduler, credits):
+        """
+        Grants more credits to a scheduler, using them right away to
+        deliver queued jobs.
+        """
+        jobs = self.unqueue(credits + self.credits[scheduler])
+        self.credits[scheduler] += credits - len(jobs)
+        for job in jobs:
+            self.send_jobs(scheduler, job)
+        self.credits_changed()
+
+    def credits_changed(self):
+        "Lets the other workers know how many credits the schedulers of this one have"
+        if self.dispatching and self.link is not None:
+            self.link.advertise(sum(self.credits.values()))
+
+    def cancel(self, job_ids, frame, forward=True):
+        """
+        Relays a cancellation to all the schedulers (and to the other workers,
+        if `forward`), and marks the jobs queued on the bus (if any) to be
+        discarded.
+        """
+        self.cancelled.update(job_id for job_id in job_ids if job_id in self.queued_ids)
+        websockets.broadcast(self.schedulers, frame)
+        if forward and self.link is not None:
+            self.link.cancel(frame)
+
+    def route_events(self, events, forward=True):
+        """
+        Sends every producer the events of the jobs it submitted, all in a
+        single frame. Jobs are forgotten after their final event.
+
+        The events of jobs submitted through other workers are sent to them
+        (if `forward`), all in a single frame as well.
+        """
+        routed = {}
+        remote = {}
+        finished = []
+        for entry in events:
+            job_id, event = entry[0], entry[1]
+            owner = self.owners.get(job_id)
+            if owner is not None:
+                routed.setdefault(owner, []).append(entry)
+                if event in FINAL_EVENTS:
+                    del self.owners[job_id]
+                    finished.append(job_id)
+            elif forward and job_id in self.remote_owners:
+                remote.setdefault(self.remote_owners[job_id], []).append(entry)
+                if event in FINAL_EVENTS:
+                    del self.remote_owners[job_id]
+        for producer, producer_events in routed.items():
+            websockets.broadcast({producer}, create_message('job_events', events=producer_events))
+        if self.link is not None:
+            for worker, worker_events in remote.items():
+                self.link.route_events(worker, worker_events)
+            if finished:
+                self.link.disown(finished)
+
+    def remote_linked(self, worker):
+        "Another worker linked to the hub, and needs to know about this one"
+        self.credits_changed()
+
+    def remote_broadcast(self, frame):
+        "Jobs that another worker got, for all the schedulers"
+        websockets.broadcast(self.schedulers, frame)
+
+    def remote_dispatch(self, worker, frame):
+        """
+        Jobs that another worker sent to this one's schedulers. Those that they
+        don't have the credits for any longer are given back.
+        """
+        batch = self.deliver(batch_from_frame(frame))
+        if len(batch):
+            self.link.give_back(worker, batch.frame)
+
+    def remote_returned(self, worker, frame):
+        "Jobs dispatched to another worker, that it couldn't take"
+        # Until it advertises its credits again
+        self.remote_credits[worker] = 0
+        self.dispatch(batch_from_frame(frame))
+
+    def remote_credits_changed(self, worker, credits):
+        "Another worker advertised its credits: they may take jobs queued here"
+        self.remote_credits[worker] = credits
+        jobs = self.unqueue(credits)
+        self.remote_credits[worker] -= len(jobs)
+        for job in jobs:
+            self.link.dispatch(worker, job.frame)
+
+    def remote_own(self, worker, job_ids):
+        "Jobs submitted through another worker, by producers that want their events"
+        for job_id in job_ids:
+            self.remote_owners[job_id] = worker
+
+    def remote_disown(self, job_ids):
+        "Jobs whose events are not wanted any longer"
+        for job_id in job_ids:
+            self.remote_owners.pop(job_id, None)
 
     async def handler(self, this_socket):
         producer = False
@@ -23,17 +315,40 @@ class Bus:
         try:
             try:
                 async for message in this_socket:
+                    if isinstance(message, bytes):
+                        if message.startswith(BATCH_MAGIC):
+                            self.relay(BinaryBatch(message), this_socket)
+                        else:
+                            logging.warning(f"Unknown binary frame from {this_socket}")
+                        continue
+
                     msg = json.loads(message)
                     if msg['cmd'] == 'register':
                         if msg['type'] == 'producer':
                             producer = True
                             self.producers.add(this_socket)
+                            if msg.get('events'):
+                                self.subscribers.add(this_socket)
                         elif msg['type'] == 'scheduler':
                             scheduler = True
                             self.schedulers.add(this_socket)
+                            self.credits[this_socket] = 0
                     elif msg['cmd'] == 'job_request':
-                        job = json.dumps(msg['payload'])
-                        websockets.broadcast(self.schedulers - {this_socket}, job)
+                        self.relay(JsonBatch([msg['payload']], message), this_socket)
+                    elif msg['cmd'] == 'job_batch':
+                        self.relay(JsonBatch(msg['payloads'], message), this_socket)
+                    elif msg['cmd'] == 'job_events':
+                        if scheduler:
+                            self.settle(this_socket, msg['events'])
+                        self.route_events(msg['events'])
+                    elif msg['cmd'] == 'cancel':
+                        self.cancel(msg['ids'], message)
+                    elif msg['cmd'] == 'credit':
+                        if self.dispatching and scheduler:
+                            self.add_credits(this_socket, msg['credits'])
+                    if self.link is not None:
+                        # Don't take more from the client than the hub can take
+                        await self.link.drain()
             except websockets.ConnectionClosedOK:
                 ...
         except Exception as exc:
@@ -41,9 +356,19 @@ class Bus:
         finally:
             if producer:
                 self.producers.remove(this_socket)
+                if this_socket in self.subscribers:
+                    self.subscribers.remove(this_socket)
+                    if self.link is not None:
+                        self.link.disown([job_id for job_id, owner in self.owners.items()
+                                          if owner is this_socket])
+                    self.owners = {job_id: owner for job_id, owner in self.owners.items()
+                                   if owner is not this_socket}
                 print(f'Now, producers: {len(self.producers)}')
             elif scheduler:
                 self.schedulers.remove(this_socket)
+                del self.credits[this_socket]
+                self.credits_changed()
+                self.scheduler_gone(this_socket)
                 print(f'Now, schedulers: {len(self.schedulers)}')
 
 def shutdown(stop):
@@ -51,15 +376,68 @@ def shutdown(stop):
     if not stop.done():
         stop.set_result(None)
 
-async def main():
-    bus = Bus()
-    async with websockets.serve(bus.handler, "", 8101) as server:
-        stop = asyncio.Future()
-        loop = asyncio.get_event_loop()
-        loop.add_signal_handler(signal.SIGINT, shutdown, stop)
-        await stop # Wait forever
+async def wait_for_signals():
+    "Waits for SIGINT or SIGTERM"
+    stop = asyncio.Future()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, shutdown, stop)
+    await stop
+
+async def serve(dispatch, port=PORT, worker=None, hub_path=None):
+    """
+    Runs a bus until it gets a signal to stop. With a `hub_path`, as worker
+    number `worker` of several, sharing the port with the others.
+    """
+    bus = Bus(dispatch=dispatch)
+    link = None
+    if hub_path is not None:
+        link = HubLink(hub_path, worker, bus)
+        await link.connect()
+    async with websockets.serve(bus.handler, "", port, reuse_port=hub_path is not None):
+        await wait_for_signals()
+    if link is not None:
+        link.close()
+
+def run_worker(dispatch, port, worker, hub_path):
+    "Only internal use, as the target of the processes of the workers"
+    asyncio.run(serve(dispatch, port, worker, hub_path))
+
+async def serve_workers(dispatch, workers, port=PORT):
+    """
+    Runs a bus made of several `workers` processes linked through a hub, until
+    it gets a signal to stop.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        hub = Hub(os.path.join(directory, 'hub'))
+        await hub.start()
+        processes = [multiprocessing.Process(target=run_worker, args=(dispatch, port, worker, hub.path))
+                     for worker in range(workers)]
+        for process in processes:
+            process.start()
+        await wait_for_signals()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.join)
+        hub.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dispatch', dest='dispatch', action='store_true',
+            help="deliver each job to a single scheduler with free capacity, instead of broadcasting it")
+    parser.add_argument('-w', dest='workers', type=int, default=1,
+            help="number of worker processes serving the port, linked through a hub. Default: 1")
+
+    return parser.parse_args()
+
+async def main(args):
+    if args.workers > 1:
+        await serve_workers(args.dispatch, args.workers)
+    else:
+        await serve(args.dispatch)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s: %(message)s')
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
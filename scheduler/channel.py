@@ -0,0 +1,159 @@
+"""
+A channel to pass an input payload to a job, and get its output back, through
+a shared memory buffer instead of pickling them through a pipe or a queue.
+
+The buffer is laid out as a header with the lengths of the payload and the
+result, followed by the payload, followed by the space reserved for the result.
+"""
+
+import asyncio
+import logging
+import struct
+from multiprocessing.shared_memory import SharedMemory
+
+from .process import Result
+
+# Payload length, result length
+HEADER = struct.Struct('<QQ')
+
+# Channels that this process attached to by unpickling them (see `detach_all`)
+_attached = []
+
+class ResultTooLargeError(Exception):
+    ...
+
+def _attach(name):
+    """
+    Attaches to the buffer of another process, leaving it to the resource
+    tracker of its creator (which is shared by the worker pools, see
+    WorkerPool): only the creator unlinks it.
+
+    Only internal use.
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching always registers the buffer. With the
+        # creator's tracker, that's just a duplicate of its own registration
+        return SharedMemory(name=name)
+
+def detach_all():
+    """
+    Closes the buffers attached to by this process so far. Long-lived processes
+    running jobs (eg. the workers of a pool) call it once a job is done.
+    """
+    while _attached:
+        channel = _attached.pop()
+        try:
+            channel.shm.close()
+        except BufferError:
+            logging.warning(f"{channel} is still in use after its job. Leaving it open")
+
+class SharedChannel:
+    """
+    Created by the parent, with room for `result_size` bytes of output, and
+    either a `payload` (which is copied into the buffer), or just room for
+    `payload_size` bytes, to be filled through the `payload` view. The job
+    gets the channel as its only argument (see TaskDescription.channel).
+
+    On the job's side, `payload` is a view on the input. The output can be
+    written straight into the `output` view, and then `commit`ed, or copied
+    with `write`.
+
+    On the parent's side, `wait` blocks until the job is done, and returns a
+    view on the result. The views share the memory with the job: there are no
+    copies other than the ones made by the job itself.
+
+    The parent owns the buffer, and must `close` the channel when done with
+    it, once every view obtained from it has been released.
+    """
+    def __init__(self, result_size, payload=None, payload_size=None):
+        if payload is not None:
+            payload_size = len(payload)
+        elif payload_size is None:
+            payload_size = 0
+        self.payload_size = payload_size
+        self.result_size = result_size
+        self.shm = SharedMemory(create=True, size=max(HEADER.size + payload_size + result_size, 1))
+        HEADER.pack_into(self.shm.buf, 0, payload_size, 0)
+        if payload is not None:
+            self.shm.buf[HEADER.size:HEADER.size + payload_size] = payload
+        self.owner = True
+        self.result_status = None
+        self.done = asyncio.Event()
+
+    def __repr__(self):
+        return f"SharedChannel({self.shm.name})"
+
+    def __getstate__(self):
+        # Only what's needed to attach to the buffer on the job's side
+        return {'name': self.shm.name, 'payload_size': self.payload_size,
+                'result_size': self.result_size}
+
+    def __setstate__(self, state):
+        self.shm = _attach(state['name'])
+        _attached.append(self)
+        self.payload_size = state['payload_size']
+        self.result_size = state['result_size']
+        self.owner = False
+        self.result_status = None
+        self.done = None
+
+    @property
+    def payload(self):
+        "A view on the input payload"
+        return self.shm.buf[HEADER.size:HEADER.size + self.payload_size]
+
+    @property
+    def output(self):
+        "A writable view on the whole space reserved for the result"
+        start = HEADER.size + self.payload_size
+        return self.shm.buf[start:start + self.result_size]
+
+    def commit(self, length):
+        "Sets the length of the result written into `output`"
+        if length > self.result_size:
+            raise ResultTooLargeError(f"{length} bytes don't fit in a {self.result_size} bytes result")
+        HEADER.pack_into(self.shm.buf, 0, self.payload_size, length)
+
+    def write(self, data):
+        "Copies `data` into the buffer as the result"
+        length = len(data)
+        if length > self.result_size:
+            raise ResultTooLargeError(f"{length} bytes don't fit in a {self.result_size} bytes result")
+        start = HEADER.size + self.payload_size
+        self.shm.buf[start:start + length] = data
+        self.commit(length)
+
+    def result(self):
+        "A view on the result, as committed by the job"
+        _, length = HEADER.unpack_from(self.shm.buf, 0)
+        start = HEADER.size + self.payload_size
+        return self.shm.buf[start:start + length]
+
+    def set_status(self, result):
+        """
+        Records how the job ended (a Result), waking up anyone waiting for it.
+
+        Only for internal use.
+        """
+        self.result_status = result
+        self.done.set()
+
+    def completed(self, task):
+        "Done callback for the task running the job"
+        self.set_status(task.result)
+
+    async def wait(self):
+        """
+        Blocks until the job is done. Returns a view on the result if it
+        succeeded, and None otherwise.
+        """
+        await self.done.wait()
+        return self.result() if self.result_status == Result.SUCCESS else None
+
+    def close(self):
+        "Releases the buffer. On the parent's side, it's also destroyed"
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
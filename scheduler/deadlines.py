@@ -0,0 +1,95 @@
+import asyncio
+from itertools import count
+
+from .heap import IndexedHeap
+
+class Deadline:
+    """
+    An action to be performed at a certain (event loop) time. Returned by
+    Deadlines.add, and meant to be used as a handle to cancel it.
+    """
+    __slots__ = ('when', 'sequence', 'callback', 'args')
+
+    def __init__(self, when, sequence, callback, args):
+        self.when = when
+        self.sequence = sequence
+        self.callback = callback
+        self.args = args
+
+    def __repr__(self):
+        return f"Deadline({self.when:.3f}, {self.callback})"
+
+    def key(self):
+        return (self.when, self.sequence)
+
+class Deadlines:
+    """
+    A set of pending deadlines, driven by a single event loop timer that is
+    always armed for the earliest of them.
+
+    Adding and cancelling deadlines are O(log n) operations, and no event loop
+    timer is created or cancelled unless the earliest deadline moves ahead. The
+    number of pending deadlines is `len(deadlines)`.
+
+    If no `loop` is given, the running one is used.
+    """
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.heap = IndexedHeap(key=Deadline.key)
+        self.sequence = count()
+        self.timer = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def time(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        return self.loop.time()
+
+    def add(self, delay, callback, *args):
+        """
+        Schedules `callback(*args)` to be called in `delay` seconds. Returns the
+        Deadline, which can be passed to `cancel`.
+        """
+        deadline = Deadline(self.time() + delay, next(self.sequence), callback, args)
+        self.heap.push(deadline)
+        self._arm()
+        return deadline
+
+    def cancel(self, deadline):
+        """
+        Cancels a pending deadline. Does nothing if it has expired already, or
+        it was cancelled before.
+        """
+        try:
+            self.heap.remove(deadline)
+        except ValueError:
+            ...
+        # If it was the earliest one, the timer is left alone. It will fire
+        # early, find nothing to do, and wait for the next deadline.
+
+    def remaining(self, deadline):
+        "How many seconds are left for `deadline` to expire"
+        return max(deadline.when - self.time(), 0)
+
+    def _arm(self):
+        if not self.heap:
+            return
+
+        earliest = self.heap.peek().when
+        if self.timer is not None:
+            if self.timer.when() <= earliest:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_at(earliest, self._expire)
+
+    def _expire(self):
+        self.timer = None
+        now = self.loop.time()
+        try:
+            while self.heap and self.heap.peek().when <= now:
+                deadline = self.heap.pop()
+                deadline.callback(*deadline.args)
+        finally:
+            self._arm()
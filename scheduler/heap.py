@@ -0,0 +1,109 @@
+import operator
+
+class IndexedHeap:
+    """
+    A binary heap that keeps track of the position of each of its items,
+    which allows removing arbitrary items in O(log n) time.
+
+    Items are ordered by `key(item)`, smallest first, or largest first if
+    `reverse` is True. Keys must be unique, as the items themselves are never
+    compared. Items are tracked by identity, so they don't need to be hashable,
+    but the same object can't be pushed twice.
+    """
+    def __init__(self, key, reverse=False):
+        self.key = key
+        self.reverse = reverse
+        # Whether a key goes before another one
+        self.before = operator.gt if reverse else operator.lt
+        self.entries = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        "Iterates over the items, in no particular order"
+        return (item for _, item in self.entries)
+
+    def __contains__(self, item):
+        return id(item) in self.positions
+
+    def __repr__(self):
+        return f"IndexedHeap({list(self)})"
+
+    # The sifts are on the path of every job (see PriorityRunner and Deadlines),
+    # hence the local variables
+
+    def _sift_up(self, pos):
+        entries, positions, before = self.entries, self.positions, self.before
+        entry = entries[pos]
+        key = entry[0]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            moved = entries[parent]
+            if not before(key, moved[0]):
+                break
+            entries[pos] = moved
+            positions[id(moved[1])] = pos
+            pos = parent
+        entries[pos] = entry
+        positions[id(entry[1])] = pos
+
+    def _sift_down(self, pos):
+        entries, positions, before = self.entries, self.positions, self.before
+        size = len(entries)
+        entry = entries[pos]
+        key = entry[0]
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            right = child + 1
+            if right < size and before(entries[right][0], entries[child][0]):
+                child = right
+            moved = entries[child]
+            if not before(moved[0], key):
+                break
+            entries[pos] = moved
+            positions[id(moved[1])] = pos
+            pos = child
+        entries[pos] = entry
+        positions[id(entry[1])] = pos
+
+    def push(self, item):
+        if id(item) in self.positions:
+            raise ValueError(f"{item} is in the heap already")
+        self.entries.append((self.key(item), item))
+        self._sift_up(len(self.entries) - 1)
+
+    def peek(self):
+        "Returns the top item without removing it. Raises IndexError if empty"
+        return self.entries[0][1]
+
+    def pop(self):
+        "Removes and returns the top item. Raises IndexError if empty"
+        item = self.peek()
+        self.remove(item)
+        return item
+
+    def remove(self, item):
+        "Removes `item` from the heap. Raises ValueError if it's not there"
+        try:
+            pos = self.positions.pop(id(item))
+        except KeyError:
+            raise ValueError(f"{item} is not in the heap") from None
+
+        entries = self.entries
+        last = entries.pop()
+        if pos < len(entries):
+            # The last entry takes its place, and moves up or down from there
+            removed = entries[pos]
+            entries[pos] = last
+            if self.before(last[0], removed[0]):
+                self._sift_up(pos)
+            else:
+                self._sift_down(pos)
+
+    def clear(self):
+        self.entries = []
+        self.positions = {}
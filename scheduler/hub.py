@@ -0,0 +1,225 @@
+"""
+Relay between the workers of a multi-process bus (see `bus --workers`).
+
+Every worker is a Bus serving the same port (with SO_REUSEPORT, so that the
+kernel spreads the connections among them), and is linked to the hub over a
+unix socket. Through the hub, workers share what they need to know about the
+clients connected to the others:
+
+  - HELLO: a worker that just linked (and needs to know about the others).
+  - JOBS: job frames, to be broadcast to the schedulers of every worker.
+  - DISPATCH: job frames for a worker whose schedulers have credits.
+  - RETURN: the jobs of a DISPATCH that its target couldn't take (its
+    credits were gone by then, or the worker itself), back to the sender.
+  - CREDITS: how many credits the schedulers of a worker have, in total.
+  - CANCEL: cancellations, relayed to every worker.
+  - OWNERS / DISOWN: ids of the jobs submitted by producers that want their
+    events (and of those to forget about, once the producer is gone).
+  - EVENTS: job events for the worker of the producer that owns the jobs.
+
+Frames between the workers and the hub are a HEADER (the length of the
+payload, its kind, whether it's text, and the origin and target workers)
+followed by the payload. The hub doesn't look into the payloads: it sends
+every frame to its target, or to every other worker if it has none. It reads
+no more frames from a worker until the others have caught up with those it
+sent, so that a slow worker doesn't make the hub buffer without bounds.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+from enum import IntEnum
+
+# Payload length, kind, text (or binary) payload, origin and target workers
+HEADER = struct.Struct('!IBBHH')
+# Target of the frames for every worker but the origin
+EVERYONE = 0xFFFF
+
+class Kind(IntEnum):
+    HELLO = 0
+    JOBS = 1
+    DISPATCH = 2
+    CREDITS = 3
+    CANCEL = 4
+    OWNERS = 5
+    DISOWN = 6
+    EVENTS = 7
+    RETURN = 8
+
+def pack(kind, origin, payload, target=EVERYONE):
+    "Returns the frame for a payload (str or bytes)"
+    text = isinstance(payload, str)
+    if text:
+        payload = payload.encode()
+    return HEADER.pack(len(payload), kind, text, origin, target) + payload
+
+async def read_frame(reader):
+    """
+    Returns the next frame as (kind, origin, target, payload, raw frame), or
+    None once the other end is gone.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        length, kind, text, origin, target = HEADER.unpack(header)
+        payload = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    frame = header + payload
+    return Kind(kind), origin, target, payload.decode() if text else payload, frame
+
+class Hub:
+    """
+    Relays the frames of the bus workers connected to `path`.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Worker -> StreamWriter
+        self.workers = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handler, self.path)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def handler(self, reader, writer):
+        worker = None
+        try:
+            while (received := await read_frame(reader)) is not None:
+                kind, origin, target, payload, frame = received
+                if kind == Kind.HELLO:
+                    worker = origin
+                    self.workers[worker] = writer
+                    logging.info(f"Bus worker {worker} linked, {len(self.workers)} in total")
+                if target == EVERYONE:
+                    await self._forward([other_writer for other, other_writer in self.workers.items()
+                                         if other != origin], frame)
+                elif target in self.workers:
+                    await self._forward([self.workers[target]], frame)
+                elif kind == Kind.DISPATCH:
+                    # Gone: the jobs go back to the sender
+                    await self._forward([writer], pack(Kind.RETURN, target, payload, origin))
+        except Exception as exc:
+            logging.error(f"While relaying frames for bus worker {worker}", exc_info=exc)
+        finally:
+            if self.workers.get(worker) is writer:
+                del self.workers[worker]
+                # Its schedulers are gone with it
+                for other_writer in self.workers.values():
+                    other_writer.write(pack(Kind.CREDITS, worker, '0'))
+            writer.close()
+
+    @staticmethod
+    async def _forward(writers, frame):
+        "Sends a frame to some workers, waiting for the slow ones to catch up"
+        for writer in writers:
+            writer.write(frame)
+        for writer in writers:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                # Its worker is gone. Its handler will let the others know
+                ...
+
+class HubLink:
+    """
+    Links a Bus (as worker number `worker`) to the hub at `path`, relaying what
+    it sends to the other workers, and handing it what they send (see the
+    `remote_*` methods of Bus).
+    """
+    def __init__(self, path, worker, bus):
+        self.path = path
+        self.worker = worker
+        self.bus = bus
+        self.writer = None
+        self.reading = None
+        # Credits to advertise, once per iteration of the loop
+        self.credits = None
+
+    async def connect(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self._send(Kind.HELLO, b'')
+        self.bus.link = self
+        self.reading = asyncio.create_task(self._read(reader))
+
+    def close(self):
+        self.bus.link = None
+        if self.reading is not None:
+            self.reading.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def _send(self, kind, payload, target=EVERYONE):
+        self.writer.write(pack(kind, self.worker, payload, target))
+
+    def broadcast(self, frame):
+        self._send(Kind.JOBS, frame)
+
+    def dispatch(self, worker, frame):
+        self._send(Kind.DISPATCH, frame, worker)
+
+    def give_back(self, worker, frame):
+        self._send(Kind.RETURN, frame, worker)
+
+    def cancel(self, frame):
+        self._send(Kind.CANCEL, frame)
+
+    def own(self, job_ids):
+        self._send(Kind.OWNERS, json.dumps(job_ids))
+
+    def disown(self, job_ids):
+        self._send(Kind.DISOWN, json.dumps(job_ids))
+
+    def route_events(self, worker, events):
+        self._send(Kind.EVENTS, json.dumps(events), worker)
+
+    def advertise(self, credits):
+        "Lets the other workers know how many credits this one has"
+        if self.credits is None:
+            asyncio.get_running_loop().call_soon(self._advertise)
+        self.credits = credits
+
+    async def drain(self):
+        "Waits until the hub has caught up with what was sent to it"
+        if self.writer is not None:
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                # Reported by `_read`
+                ...
+
+    def _advertise(self):
+        if self.writer is not None and not self.writer.is_closing():
+            self._send(Kind.CREDITS, str(self.credits))
+        self.credits = None
+
+    async def _read(self, reader):
+        bus = self.bus
+        while (received := await read_frame(reader)) is not None:
+            kind, origin, _, payload, _ = received
+            try:
+                if kind == Kind.HELLO:
+                    bus.remote_linked(origin)
+                elif kind == Kind.JOBS:
+                    bus.remote_broadcast(payload)
+                elif kind == Kind.DISPATCH:
+                    bus.remote_dispatch(origin, payload)
+                elif kind == Kind.RETURN:
+                    bus.remote_returned(origin, payload)
+                elif kind == Kind.CREDITS:
+                    bus.remote_credits_changed(origin, int(payload))
+                elif kind == Kind.CANCEL:
+                    bus.cancel(json.loads(payload)['ids'], payload, forward=False)
+                elif kind == Kind.OWNERS:
+                    bus.remote_own(origin, json.loads(payload))
+                elif kind == Kind.DISOWN:
+                    bus.remote_disown(json.loads(payload))
+                elif kind == Kind.EVENTS:
+                    bus.route_events(json.loads(payload), forward=False)
+            except Exception as exc:
+                logging.error(f"While handling a {kind.name} frame from bus worker {origin}",
+                              exc_info=exc)
+        logging.error("Lost the link to the hub")
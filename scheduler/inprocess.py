@@ -0,0 +1,96 @@
+"""
+Tasks that run their job within the scheduler's own process, offering the
+same interface as ProcessTask: ThreadTask runs a callable on a thread pool,
+and CoroutineTask runs a coroutine on the event loop.
+
+They skip the cost of starting (or messaging) a process, which dominates
+for short or I/O-bound jobs, but they can't be suspended, and a thread
+can't be killed: terminating a ThreadTask frees its slot and marks the
+result, but the callable keeps running until it returns.
+"""
+
+import asyncio
+import logging
+
+from .process import BaseTask, CantStartError, NotRunningError, Result
+
+class InProcessTask(BaseTask):
+    """
+    Common code for ThreadTask and CoroutineTask. Subclasses implement
+    `_launch`, returning a future for the outcome of the job.
+    """
+    # There's no process to send SIGSTOP to
+    suspendable = False
+    pid = None
+
+    def __init__(self, target):
+        super().__init__()
+        self.target = target
+        self.future = None
+        self.notifying_task = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.target})"
+
+    async def wait(self):
+        "Will block until the job finishes (or is terminated)"
+        if self.future is None:
+            raise NotRunningError("Can't wait on a task that is not running")
+
+        await self.done.wait()
+
+    def start(self):
+        """
+        Launches the job.
+
+        Can only be invoked once. It will raise CantStartError otherwise.
+        """
+        if self.future is not None:
+            raise CantStartError("This task ran already")
+
+        loop = asyncio.get_running_loop()
+        self.started_at = loop.time()
+        self.future = self._launch(loop)
+        self.spawn_time = loop.time() - self.started_at
+        self.future.add_done_callback(self._finish)
+
+    def terminate(self, result=Result.TERMINATED):
+        """
+        Cancels the job. Sets the result to the specified value.
+        """
+        if self.future is not None and not self.future.done():
+            if self.result is None:
+                self.result = result
+            self.future.cancel()
+
+    def _finish(self, future):
+        self.exited_at = asyncio.get_running_loop().time()
+        if self.result is None:
+            if future.cancelled():
+                self.result = Result.TERMINATED
+            elif future.exception() is not None:
+                logging.warning(f"  - {self} raised {future.exception()!r}")
+                self.result = Result.ERROR
+            else:
+                self.result = Result.SUCCESS
+        self.notifying_task = asyncio.create_task(self._set_done())
+
+class ThreadTask(InProcessTask):
+    """
+    Runs `target` (a callable with no arguments) on `executor`, or on the
+    loop's default executor if None.
+    """
+    def __init__(self, target, executor=None):
+        super().__init__(target)
+        self.executor = executor
+
+    def _launch(self, loop):
+        return loop.run_in_executor(self.executor, self.target)
+
+class CoroutineTask(InProcessTask):
+    """
+    Runs the coroutine returned by `target` (a callable with no arguments,
+    like an async function) as an asyncio task.
+    """
+    def _launch(self, loop):
+        return loop.create_task(self.target(), name=f"Running {self.target}")
@@ -0,0 +1,270 @@
+"""
+A write-ahead journal of the tasks accepted by a SchedulerBin, so that the
+ones that were pending or running when the scheduler died can be scheduled
+again on restart.
+
+The journal is an append-only file of binary records: a header with the event,
+and the lengths of the job id and the payload, followed by the job id (UTF-8)
+and the payload itself (only for ACCEPTED records: whatever is needed to
+recreate the task).
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import mmap
+import os
+import struct
+import uuid
+
+from .scheduler_bin import TaskEvent
+
+# Event, job id length, payload length
+RECORD = struct.Struct('<BHI')
+
+# Seconds to wait for more records before writing and syncing them
+DEFAULT_COMMIT_INTERVAL = 0.01
+# The journal is compacted once it grows beyond this size (in bytes)...
+DEFAULT_COMPACT_SIZE = 16 * 1024 * 1024
+# ... and this many times the size of the records of the live jobs
+COMPACT_RATIO = 4
+
+class Journal:
+    """
+    Journals the events of the tasks of one or more SchedulerBins (add the
+    journal's `record` method as a listener to them).
+
+    Records are written in groups: they are buffered and, every `commit_interval`
+    seconds at most, written and synced to disk in one go, on a thread of the
+    journal (so that the loop doesn't wait for the disk). Tasks that were
+    accepted less than that before a crash may then be lost, in exchange of
+    doing a single fsync for any number of records in the interval.
+
+    The journal keeps track of the jobs that are still live (accepted and
+    not done, dropped or cancelled). When the file has grown large enough in
+    comparison with them, it is rewritten with just the live jobs. This keeps
+    the file, and the time to recover from it, bounded.
+
+    `encode` turns a TaskDescription into the bytes that will be given back
+    on recovery. Tasks without a `job_id` are given one as they are accepted.
+    """
+    def __init__(self, path, encode, commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 compact_size=DEFAULT_COMPACT_SIZE, loop=None):
+        self.path = path
+        self.encode = encode
+        self.commit_interval = commit_interval
+        self.compact_size = compact_size
+        self.loop = loop
+        # Job id -> (payload, started)
+        self.live = {}
+        self.live_size = 0
+        self.buffer = bytearray()
+        self.commit_handle = None
+        self.recovered = self._load()
+        self.file = open(path, 'ab')
+        # Bytes in the file, or on their way to it
+        self.size = self.file.tell()
+        # Writes, syncs and compactions run on this thread, one after the other,
+        # not to stall the loop. Only the buffering happens on the loop
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+        # Future of the group of records being written, if any
+        self.writing = None
+
+    def _load(self):
+        """
+        Replays the journal, leaving the live jobs in `self.live`. A torn
+        record at the end (from a crash in the middle of a write) is
+        discarded. Returns the recovered jobs.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return []
+        if size == 0:
+            return []
+
+        # Keep the offsets only, not to copy payloads that will be discarded later
+        live = {}
+        with open(self.path, 'rb') as log, mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # This loop may run millions of times: keep everything in locals
+            offset = 0
+            unpack, header = RECORD.unpack_from, RECORD.size
+            accepted, started = TaskEvent.ACCEPTED.value, TaskEvent.STARTED.value
+            end = size - header
+            while offset <= end:
+                event, id_length, length = unpack(data, offset)
+                start = offset + header + id_length
+                if start + length > size:
+                    break
+                job_id = data[start - id_length:start]
+                if event == accepted:
+                    live[job_id] = [start, length, False]
+                elif event == started:
+                    if job_id in live:
+                        live[job_id][2] = True
+                else:
+                    live.pop(job_id, None)
+                offset = start + length
+
+            self.live = {job_id.decode(): (data[start:start + length], was_started)
+                         for job_id, (start, length, was_started) in live.items()}
+
+        if offset < size:
+            logging.warning(f"Discarding {size - offset} bytes from the end of the journal")
+            os.truncate(self.path, offset)
+        self.live_size = sum(self._record_size(job_id, payload)
+                             for job_id, (payload, _) in self.live.items())
+        return [(job_id, payload, started) for job_id, (payload, started) in self.live.items()]
+
+    def recover(self):
+        """
+        Returns the jobs that were live when the journal was last closed (or
+        the scheduler died), in order of arrival, as tuples of (job id, payload,
+        started). The caller is expected to schedule them again, with their
+        original job id, so that they are not journaled twice, and to `discard`
+        the ones that can't be scheduled.
+        """
+        return self.recovered
+
+    def discard(self, job_id):
+        """
+        Ends a recovered job that couldn't be scheduled again (eg. no bin took
+        it), as DROPPED, so that it's not recovered on every restart.
+        """
+        if job_id in self.live:
+            self._end(TaskEvent.DROPPED, job_id)
+
+    @staticmethod
+    def _record_size(job_id, payload):
+        "The size of the records of a live job: ACCEPTED and STARTED"
+        return 2 * (RECORD.size + len(job_id.encode())) + len(payload)
+
+    def record(self, event, task):
+        "Listener for the SchedulerBin events"
+        if event == TaskEvent.ACCEPTED:
+            if task.job_id is None:
+                task.job_id = uuid.uuid4().hex
+            elif task.job_id in self.live:
+                # Recovered task, and already in the journal
+                return
+            payload = self.encode(task)
+            self.live[task.job_id] = (payload, False)
+            self.live_size += self._record_size(task.job_id, payload)
+            self._append(event, task.job_id, payload)
+        elif task.job_id not in self.live:
+            # We never journaled this one, e.g. it wasn't admitted
+            return
+        elif event == TaskEvent.STARTED:
+            payload, _ = self.live[task.job_id]
+            self.live[task.job_id] = (payload, True)
+            self._append(event, task.job_id)
+        elif event == TaskEvent.QUEUED:
+            # Nothing new: the job is live already
+            return
+        else:
+            self._end(event, task.job_id)
+
+    def _end(self, event, job_id):
+        "Records the final event of a live job. Only internal use"
+        payload, _ = self.live.pop(job_id)
+        self.live_size -= self._record_size(job_id, payload)
+        self._append(event, job_id)
+
+    def _append(self, event, job_id, payload=b''):
+        self.buffer += self._pack(event, job_id, payload)
+        if self.commit_handle is None:
+            loop = self.loop or asyncio.get_running_loop()
+            self.commit_handle = loop.call_later(self.commit_interval, self.commit)
+
+    @staticmethod
+    def _pack(event, job_id, payload=b''):
+        job_id = job_id.encode()
+        return RECORD.pack(event.value, len(job_id), len(payload)) + job_id + payload
+
+    def commit(self):
+        """
+        Hands the buffered records to the writer thread, to be written and
+        synced. Compacts the journal if needed. If the writer is still busy
+        with the previous group, they're committed as soon as it's done.
+        """
+        if self.commit_handle is not None:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        if self.writing is not None:
+            return
+
+        if self.size > self.compact_size and self.size > COMPACT_RATIO * self.live_size:
+            self._submit(self._compact, self._live_records())
+        elif self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            self.size += len(data)
+            self._submit(self._write, data)
+
+    def _submit(self, write, data):
+        loop = self.loop or asyncio.get_running_loop()
+        self.writing = self.writer.submit(write, data)
+        self.writing.add_done_callback(lambda future: loop.call_soon_threadsafe(self._written, future))
+
+    def _written(self, future):
+        self.writing = None
+        if (exc := future.exception()) is not None:
+            logging.error("While writing the journal", exc_info=exc)
+        if self.buffer:
+            self.commit()
+
+    def _live_records(self):
+        """
+        Returns the records of the live jobs, to rewrite the journal with. They
+        include those of the buffer, which is cleared.
+        """
+        logging.info(f"Compacting the journal: {len(self.live)} live jobs")
+        records = bytearray()
+        for job_id, (payload, started) in self.live.items():
+            records += self._pack(TaskEvent.ACCEPTED, job_id, payload)
+            if started:
+                records += self._pack(TaskEvent.STARTED, job_id)
+        self.buffer.clear()
+        self.size = len(records)
+        return records
+
+    def _write(self, data):
+        "Only internal use, on the writer thread"
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _compact(self, records):
+        "Rewrites the journal with `records`. Only internal use, on the writer thread"
+        new_path = self.path + '.new'
+        with open(new_path, 'wb') as new:
+            new.write(records)
+            new.flush()
+            os.fsync(new.fileno())
+        self.file.close()
+        os.replace(new_path, self.path)
+        # Make the rename itself durable
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.file = open(self.path, 'ab')
+
+    async def close(self):
+        """
+        Commits any pending records, waits for them to be synced (on a thread,
+        not to block the loop), and closes the journal
+        """
+        if self.commit_handle is not None:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        if self.buffer:
+            self.writer.submit(self._write, bytes(self.buffer))
+            self.buffer.clear()
+        await asyncio.to_thread(self._shutdown)
+
+    def _shutdown(self):
+        "Only internal use, on a thread of its own"
+        self.writer.shutdown(wait=True)
+        self.file.close()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+"""
+Open-loop load generator and end-to-end benchmark for the bus and the
+schedulers.
+
+Jobs are submitted over many producer connections at once, at the times set
+by an arrival process (Poisson, bursts, or replayed from a trace) and
+regardless of how fast they are handled (ie. open loop: a slow system builds
+up a backlog, instead of slowing the load down). Every job is tagged with an
+id and the time it was due to arrive, and the events that the schedulers
+report for it (see the `job_events` frames in the `wire` module) give the
+end-to-end latency, from its arrival until it is accepted and started. The
+latencies are measured from the arrival, not from when the job was actually
+sent: if the senders fall behind, the delay counts too (instead of being left
+out, ie. coordinated omission). The lag of the senders is reported apart.
+
+Unless told otherwise, a local bus (in dispatch mode) and a number of
+`test_scheduler`s are started for the benchmark, and stopped at the end.
+With `--sweep`, the rate is doubled on every run for as long as the system
+keeps up with it, to find the maximum sustainable throughput.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import shlex
+import signal
+import sys
+import time
+from collections import Counter
+from itertools import count
+from random import Random
+
+import websockets
+
+from . import bus
+from .simulation import trace_jobs
+from .wire import FINAL_EVENTS
+
+URL = 'ws://localhost:8101'
+DEFAULT_RATE = 100
+DEFAULT_DURATION = 10
+DEFAULT_CONNECTIONS = 8
+DEFAULT_RUNTIME = 0.01
+DEFAULT_BURST = 50
+DEFAULT_SCHEDULERS = 1
+DEFAULT_SCHEDULER_ARGS = '--backend coroutine -s 1000 -t 60'
+# Seconds to wait for the events of the jobs sent at the end of a run
+DEFAULT_DRAIN = 5
+# A run is sustained if at least this fraction of the jobs started...
+SUSTAINED_RATIO = 0.95
+# ... and the 99th percentile of the start latency is below this (seconds)
+DEFAULT_MAX_LATENCY = 1.0
+
+def poisson_arrivals(rate, runtime, rnd):
+    "Jobs arriving as a Poisson process with the specified rate (jobs/s)"
+    arrival = 0.0
+    while True:
+        arrival += rnd.expovariate(rate)
+        yield arrival, rnd.randint(0, 10), runtime
+
+def bursty_arrivals(rate, runtime, rnd, burst):
+    """
+    Jobs arriving in bursts of `burst` at once, the bursts arriving as a
+    Poisson process. The average rate is still `rate` jobs/s
+    """
+    arrival = 0.0
+    while True:
+        arrival += rnd.expovariate(rate / burst)
+        for _ in range(burst):
+            yield arrival, rnd.randint(0, 10), runtime
+
+def percentiles(values, quantiles=(0.5, 0.9, 0.99)):
+    "Returns the requested quantiles of `values`, and their maximum. NaN if empty"
+    if not values:
+        return [float('nan')] * (len(quantiles) + 1)
+    values = sorted(values)
+    return [values[int(q * (len(values) - 1))] for q in quantiles] + [values[-1]]
+
+class Tracker:
+    """
+    Keeps the time every job was due to arrive at, and collects the latencies
+    of their events as they come back.
+    """
+    def __init__(self):
+        self.due_at = {}
+        self.accepted = []
+        self.started = []
+        self.outcomes = Counter()
+        self.done = 0
+        self.all_done = asyncio.Event()
+        self.expected = None
+
+    def sent(self, job_id, due_at):
+        self.due_at[job_id] = due_at
+
+    def handle(self, message):
+        msg = json.loads(message)
+        if msg.get('cmd') != 'job_events':
+            return
+        for job_id, event, when in msg['events']:
+            due_at = self.due_at.get(job_id)
+            if due_at is None:
+                continue
+            if event == 'accepted':
+                self.accepted.append(when - due_at)
+            elif event == 'started':
+                self.started.append(when - due_at)
+            elif event in FINAL_EVENTS:
+                self.outcomes[event] += 1
+                self.done += 1
+        if self.expected is not None and self.done >= self.expected:
+            self.all_done.set()
+
+    async def listen(self, websocket):
+        try:
+            async for message in websocket:
+                self.handle(message)
+        except websockets.ConnectionClosed:
+            ...
+
+    async def drain(self, timeout):
+        "Waits for all the jobs sent to be done, for `timeout` seconds at most"
+        self.expected = len(self.due_at)
+        if self.done < self.expected:
+            try:
+                await asyncio.wait_for(self.all_done.wait(), timeout)
+            except asyncio.TimeoutError:
+                ...
+
+async def run_load(args, jobs, label):
+    """
+    Submits the `jobs` (arrival, priority, runtime) for `args.duration`
+    seconds. Returns a dictionary with the results.
+    """
+    tracker = Tracker()
+    connections = []
+    for _ in range(args.connections):
+        websocket = await websockets.connect(URL, max_size=None)
+        await websocket.send(bus.create_message('register', type='producer', events=True))
+        connections.append(websocket)
+    listeners = [asyncio.create_task(tracker.listen(websocket)) for websocket in connections]
+
+    loop = asyncio.get_running_loop()
+    # How late every job was sent
+    lags = []
+    # Shared by the senders, which take the next job due as they're free
+    jobs = iter(jobs)
+    sequence = count()
+
+    async def sender(websocket):
+        "Sends jobs through `websocket` until the run is over. Returns how many"
+        sent = 0
+        for arrival, priority, runtime in jobs:
+            if arrival > args.duration:
+                break
+            delay = start + arrival - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lags.append(max(loop.time() - start - arrival, 0))
+            job_id = f'{label}-{next(sequence)}'
+            # The events come with the (wall clock) time of the schedulers
+            tracker.sent(job_id, wall_start + arrival)
+            payload = {'priority': priority, 'runtime': runtime, 'id': job_id}
+            await websocket.send(bus.create_message('job_request', payload=payload))
+            sent += 1
+        return sent
+
+    start, wall_start = loop.time(), time.time()
+    # One sender per connection, so that the rate is not bound by the round
+    # trips of a single one
+    sent = sum(await asyncio.gather(*(sender(websocket) for websocket in connections)))
+    elapsed = loop.time() - start
+
+    await tracker.drain(args.drain)
+    for websocket in connections:
+        await websocket.close()
+    await asyncio.gather(*listeners)
+
+    return {
+        'sent': sent,
+        'send_rate': sent / elapsed,
+        'start_rate': len(tracker.started) / elapsed,
+        'started': len(tracker.started),
+        'lag': percentiles(lags),
+        'accepted': percentiles(tracker.accepted),
+        'start': percentiles(tracker.started),
+        'outcomes': tracker.outcomes,
+    }
+
+def report(rate, results):
+    "Prints a row with the results of a run. `rate` is None for traces"
+    accepted, start = results['accepted'], results['start']
+    rate = f"{rate:>9,.0f}" if rate is not None else f"{'trace':>9}"
+    print(f"{rate} {results['send_rate']:>9,.0f} {results['start_rate']:>9,.0f} "
+          f"{accepted[0] * 1000:>8.1f} {accepted[2] * 1000:>8.1f} "
+          f"{start[0] * 1000:>8.1f} {start[1] * 1000:>8.1f} {start[2] * 1000:>8.1f} {start[3] * 1000:>8.1f} "
+          f"{results['lag'][2] * 1000:>8.1f} {results['lag'][3] * 1000:>8.1f}  {dict(results['outcomes'])}")
+
+def sustained(results, max_latency):
+    return (results['sent'] > 0 and results['started'] >= SUSTAINED_RATIO * results['sent']
+            and results['start'][2] <= max_latency)
+
+def make_jobs(args, rate, rnd):
+    if args.trace:
+        return trace_jobs(args.trace)
+    elif args.arrivals == 'bursty':
+        return bursty_arrivals(rate, args.runtime, rnd, args.burst)
+    return poisson_arrivals(rate, args.runtime, rnd)
+
+async def start_system(args):
+    "Starts the bus and the schedulers. Returns their processes"
+    quiet = dict(stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    bus_args = ['-w', str(args.bus_workers)] + ([] if args.broadcast else ['--dispatch'])
+    processes = [await asyncio.create_subprocess_exec(sys.executable, '-m', 'scheduler.bus', *bus_args,
+                                                      **quiet)]
+    # Wait for the bus to be up
+    for _ in range(50):
+        try:
+            async with websockets.connect(URL):
+                break
+        except OSError:
+            await asyncio.sleep(0.1)
+    for _ in range(args.schedulers):
+        processes.append(await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'scheduler.test_scheduler', '--quiet',
+            *shlex.split(args.scheduler_args), **quiet))
+    # Let them register with the bus
+    await asyncio.sleep(1.5)
+    return processes
+
+async def stop_system(processes):
+    for process in reversed(processes):
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), 5)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+async def main(args):
+    processes = await start_system(args) if args.schedulers else []
+    rnd = Random(args.seed)
+    try:
+        print(f"{'rate':>9} {'sent/s':>9} {'started/s':>9} "
+              f"{'acc p50':>8} {'acc p99':>8} {'st p50':>8} {'st p90':>8} {'st p99':>8} {'st max':>8} "
+              f"{'lag p99':>8} {'lag max':>8}  (latencies in ms)")
+        rate, best, run = args.rate, None, 0
+        while True:
+            results = await run_load(args, make_jobs(args, rate, rnd), f'r{run}-{rnd.getrandbits(32):x}')
+            report(rate if not args.trace else None, results)
+            if not args.sweep:
+                break
+            if not sustained(results, args.max_latency):
+                break
+            best = results['start_rate']
+            rate *= 2
+            run += 1
+        if args.sweep:
+            if best is None:
+                print(f"Not even {args.rate:,.0f} jobs/s were sustained")
+            else:
+                print(f"Max sustained throughput: {best:,.0f} jobs/s")
+    finally:
+        await stop_system(processes)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', dest='rate', type=float, default=DEFAULT_RATE,
+            help=f"average arrival rate, in jobs/s (the starting one, with --sweep). Default: {DEFAULT_RATE}")
+    parser.add_argument('-d', dest='duration', type=float, default=DEFAULT_DURATION,
+            help=f"seconds to send jobs for, on every run. Default: {DEFAULT_DURATION}")
+    parser.add_argument('-c', dest='connections', type=int, default=DEFAULT_CONNECTIONS,
+            help=f"number of producer connections. Default: {DEFAULT_CONNECTIONS}")
+    parser.add_argument('-a', dest='arrivals', choices=('poisson', 'bursty'), default='poisson',
+            help="arrival process: Poisson, or Poisson bursts of -b jobs. Default: poisson")
+    parser.add_argument('-b', dest='burst', type=int, default=DEFAULT_BURST,
+            help=f"jobs per burst, with -a bursty. Default: {DEFAULT_BURST}")
+    parser.add_argument('--trace', dest='trace',
+            help="replay the jobs from a CSV file (arrival, priority, runtime), instead of generating them")
+    parser.add_argument('--runtime', dest='runtime', type=float, default=DEFAULT_RUNTIME,
+            help=f"runtime of the generated jobs (seconds). Default: {DEFAULT_RUNTIME}")
+    parser.add_argument('--sweep', dest='sweep', action='store_true',
+            help="double the rate on every run, until the system doesn't keep up")
+    parser.add_argument('--max-latency', dest='max_latency', type=float, default=DEFAULT_MAX_LATENCY,
+            help=f"highest 99th percentile of the start latency that is sustainable (seconds). "
+                 f"Default: {DEFAULT_MAX_LATENCY}")
+    parser.add_argument('--drain', dest='drain', type=float, default=DEFAULT_DRAIN,
+            help=f"seconds to wait for the last jobs to be done, after every run. Default: {DEFAULT_DRAIN}")
+    parser.add_argument('-s', dest='schedulers', type=int, default=DEFAULT_SCHEDULERS,
+            help=f"number of schedulers to start, along with a bus. With 0, use the ones already "
+                 f"running. Default: {DEFAULT_SCHEDULERS}")
+    parser.add_argument('--scheduler-args', dest='scheduler_args', default=DEFAULT_SCHEDULER_ARGS,
+            help=f"arguments for the schedulers. Default: '{DEFAULT_SCHEDULER_ARGS}'")
+    parser.add_argument('--broadcast', dest='broadcast', action='store_true',
+            help="start the bus in broadcast mode, instead of dispatch mode")
+    parser.add_argument('--bus-workers', dest='bus_workers', type=int, default=1,
+            help="number of worker processes of the bus to start. Default: 1")
+    parser.add_argument('--seed', dest='seed', type=int,
+            help="seed for the random job generator")
+
+    args = parser.parse_args()
+    if args.sweep and args.trace:
+        parser.error("--sweep can't change the rate of a --trace")
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(args))
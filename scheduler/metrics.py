@@ -0,0 +1,145 @@
+"""
+Counters and histograms on the scheduler's latencies and events, broken down
+by priority.
+
+Instrumentation is opt-in: the scheduling classes take an optional Metrics
+instance, and skip any measurement if they don't have one.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+# Upper bounds (in bytes) of the histogram buckets for memory: 1MiB to 16GiB
+MEMORY_BUCKETS = tuple(2 ** bits for bits in range(20, 35, 2))
+
+class Counter:
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.values = defaultdict(int)
+
+    def inc(self, priority, amount=1):
+        self.values[priority] += amount
+
+    def add(self, other):
+        "Adds the values of another counter of the same metric"
+        for priority, value in dict(other.values).items():
+            self.values[priority] += value
+
+    def snapshot(self):
+        return dict(self.values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for priority, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{priority="{priority}"}} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, doc, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        # Per priority: a count per bucket (plus one for +Inf), the sum, and the count
+        self.values = {}
+
+    def observe(self, priority, value):
+        try:
+            counts, total = self.values[priority]
+        except KeyError:
+            counts, total = [0] * (len(self.buckets) + 1), [0.0, 0]
+            self.values[priority] = counts, total
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+        total[1] += 1
+
+    def add(self, other):
+        "Adds the observations of another histogram of the same metric"
+        for priority, (counts, total) in dict(other.values).items():
+            try:
+                mine, my_total = self.values[priority]
+            except KeyError:
+                mine, my_total = [0] * (len(self.buckets) + 1), [0.0, 0]
+                self.values[priority] = mine, my_total
+            for k, count in enumerate(list(counts)):
+                mine[k] += count
+            my_total[0] += total[0]
+            my_total[1] += total[1]
+
+    def snapshot(self):
+        return {priority: {'buckets': dict(zip((*self.buckets, float('inf')), counts)),
+                           'sum': total[0], 'count': total[1]}
+                for priority, (counts, total) in self.values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for priority, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{priority="{priority}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{priority="{priority}"}} {total[0]}')
+            lines.append(f'{self.name}_count{{priority="{priority}"}} {total[1]}')
+        return lines
+
+class Metrics:
+    """
+    The set of metrics collected by the scheduler. They can be pulled as a
+    dictionary with `snapshot`, or in Prometheus' text exposition format
+    with `render`.
+
+    Each thread updates a Metrics of its own: those of other threads are
+    added to what this one reports with `include`.
+    """
+    def __init__(self):
+        self.queue_wait = Histogram('scheduler_queue_wait_seconds',
+                                    'Time spent by tasks in the pending queue')
+        self.spawn_latency = Histogram('scheduler_spawn_latency_seconds',
+                                       'Time taken to start the process for a job')
+        self.run_time = Histogram('scheduler_run_time_seconds',
+                                  'Time from the start of a job until it is done')
+        self.exit_lag = Histogram('scheduler_exit_lag_seconds',
+                                  'Time from detecting that a process exited until the runner is notified')
+        self.cpu_time = Histogram('scheduler_job_cpu_seconds',
+                                  'CPU time (user + system) used by the process of a job')
+        self.max_rss = Histogram('scheduler_job_max_rss_bytes',
+                                 'Peak resident memory of the process of a job', MEMORY_BUCKETS)
+        self.missing_usage = Counter('scheduler_job_missing_usage_total',
+                                     'Processes of jobs whose resource usage could not be collected')
+        self.evictions = Counter('scheduler_evictions_total',
+                                 'Jobs evicted by a higher priority one')
+        self.timeouts = Counter('scheduler_timeouts_total',
+                                'Jobs terminated because they timed out')
+        self.rejections = Counter('scheduler_rejections_total',
+                                  'Scheduling attempts rejected by the runner, for lack of slots')
+        self.dropped_tasks = Counter('scheduler_dropped_tasks_total',
+                                     'Tasks dropped from (or not admitted to) a full pending queue')
+        self.rejected_tasks = Counter('scheduler_rejected_tasks_total',
+                                      'Tasks not accepted by any bin')
+        # Metrics collected on other threads
+        self.parts = []
+
+    def include(self, part):
+        "Adds a Metrics collected on another thread to what this one reports"
+        self.parts.append(part)
+
+    def all(self):
+        return [metric for metric in vars(self).values() if isinstance(metric, (Counter, Histogram))]
+
+    def merged(self):
+        "Returns the metrics of this one and its parts, added up"
+        if not self.parts:
+            return self.all()
+        merged = Metrics()
+        for source in (self, *self.parts):
+            for metric, other in zip(merged.all(), source.all()):
+                metric.add(other)
+        return merged.all()
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.merged()}
+
+    def render(self):
+        return '\n'.join(line for metric in self.merged() for line in metric.render()) + '\n'
@@ -0,0 +1,280 @@
+import dataclasses
+import heapq
+import math
+from array import array
+from itertools import count
+from operator import attrgetter
+
+# How CompactPendingQueue packs its heap entries: the key, the order of arrival,
+# and the slot of the task, from the most to the least significant bits
+SEQUENCE_BITS = 40
+SLOT_BITS = 32
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+class PendingQueue:
+    """
+    The queue of tasks waiting for a slot, highest priority first.
+
+    Tasks are ordered by `key(task)` (by default, the tasks themselves), and
+    in order of arrival among tasks with the same key.
+
+    Removing a task other than the first one (see `remove`) just leaves a
+    tombstone in its place, that is skipped later. The heap is rebuilt
+    without them once they are more than the live tasks.
+
+    `push` returns a handle for the task, to `remove` it later: the task itself
+    (see CompactPendingQueue, for which it isn't).
+    """
+    def __init__(self, key=None):
+        self.key = key
+        self.heap = []
+        self.sequence = count()
+        # id(task) -> heap entry, to find them for removal
+        self.entries = {}
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.heap) - self.removed
+
+    def __iter__(self):
+        "Iterates over the tasks, in no particular order"
+        return (entry[2] for entry in self.heap if entry[2] is not None)
+
+    def __contains__(self, task):
+        return id(task) in self.entries
+
+    def __repr__(self):
+        return f"PendingQueue({list(self)})"
+
+    def push(self, task):
+        entry = [task if self.key is None else self.key(task), next(self.sequence), task]
+        self.entries[id(task)] = entry
+        heapq.heappush(self.heap, entry)
+        return task
+
+    def _discard_removed(self):
+        heap = self.heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self.removed -= 1
+
+    def peek(self):
+        "Returns the highest priority task. Raises IndexError if empty"
+        self._discard_removed()
+        return self.heap[0][2]
+
+    def pop(self):
+        "Removes and returns the highest priority task. Raises IndexError if empty"
+        self._discard_removed()
+        task = heapq.heappop(self.heap)[2]
+        del self.entries[id(task)]
+        return task
+
+    def remove(self, task):
+        "Removes `task` from the queue, and returns it. Raises ValueError if it's not there"
+        try:
+            entry = self.entries.pop(id(task))
+        except KeyError:
+            raise ValueError(f"{task} is not in the queue") from None
+        entry[2] = None
+        self.removed += 1
+        if self.removed > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if entry[2] is not None]
+            heapq.heapify(self.heap)
+            self.removed = 0
+        return task
+
+    def worst(self):
+        "Returns the lowest priority task. Raises ValueError if empty"
+        heap = self.heap
+        if self.removed:
+            # A tombstone could hide the worst task under it
+            return max((entry for entry in heap if entry[2] is not None))[2]
+        # Otherwise, the worst entry of a heap must be a leaf, and the leaves
+        # are in the second half of the list
+        return max(heap[len(heap) // 2:])[2]
+
+    def pop_worst(self):
+        "Removes and returns the lowest priority task. Raises ValueError if empty"
+        return self.remove(self.worst())
+
+    def expire(self, before):
+        """
+        Removes the tasks queued before the specified time (according to their
+        `queued_at`). Returns the list of removed tasks.
+        """
+        expired = [task for task in self if task.queued_at < before]
+        if expired:
+            for task in expired:
+                del self.entries[id(task)]
+            self.heap = [entry for entry in self.heap
+                         if entry[2] is not None and entry[2].queued_at >= before]
+            heapq.heapify(self.heap)
+            self.removed = 0
+        return expired
+
+    def oldest(self):
+        "Returns the task that has been queued for longer. Raises ValueError if empty"
+        return min((entry for entry in self.heap if entry[2] is not None), key=lambda entry: entry[1])[2]
+
+class CompactPendingQueue:
+    """
+    A PendingQueue for huge backlogs, that keeps the tasks as columns instead
+    of as objects. Numeric fields go to arrays, and the rest to lists of
+    references, which cost nothing more when they are shared (eg. None, or the
+    same target for many tasks). Tasks are rebuilt as they leave the queue (or
+    are looked at), so they are equal to the ones pushed, but not the same
+    objects.
+
+    `record` is the dataclass of the tasks. Its `int` fields can't be None, and
+    its `float` fields are kept as floats (None as NaN).
+
+    Keys (`key(task)`) must be integers. Every heap entry is a single integer
+    that packs the key, the order of arrival and the slot of the task in the
+    columns, so that the heap compares nothing but ints.
+
+    `push` returns a handle for the task, that `remove` and `in` take instead
+    of the task itself.
+    """
+    def __init__(self, record, key):
+        self.record = record
+        self.key = key
+        fields = dataclasses.fields(record)
+        self.fields = [field.name for field in fields]
+        self.values_of = attrgetter(*self.fields)
+        self.floats = [index for index, field in enumerate(fields) if field.type is float]
+        self.columns = [array('q') if field.type is int else
+                        array('d') if field.type is float else []
+                        for field in fields]
+        self.lists = [column for column in self.columns if isinstance(column, list)]
+        # Order of arrival of the task in every slot, or -1 if it's free
+        self.sequences = array('q')
+        self.free = []
+        self.heap = []
+        self.sequence = count()
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.heap) - self.removed
+
+    def __iter__(self):
+        "Iterates over (copies of) the tasks, in no particular order"
+        return (self._get(handle & SLOT_MASK) for handle in self.heap if self._live(handle))
+
+    def __contains__(self, handle):
+        return self._live(handle)
+
+    def __repr__(self):
+        return f"CompactPendingQueue({list(self)})"
+
+    def _live(self, handle):
+        "True if the task for `handle` is still queued. Only internal use."
+        return self.sequences[handle & SLOT_MASK] == (handle >> SLOT_BITS) & SEQUENCE_MASK
+
+    def _get(self, slot):
+        "Rebuilds the task in `slot`. Only internal use."
+        values = [column[slot] for column in self.columns]
+        for index in self.floats:
+            if values[index] != values[index]:
+                # NaN
+                values[index] = None
+        return self.record(*values)
+
+    def _take(self, slot):
+        "Rebuilds the task in `slot`, and frees the slot. Only internal use."
+        task = self._get(slot)
+        for column in self.lists:
+            column[slot] = None
+        self.sequences[slot] = -1
+        self.free.append(slot)
+        return task
+
+    def push(self, task):
+        key = self.key(task)
+        if not isinstance(key, int):
+            raise TypeError(f"CompactPendingQueue needs integer keys, not {key!r}")
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.sequences)
+            self.sequences.append(-1)
+            for column in self.columns:
+                column.append(None if isinstance(column, list) else 0)
+        values = list(self.values_of(task))
+        for index in self.floats:
+            if values[index] is None:
+                values[index] = math.nan
+        for column, value in zip(self.columns, values):
+            column[slot] = value
+        sequence = next(self.sequence)
+        self.sequences[slot] = sequence
+        handle = (((key << SEQUENCE_BITS) | sequence) << SLOT_BITS) | slot
+        heapq.heappush(self.heap, handle)
+        return handle
+
+    def _discard_removed(self):
+        heap = self.heap
+        while heap and not self._live(heap[0]):
+            heapq.heappop(heap)
+            self.removed -= 1
+
+    def peek(self):
+        "Returns (a copy of) the highest priority task. Raises IndexError if empty"
+        self._discard_removed()
+        return self._get(self.heap[0] & SLOT_MASK)
+
+    def pop(self):
+        "Removes and returns the highest priority task. Raises IndexError if empty"
+        self._discard_removed()
+        return self._take(heapq.heappop(self.heap) & SLOT_MASK)
+
+    def remove(self, handle):
+        """
+        Removes the task for `handle` from the queue, and returns it. Raises
+        ValueError if it's not there
+        """
+        if not self._live(handle):
+            raise ValueError(f"{handle} is not in the queue")
+        task = self._take(handle & SLOT_MASK)
+        self.removed += 1
+        if self.removed > len(self.heap) // 2:
+            self.heap = [handle for handle in self.heap if self._live(handle)]
+            heapq.heapify(self.heap)
+            self.removed = 0
+        return task
+
+    def _worst(self):
+        "Returns the handle of the lowest priority task. Only internal use."
+        heap = self.heap
+        if self.removed:
+            return max(handle for handle in heap if self._live(handle))
+        return max(heap[len(heap) // 2:])
+
+    def worst(self):
+        "Returns (a copy of) the lowest priority task. Raises ValueError if empty"
+        return self._get(self._worst() & SLOT_MASK)
+
+    def pop_worst(self):
+        "Removes and returns the lowest priority task. Raises ValueError if empty"
+        return self.remove(self._worst())
+
+    def expire(self, before):
+        """
+        Removes the tasks queued before the specified time (according to their
+        `queued_at`). Returns the list of removed tasks.
+        """
+        queued_at = self.columns[self.fields.index('queued_at')]
+        expired = [self._take(handle & SLOT_MASK) for handle in self.heap
+                   if self._live(handle) and queued_at[handle & SLOT_MASK] < before]
+        if expired:
+            self.heap = [handle for handle in self.heap if self._live(handle)]
+            heapq.heapify(self.heap)
+            self.removed = 0
+        return expired
+
+    def oldest(self):
+        "Returns (a copy of) the task that has been queued for longer. Raises ValueError if empty"
+        handle = min((handle for handle in self.heap if self._live(handle)),
+                     key=lambda handle: (handle >> SLOT_BITS) & SEQUENCE_MASK)
+        return self._get(handle & SLOT_MASK)
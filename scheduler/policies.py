@@ -0,0 +1,56 @@
+"""
+Scheduling policies. A policy gives every task a rank when it arrives, and
+the tasks with a lower rank go first: SchedulerBin runs the pending tasks in
+order of rank, and PriorityRunner evicts the running job with the highest rank
+when one with a lower rank arrives (ties go to the running job).
+
+Ranks are fixed when the task arrives, so that the queues don't need to be
+reordered as time passes. They only need to be comparable among the tasks
+ranked by the same policy.
+"""
+
+import math
+
+class PriorityPolicy:
+    "The lowest priority number goes first. The default"
+    def rank(self, task, now):
+        return task.priority
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+class EarliestDeadlineFirst(PriorityPolicy):
+    """
+    The task with the earliest `deadline` goes first. Tasks without a deadline
+    go after all the ones that have one. Ties are broken by priority.
+    """
+    def rank(self, task, now):
+        deadline = task.deadline if task.deadline is not None else math.inf
+        return (deadline, task.priority)
+
+class ShortestRuntimeFirst(PriorityPolicy):
+    """
+    The task with the shortest expected `runtime` goes first. Tasks without
+    a runtime hint go after all the ones that have one. Ties are broken by
+    priority.
+    """
+    def rank(self, task, now):
+        runtime = task.runtime if task.runtime is not None else math.inf
+        return (runtime, task.priority)
+
+class AgingPolicy(PriorityPolicy):
+    """
+    Priority, but tasks gain `rate` priority levels per second since their
+    arrival, so that low priority tasks are not starved forever.
+
+    Aging the waiting tasks is the same as making the new ones `rate` levels
+    worse for every second that passes, which keeps the ranks fixed.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+
+    def __repr__(self):
+        return f"AgingPolicy({self.rate})"
+
+    def rank(self, task, now):
+        return task.priority + self.rate * now
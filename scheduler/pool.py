@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from multiprocessing import resource_tracker
+
+from .channel import detach_all
+from .process import BaseTask, CantStartError, NotRunningError, Result, get_watcher, spawning
+
+# Seconds that a terminated worker has to exit, before being killed
+KILL_AFTER = 5
+
+def run_target(target):
+    """
+    Runs `target` on a process that outlives it. Returns the exit status the
+    process would have had, if it ran the target on its own.
+    """
+    try:
+        target()
+        return 0
+    except SystemExit as exc:
+        return exc.code if isinstance(exc.code, int) else int(exc.code is not None)
+    except Exception as exc:
+        logging.error(f"While running {target}", exc_info=exc)
+        return 1
+
+def worker_main(conn):
+    """
+    Main loop for the worker processes. Receives targets through `conn`, runs
+    them, and sends back the exit status, until the parent closes the pipe.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            target = conn.recv()
+        except EOFError:
+            break
+
+        status = run_target(target)
+        detach_all()
+        conn.send(status)
+
+class Worker:
+    """
+    A long-lived process, waiting for targets to run.
+    """
+    def __init__(self, context):
+        # Daemonic, so that they don't keep the parent alive. As a consequence,
+        # the jobs can't start processes of their own.
+        with spawning():
+            self.conn, child_conn = context.Pipe()
+            self.process = context.Process(target=worker_main, args=(child_conn,), daemon=True)
+            self.process.start()
+            child_conn.close()
+
+    def __repr__(self):
+        return f"Worker({self.process.pid})"
+
+    def kill(self):
+        """
+        Terminates the worker process. It will be reaped asynchronously, and
+        killed with SIGKILL if it's still there after KILL_AFTER seconds.
+        """
+        self.conn.close()
+        self.process.terminate()
+        # In case it was suspended. Otherwise, it won't get the SIGTERM
+        try:
+            os.kill(self.process.pid, signal.SIGCONT)
+        except ProcessLookupError:
+            # Already gone
+            ...
+        try:
+            get_watcher().watch(self.process)
+        except (RuntimeError, NotImplementedError):
+            # No running loop to do it for us
+            self.process.join(KILL_AFTER)
+            self._force_kill()
+            self.process.join()
+        else:
+            asyncio.get_running_loop().call_later(KILL_AFTER, self._force_kill)
+
+    def _force_kill(self):
+        if self.process.exitcode is None:
+            logging.warning(f"  - {self} didn't exit after {KILL_AFTER}s. Killing it")
+            self.process.kill()
+
+class WorkerPool:
+    """
+    A pool of pre-forked worker processes that receive pickled targets over
+    a pipe, avoiding the cost of starting a process for each job.
+
+    `size` workers are started in advance. If more are needed at some point
+    (there should be no need if the pool is as big as the runner using it),
+    they'll be started on demand.
+
+    `context` is an optional multiprocessing start method ("fork", "spawn",
+    "forkserver").
+    """
+    def __init__(self, size, context=None):
+        self.context = multiprocessing.get_context(context)
+        self.size = size
+        # Shared with the workers from the start, so that the buffers of the
+        # channels that they get are tracked (and unlinked) by their creator
+        # only, not by a tracker of each worker
+        resource_tracker.ensure_running()
+        self.idle = [Worker(self.context) for _ in range(size)]
+
+    def task(self, target):
+        "Returns a new PooledTask that will run `target` on this pool"
+        return PooledTask(self, target)
+
+    def acquire(self):
+        try:
+            return self.idle.pop()
+        except IndexError:
+            return Worker(self.context)
+
+    def release(self, worker):
+        if len(self.idle) < self.size:
+            self.idle.append(worker)
+        else:
+            worker.kill()
+
+    def discard(self, worker):
+        """
+        Kills a worker that can't be reused (eg. because its job has been
+        terminated), replacing it with a fresh one.
+        """
+        worker.kill()
+        if len(self.idle) < self.size:
+            self.idle.append(Worker(self.context))
+
+    def close(self):
+        """
+        Terminates the idle workers. Running tasks should be terminated first.
+        """
+        for worker in self.idle:
+            worker.kill()
+        self.idle = []
+
+class PooledTask(BaseTask):
+    """
+    Runs a target on a WorkerPool, offering the same interface as ProcessTask.
+
+    The exit status of the worker is replaced by that of the target: SUCCESS if
+    it returned normally, and ERROR if it raised an exception (or the worker
+    died, or the target couldn't be sent to it). Terminating the task kills the
+    worker, which is then replaced.
+    """
+    def __init__(self, pool, target):
+        super().__init__()
+        self.pool = pool
+        self.target = target
+        self.worker = None
+        self.notifying_task = None
+
+    def __repr__(self):
+        return f"PooledTask({self.target})"
+
+    @property
+    def pid(self):
+        return self.worker.process.pid if self.worker is not None else None
+
+    async def wait(self):
+        "Will block until the target finishes (or is terminated)"
+        if self.worker is None and not self.done.is_set():
+            raise NotRunningError("Can't wait on a task that is not running")
+
+        await self.done.wait()
+
+    def start(self):
+        """
+        Sends the target to an idle worker.
+
+        Can only be invoked once. It will raise CantStartError if the task was already
+        running, or if it has finished.
+        """
+        if self.worker is not None:
+            raise CantStartError("The task is running already")
+        elif self.done.is_set():
+            raise CantStartError("This task ran already")
+
+        loop = asyncio.get_running_loop()
+        self.started_at = loop.time()
+        self.worker = self.pool.acquire()
+        try:
+            self.worker.conn.send(self.target)
+        except Exception as exc:
+            # Eg. a target that can't be pickled, or a worker that died while idle.
+            # The task fails, as it would if the target raised
+            logging.error(f"  - Couldn't send {self.target} to {self.worker}", exc_info=exc)
+            # The pipe is only broken if the sending failed (not the pickling)
+            self._finish(None if isinstance(exc, OSError) else 1)
+            return
+        self.spawn_time = loop.time() - self.started_at
+        loop.add_reader(self.worker.conn.fileno(), self._reply_ready)
+
+    def terminate(self, result=Result.TERMINATED):
+        """
+        Kills the worker running the target. Sets the result to the specified value.
+        """
+        if self.worker is not None:
+            if self.result is None:
+                self.result = result
+            self._finish(None)
+
+    def _reply_ready(self):
+        self.exited_at = asyncio.get_running_loop().time()
+        try:
+            status = self.worker.conn.recv()
+        except EOFError:
+            # The worker died unexpectedly
+            status = None
+        self._finish(status)
+
+    def _finish(self, status):
+        worker, self.worker = self.worker, None
+        asyncio.get_running_loop().remove_reader(worker.conn.fileno())
+        if status is None:
+            self.pool.discard(worker)
+        else:
+            self.pool.release(worker)
+
+        if self.result is None:
+            self.result = Result.SUCCESS if status == 0 else Result.ERROR
+        self.notifying_task = asyncio.create_task(self._set_done())
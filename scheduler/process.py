@@ -1,8 +1,13 @@
 import asyncio
+import dataclasses
 import threading
 import logging
+import multiprocessing.process
+import os
+import signal
+import sys
+import weakref
 from enum import Enum
-from functools import partial
 
 class NotRunningError(Exception):
     ...
@@ -16,32 +21,206 @@ class Result(Enum):
     TERMINATED = 2
     ERROR = 3
 
-async def delayed_action(wait_time, action):
-    "Executes an arbitrary `action` after `wait_time` seconds have passed"
-    await asyncio.sleep(wait_time)
-    res = action()
-    if asyncio.iscoroutine(res):
-        await res
+@dataclasses.dataclass
+class ResourceUsage:
+    "What a process used, over its whole life (see os.wait4)"
+    # User + system CPU time, in seconds
+    cpu_time: float
+    # Peak resident set size, in bytes
+    max_rss: int
+    # Blocks read from, and written to, the filesystem
+    read_blocks: int
+    write_blocks: int
 
-class ProcessTask:
+    @classmethod
+    def from_rusage(cls, rusage):
+        # ru_maxrss comes in KiB, except on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return cls(rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * scale,
+                   rusage.ru_inblock, rusage.ru_oublock)
+
+class ProcessWatcher:
     '''
-    A class that allows an async process fine control over a
-    multiprocessing.Process
+    Waits for any number of processes from within the event loop, with no
+    helper threads: the sentinel of every watched process is registered with
+    the loop's selector, and the process is reaped as soon as it becomes
+    readable.
 
-    Initialize by passing an instance of Process, that must not
-    be running.
+    Children of this process are reaped with os.wait4 where available, which
+    also tells what they used (see ResourceUsage). Their usage is still lost
+    (and reported as None) if something else reaps them first, like
+    `Process.is_alive()` or `join()` on an exited process.
+
+    There's one watcher per event loop. Use `get_watcher` to obtain it.
     '''
-    def __init__(self, process):
-        self.process = process
+    # Seconds between attempts to collect a process that closed its sentinel
+    # but that the kernel still doesn't report as finished
+    REAP_RETRY = 0.001
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiters = {}
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def watch(self, process):
+        """
+        Returns a future that will be set as soon as `process` finishes, to a
+        (time, usage) tuple: the (loop) time when its sentinel became readable,
+        and its ResourceUsage, or None if not known. The process must be started
+        already.
+
+        Cancelling the future is fine: the process will still be reaped when it
+        exits, so that it doesn't linger as a zombie.
+        """
+        future = self.loop.create_future()
+        _disown(process)
+        fd = process.sentinel
+        self.loop.add_reader(fd, self._sentinel_ready, fd)
+        self.waiters[fd] = (process, future)
+        return future
+
+    def _sentinel_ready(self, fd):
+        self.loop.remove_reader(fd)
+        self._reap(fd, self.loop.time())
+
+    def _reap(self, fd, ready_time):
+        process, future = self.waiters[fd]
+        # The sentinel is closed as the child exits, which may happen a tad
+        # before the kernel lets us collect its exit status
+        done, usage = self._collect(process)
+        if not done:
+            self.loop.call_later(self.REAP_RETRY, self._reap, fd, ready_time)
+            return
+
+        del self.waiters[fd]
+        if not future.done():
+            future.set_result((ready_time, usage))
+
+    @staticmethod
+    def _collect(process):
+        """
+        Reaps `process` if it's done, without blocking. Returns whether it was
+        done, and its ResourceUsage if it could be collected.
+
+        Only internal use.
+        """
+        # multiprocessing reaps its children with waitpid (even just to tell
+        # the `exitcode`), which throws the rusage away. Do it ourselves, and
+        # hand it the exit status
+        popen = getattr(process, '_popen', None)
+        if hasattr(os, 'wait4') and getattr(popen, 'returncode', False) is None:
+            try:
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            except ChildProcessError:
+                # Not our child (eg. started by a forkserver)
+                ...
+            else:
+                if pid == 0:
+                    return False, None
+                popen.returncode = os.waitstatus_to_exitcode(status)
+                process.join(0)
+                return True, ResourceUsage.from_rusage(rusage)
+        process.join(0)
+        return process.exitcode is not None, None
+
+_watchers = weakref.WeakKeyDictionary()
+
+def _disown(process):
+    """
+    Every Process.start() reaps the children of multiprocessing that are done
+    already, throwing their rusage away. Under load, that happens to many of
+    the ones that exit before the watcher gets to them. They're watched (and
+    reaped) by a ProcessWatcher instead, so they're not multiprocessing's
+    children any longer.
+
+    Only internal use.
+    """
+    getattr(multiprocessing.process, '_children', set()).discard(process)
+
+def _reset_loop_signals():
+    """
+    Runs on the children forked by this process. A child forked from within
+    an event loop inherits the handlers installed by `loop.add_signal_handler`,
+    which do nothing but wake up the loop (the parent's, through the inherited
+    wakeup fd!). That would make the child ignore eg. SIGTERM, so the default
+    handlers are restored.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    reset = False
+    for sig in signal.valid_signals():
+        if getattr(signal.getsignal(sig), '__module__', None) == 'asyncio.unix_events':
+            signal.signal(sig, signal.default_int_handler if sig == signal.SIGINT else signal.SIG_DFL)
+            reset = True
+    if reset:
+        signal.set_wakeup_fd(-1)
+
+# Held while a child process is started, along with any pipe whose other end
+# only that child should keep (see `spawning`)
+_spawn_lock = threading.RLock()
+
+def spawning():
+    """
+    Returns the lock to hold while starting a child process, from creating the
+    pipes that it takes until the parent closes its ends of them. A child forked
+    meanwhile from another thread (eg. by another shard) would inherit them,
+    and hold the first one's sentinel open until it exits too.
+    """
+    return _spawn_lock
+
+def _reset_spawn_lock():
+    "Runs on the children forked by this process, where no other thread holds it"
+    global _spawn_lock
+    _spawn_lock = threading.RLock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_loop_signals)
+    os.register_at_fork(after_in_child=_reset_spawn_lock)
+
+def get_watcher(loop=None):
+    "Returns the ProcessWatcher associated to `loop` (by default, the running loop)"
+    loop = loop or asyncio.get_running_loop()
+    try:
+        return _watchers[loop]
+    except KeyError:
+        watcher = _watchers[loop] = ProcessWatcher(loop)
+        return watcher
+
+class BaseTask:
+    '''
+    Common bookkeeping for the classes that run a job on behalf of a
+    PriorityRunner: the result, and the notification of it being done.
+
+    Subclasses implement `start`, `wait` and `terminate`, and provide the `pid`
+    of the process running the job.
+
+    Subclasses also record some timings, when possible: the (loop) time when the
+    job started and when its end was detected, and how long it took to launch it.
+
+    Tasks that can't be paused (because there's no process of their own to
+    send SIGSTOP to) set `suspendable` to False.
+
+    Tasks that run a process of their own also report its `usage` once it's
+    done (a ResourceUsage), when possible.
+    '''
+    suspendable = True
+
+    def __init__(self):
         self.done = asyncio.Event()
-        self.running_task = None
         self.done_callbacks = []
         self.result = None
+        self.started_at = None
+        self.spawn_time = None
+        self.exited_at = None
+        self.usage = None
+        self.suspended = False
 
     def add_done_callback(self, callback):
         """
         Add a callback to be invoked when the process finishes by
-        any reason. The callback must accept one argument (the ProcessTask
+        any reason. The callback must accept one argument (the task
         instance itself)
         """
         self.done_callbacks.append(callback)
@@ -63,6 +242,68 @@ class ProcessTask:
         "True if the process was actively terminated"
         return self.result == Result.TERMINATED
 
+    def kill(self):
+        """
+        Terminates the job forcefully, for the ones that don't react to
+        `terminate`. By default, the same as `terminate`.
+        """
+        self.terminate()
+
+    def suspend(self):
+        """
+        Pauses the running process by sending it SIGSTOP. The runner pauses its
+        timeout, if any, until it's resumed.
+        """
+        if self.suspended or self.pid is None or self.done.is_set():
+            return
+
+        try:
+            os.kill(self.pid, signal.SIGSTOP)
+        except ProcessLookupError:
+            # Exited and reaped already, but not notified yet
+            return
+        self.suspended = True
+
+    def resume(self):
+        """
+        Resumes a suspended process by sending it SIGCONT.
+        """
+        if not self.suspended:
+            return
+
+        os.kill(self.pid, signal.SIGCONT)
+        self.suspended = False
+
+    async def _set_done(self):
+        """
+        Notifies any task blocked waiting for this processes, and invokes any
+        callback that was added for asynchronous notification.
+
+        Only for internal use.
+        """
+        self.done.set()
+        for callback in self.done_callbacks:
+            res = callback(self)
+            if asyncio.iscoroutine(res):
+                await res
+
+class ProcessTask(BaseTask):
+    '''
+    A class that allows an async process fine control over a
+    multiprocessing.Process
+
+    Initialize by passing an instance of Process, that must not
+    be running.
+    '''
+    def __init__(self, process):
+        super().__init__()
+        self.process = process
+        self.running_task = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
     async def wait(self):
         "Will block until the process finishes (or is terminated)"
         if not self.process.is_alive():
@@ -72,29 +313,31 @@ class ProcessTask:
 
     def terminate(self, result=Result.TERMINATED):
         """
-        Cancel the task waiting for the process to finish. As a side
-        effect, this will terminate the process itself.
+        Terminates the process. The task waiting for it will notice as soon
+        as it's gone.
 
         Sets the result to the specified value.
         """
         if self.process.is_alive():
             if self.result is None:
                 self.result = result
-            if self.running_task:
-                self.running_task.cancel()
+            self._kill()
 
-    async def _set_done(self):
+    def kill(self):
         """
-        Notifies any task blocked waiting for this processes, and invokes any
-        callback that was added for asynchronous notification.
-
-        Only for internal use.
+        Kills the process with SIGKILL, which can't be ignored (not even by a
+        suspended process). The result is set to TERMINATED.
         """
-        self.done.set()
-        for callback in self.done_callbacks:
-            res = callback(self)
-            if asyncio.iscoroutine(res):
-                await res
+        if self.process.is_alive():
+            if self.result is None:
+                self.result = Result.TERMINATED
+            self.process.kill()
+
+    def _kill(self):
+        self.process.terminate()
+        if self.suspended:
+            # Otherwise, it won't get the SIGTERM until resumed
+            os.kill(self.process.pid, signal.SIGCONT)
 
     async def await_process(self):
         """
@@ -108,22 +351,27 @@ class ProcessTask:
         In any case, it will signal that the process is done to anyone waiting.
         """
         try:
-            # This needs to be run on a thread, because Process.join() is a synchronous
-            # method and it would lock the whole event loop otherwise.
-            await asyncio.get_event_loop().run_in_executor(None, self.process.join)
+            try:
+                self.exited_at, self.usage = await get_watcher().watch(self.process)
+            except NotImplementedError:
+                # The loop can't watch file descriptors (eg. the Proactor loop on
+                # Windows). Fall back to waiting on a thread, because Process.join()
+                # is a synchronous method and it would lock the whole event loop otherwise.
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.process.join)
+                self.exited_at = loop.time()
         except asyncio.CancelledError:
-            self.process.terminate()
+            self._kill()
         finally:
             self.running_task = None
             if self.result is None:
                 self.result = Result.SUCCESS if self.process.exitcode == 0 else Result.ERROR
             await self._set_done()
 
-    def start(self, timeout=None):
+    def start(self):
         """
-        Starts the process and a background task will wait for it to finish. Optionally, if
-        `timeout` is not None, a second task will be launched to ensure that the process is
-        done within the deadline.
+        Starts the process and a background task will wait for it to finish. Timeouts are
+        up to the runner (see PriorityRunner), or to whoever starts the task.
 
         Can only be invoked once. It will raise CantStartError if the process was already
         alive, or if the task has finished.
@@ -133,9 +381,9 @@ class ProcessTask:
         elif self.done.is_set():
             raise CantStartError("This process ran already")
 
-        self.process.start()
+        self.started_at = asyncio.get_running_loop().time()
+        with spawning():
+            self.process.start()
+        _disown(self.process)
+        self.spawn_time = asyncio.get_running_loop().time() - self.started_at
         self.running_task = asyncio.create_task(self.await_process(), name=f"Running {self.process.name}")
-
-        if timeout is not None:
-            asyncio.create_task(delayed_action(timeout, partial(self.terminate, Result.TIMEOUT)),
-                                name=f"Timeout for {self.process.name}")
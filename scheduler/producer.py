@@ -5,44 +5,136 @@ import asyncio
 import functools
 import json
 import logging
+import uuid
 import websockets
-from random import randint, gauss
+from collections import Counter
+from random import randint, gauss, random
 
-from . import bus
+from . import bus, wire
 
 # Default production period, in seconds
 DEFAULT_PERIOD = 5
 DEFAULT_SD = 2
 
 def parse_args():
-    parser = argparse.ArgumentParser(epilog="By default, (with no -g specified), the producer issues new jobs periodically")
+    parser = argparse.ArgumentParser(epilog="By default, (with no -g or -w specified), the producer issues new jobs periodically")
     parser.add_argument('--period', '-p', dest='period', type=float, default=DEFAULT_PERIOD,
                         help = f'How many seconds to wait between events. Default {DEFAULT_PERIOD}s')
     parser.add_argument('--gauss', '-g', dest='gaussian', action='store_true',
                         help = 'Waits a random time, using -p as mean, and -s as std. deviation')
     parser.add_argument('--sigma', '-s', dest='sigma', type=float, default=DEFAULT_SD,
                         help = f'Standard deviation for -g. Default {DEFAULT_SD}s')
+    parser.add_argument('--batch', '-b', dest='batch', type=int, default=1,
+                        help = 'How many jobs to send per event. Default 1')
+    parser.add_argument('--binary', dest='binary', action='store_true',
+                        help = 'Use the compact binary encoding for the jobs')
+    parser.add_argument('--cancel', '-c', dest='cancel', type=float, default=0,
+                        help = 'Fraction of the jobs to cancel, one period after submitting them. '
+                               'Not for the binary encoding, that carries no job ids. Default 0')
+    parser.add_argument('--window', '-w', dest='window', type=int,
+                        help = 'Keep up to this many jobs in flight, submitting new ones as the '
+                               'scheduler reports the old ones are done, instead of periodically')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.window is not None and args.binary:
+        parser.error("--window needs job ids, that the binary encoding doesn't carry")
+    if args.window is not None and args.window < args.batch:
+        parser.error("--window can't be smaller than --batch")
+    return args
 
-def get_new_job():
+class InFlight:
+    """
+    Keeps track of the jobs submitted and not done yet, as told by the events
+    that the bus routes back to us.
+    """
+    def __init__(self):
+        self.jobs = set()
+        self.outcomes = Counter()
+        self.closed = False
+        self.changed = asyncio.Event()
+
+    def submitted(self, ids):
+        self.jobs.update(ids)
+
+    def handle(self, message):
+        msg = json.loads(message)
+        if msg.get('cmd') != 'job_events':
+            return
+        for job_id, event, _ in msg['events']:
+            if event in wire.FINAL_EVENTS and job_id in self.jobs:
+                self.jobs.remove(job_id)
+                self.outcomes[event] += 1
+        self.changed.set()
+
+    async def listen(self, websocket):
+        try:
+            async for message in websocket:
+                self.handle(message)
+        except websockets.ConnectionClosed:
+            ...
+        finally:
+            self.closed = True
+            self.changed.set()
+
+    async def room(self, window, count):
+        """
+        Waits until `count` more jobs fit in the `window`. Returns False if
+        the connection was closed in the meantime.
+        """
+        while len(self.jobs) + count > window and not self.closed:
+            self.changed.clear()
+            await self.changed.wait()
+        return not self.closed
+
+def get_new_payload():
     rt, pr = randint(3, 15), randint(0, 10)
-    return bus.create_message('job_request', payload={'runtime': rt, 'priority': pr})
+    return {'runtime': rt, 'priority': pr, 'id': uuid.uuid4().hex}
+
+def get_new_job():
+    return bus.create_message('job_request', payload=get_new_payload())
+
+def get_new_jobs(count, binary=False):
+    """
+    Returns a message carrying `count` new jobs, using the compact
+    binary encoding if requested, and the list of their ids (none for the
+    binary encoding, which doesn't carry them).
+    """
+    payloads = [get_new_payload() for _ in range(count)]
+    if binary:
+        return wire.encode_jobs(payloads), []
+    ids = [payload['id'] for payload in payloads]
+    if count == 1:
+        return bus.create_message('job_request', payload=payloads[0]), ids
+    return bus.create_message('job_batch', payloads=payloads), ids
 
-async def main(time_gen):
+async def main(time_gen, batch=1, binary=False, cancel=0, window=None):
     nmessages = 0
+    in_flight = InFlight()
     async with websockets.connect('ws://localhost:8101') as websocket:
-        await websocket.send(bus.create_message('register', type='producer'))
+        await websocket.send(bus.create_message('register', type='producer', events=True))
+        listener = asyncio.create_task(in_flight.listen(websocket))
         try:
             while True:
-                job = get_new_job()
+                job, ids = get_new_jobs(batch, binary)
                 await websocket.send(job)
-                seconds = next(time_gen)
-                logging.info(f"Submitted: {job}. Next in {seconds} seconds")
-                nmessages += 1
-                await asyncio.sleep(seconds)
+                in_flight.submitted(ids)
+                nmessages += batch
+                if window is None:
+                    seconds = next(time_gen)
+                    logging.info(f"Submitted: {job}. Next in {seconds} seconds")
+                    await asyncio.sleep(seconds)
+                else:
+                    logging.info(f"Submitted: {job}. {len(in_flight.jobs)} jobs in flight")
+                    if not await in_flight.room(window, batch):
+                        break
+                cancelled = [job_id for job_id in ids if random() < cancel]
+                if cancelled:
+                    await websocket.send(bus.create_message('cancel', ids=cancelled))
+                    logging.info(f"Cancelled {len(cancelled)} jobs")
         except websockets.ConnectionClosedOK as exc:
-            logging.info(f"Exiting after producing {nmessages} tasks")
+            ...
+        listener.cancel()
+        logging.info(f"Exiting after producing {nmessages} tasks. Outcomes: {dict(in_flight.outcomes)}")
 
 def constant_timer(period):
     while True:
@@ -58,4 +150,4 @@ if __name__ == '__main__':
                         format='%(asctime)s: %(message)s')
     args = parse_args()
     time_gen = functools.partial(gaussian_timer, sigma=args.sigma) if args.gaussian else constant_timer
-    asyncio.run(main(time_gen(args.period)))
+    asyncio.run(main(time_gen(args.period), args.batch, args.binary, args.cancel, args.window))
@@ -0,0 +1,107 @@
+"""
+Resource budgets for the runner, and estimates of what every kind of job
+needs.
+
+A Budget holds the capacity of the node in several resources (eg.
+`{'cpu': 4, 'memory': 8 * 2**30}`: 4 CPUs and 8GiB of memory), and how much
+of it is taken by the running jobs, according to their declared demands.
+PriorityRunner admits (and evicts) jobs against it, along with its slots.
+
+A UsageEstimator learns the demand of every kind of job from the
+ResourceUsage of the ones that finished, for the jobs that don't declare it.
+"""
+
+# The resources that a UsageEstimator knows about: CPUs (cores busy on
+# average) and memory (peak resident set, in bytes)
+CPU = 'cpu'
+MEMORY = 'memory'
+
+# Weight of the last observation on the estimates
+DEFAULT_ALPHA = 0.2
+
+# Rounding errors that are not worth rejecting a job for, as a fraction of
+# the capacity
+TOLERANCE = 1e-9
+
+class Budget:
+    """
+    The capacity of the node in some resources, and how much of it is used.
+
+    Demands are dictionaries from resource to amount, like the capacity.
+    Resources missing from a demand count as 0, and the ones missing from the
+    capacity are not limited. A demand larger than the whole capacity counts
+    as taking all of it, so that the job can still run (on its own).
+    """
+    def __init__(self, capacity):
+        self.capacity = dict(capacity)
+        self.used = dict.fromkeys(self.capacity, 0)
+
+    def __repr__(self):
+        return f"Budget({self.used} of {self.capacity})"
+
+    def _amounts(self, demand):
+        "The (resource, amount) pairs that `demand` takes. Only internal use."
+        if not demand:
+            return ()
+        capacity = self.capacity
+        return [(resource, min(amount, capacity[resource]))
+                for resource, amount in demand.items() if resource in capacity]
+
+    def fits(self, demand):
+        "True if `demand` fits in what's left"
+        capacity, used = self.capacity, self.used
+        return all(used[resource] + amount <= capacity[resource] * (1 + TOLERANCE)
+                   for resource, amount in self._amounts(demand))
+
+    def exhausted(self):
+        "True if any of the resources is fully used"
+        return any(self.used[resource] >= capacity * (1 - TOLERANCE)
+                   for resource, capacity in self.capacity.items())
+
+    def acquire(self, demand):
+        for resource, amount in self._amounts(demand):
+            self.used[resource] += amount
+
+    def release(self, demand):
+        for resource, amount in self._amounts(demand):
+            self.used[resource] = max(self.used[resource] - amount, 0)
+
+    def clear(self):
+        self.used = dict.fromkeys(self.capacity, 0)
+
+class UsageEstimator:
+    """
+    Estimates the demand of every kind of job as an exponentially weighted
+    moving average of what the previous ones used: their CPU time over their
+    run time (ie. how many cores they kept busy) and their peak memory.
+    Recent jobs weigh more, by `alpha`.
+    """
+    def __init__(self, alpha=DEFAULT_ALPHA):
+        self.alpha = alpha
+        # Kind -> {resource: amount}
+        self.estimates = {}
+
+    def __repr__(self):
+        return f"UsageEstimator({self.estimates})"
+
+    def observe(self, kind, usage, elapsed):
+        """
+        Learns from a job of `kind` that used `usage` (a ResourceUsage) over
+        `elapsed` seconds.
+        """
+        observed = {MEMORY: usage.max_rss}
+        if elapsed > 0:
+            observed[CPU] = usage.cpu_time / elapsed
+        estimate = self.estimates.get(kind)
+        if estimate is None:
+            self.estimates[kind] = observed
+            return
+        for resource, amount in observed.items():
+            previous = estimate.get(resource)
+            estimate[resource] = (amount if previous is None
+                                  else previous + self.alpha * (amount - previous))
+
+    def estimate(self, kind):
+        "Returns the estimated demand of the jobs of `kind`, or None if there's none yet"
+        estimate = self.estimates.get(kind)
+        return dict(estimate) if estimate is not None else None
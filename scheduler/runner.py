@@ -1,23 +1,82 @@
+import asyncio
 import dataclasses
 import functools
 import logging
+import os
+from collections import Counter
+from enum import Enum
 from itertools import count
 from multiprocessing import Process
+from multiprocessing.process import BaseProcess
 
+from .deadlines import Deadlines
+from .heap import IndexedHeap
 from .process import ProcessTask, Result
 
 job_counter = count()
 
-@dataclasses.dataclass(order=True)
+# Seconds that terminated jobs have to exit when draining, before being killed
+DEFAULT_KILL_AFTER = 5
+
+class Preemption(Enum):
+    "What to do with the jobs evicted by a higher priority one"
+    TERMINATE = 0
+    SUSPEND = 1
+
+class DrainOutcome(Enum):
+    "How a job ended, when draining the runner"
+    # On its own, within the grace period
+    FINISHED = 0
+    # It exited after being terminated
+    TERMINATED = 1
+    # It had to be killed
+    KILLED = 2
+    # Not even that worked: it was still there when we gave up on it
+    ALIVE = 3
+
+@dataclasses.dataclass
+class DrainReport:
+    "What PriorityRunner.drain did"
+    # Seconds it took
+    elapsed: float
+    # (Job, DrainOutcome) pairs
+    outcomes: list
+
+    def counts(self):
+        return Counter(outcome for _, outcome in self.outcomes)
+
+    def __str__(self):
+        counts = ', '.join(f"{n} {outcome.name.lower()}" for outcome, n in self.counts().items())
+        return f"Drained {len(self.outcomes)} jobs in {self.elapsed:.3f}s ({counts or 'none running'})"
+
+@dataclasses.dataclass(order=True, slots=True)
 class Job:
     priority: int
     process: ProcessTask=dataclasses.field(compare=False)
     sequence: int=dataclasses.field(compare=False,
                                     default_factory=functools.partial(next, job_counter))
+    deadline: object=dataclasses.field(compare=False, default=None)
+    time_left: float=dataclasses.field(compare=False, default=None)
+    cpus: set=dataclasses.field(compare=False, default=None)
+    # As given by a scheduling policy (see the `policies` module). By default, the priority
+    rank: object=dataclasses.field(compare=False, default=None)
+    # What it takes from the runner's budget (see the `resources` module)
+    demand: dict=dataclasses.field(compare=False, default=None)
+
+    def __post_init__(self):
+        if self.rank is None:
+            self.rank = self.priority
 
     def __repr__(self):
         return f"Job-{self.sequence} {{prio={self.priority}}}"
 
+    def eviction_key(self):
+        """
+        Jobs with a larger key are evicted first: the ones with the highest
+        rank (by default, the lowest priority) and, among those, the oldest ones.
+        """
+        return (self.rank, -self.sequence)
+
 class PriorityRunner:
     """
     A class that controls running processes according a certain priority.
@@ -33,12 +92,67 @@ class PriorityRunner:
       * Otherwise, the lowest priority job currently running is evicted
         (and its associated process terminated) to make room for the new
         task.
+
+    If `preemption` is Preemption.SUSPEND, evicted jobs are paused instead of
+    terminated, and kept in a set of suspended jobs that don't count towards
+    the `size`. Their timeout clocks are paused too. Whenever a slot is freed,
+    the highest priority suspended job is resumed before notifying anyone
+    else, unless a task waiting for a slot outranks it (see `set_waiting`).
+    Tasks that don't support being suspended are terminated as usual.
+
+    Running jobs are kept in a heap indexed by job, ordered by eviction
+    preference, so that scheduling, evicting and finishing a job are all
+    O(log n) operations.
+
+    Job timeouts are handled by the runner itself, through a shared set of
+    `deadlines` driven by a single event loop timer. If no `loop` is given,
+    the running one is used.
+
+    If a Metrics instance is passed as `metrics`, the runner records job
+    timings, evictions, timeouts and rejections on it.
+
+    Jobs can be given a `rank` by a scheduling policy (see the `policies`
+    module). Then, the ranks are compared instead of the priorities.
+
+    If a CpuPlacer is passed as `placer`, the process of every job is pinned
+    to the CPU it chooses, right after starting it. Suspended jobs give their
+    CPU back, and get a new one when resumed. Jobs with no process of their own
+    (eg. running on a thread) are not pinned.
+
+    Jobs can be looked up (`job_of`) and cancelled (`cancel`) by the task
+    object that was given to `schedule`, unless that was a bare Process.
+
+    If a Budget is passed as `budget` (see the `resources` module), jobs are
+    admitted against it as well as against the `size`: a job is only run if
+    its `demand` fits in what the running jobs leave, evicting as many jobs
+    with a higher rank as needed (highest rank first), and it's rejected,
+    evicting none, if not even that makes room for it. Suspended jobs give
+    their share back, and are only resumed when it fits again.
+
+    To shut the runner down, either `terminate_all` the jobs and forget
+    about them, or `drain` it, waiting until they are all gone.
     """
-    def __init__(self, size, timeout=None):
+    def __init__(self, size, timeout=None, preemption=Preemption.TERMINATE, loop=None,
+                 metrics=None, placer=None, budget=None):
         self.max_jobs = size
-        self.jobs = []
+        self.jobs = IndexedHeap(key=Job.eviction_key, reverse=True)
+        self.suspended = IndexedHeap(key=Job.eviction_key)
         self.callbacks = []
         self.timeout = timeout
+        self.preemption = preemption
+        self.deadlines = Deadlines(loop)
+        self.metrics = metrics
+        self.placer = placer
+        self.budget = budget
+        # Task object given to `schedule` -> Job
+        self.by_process = {}
+        self.draining = False
+        # Returns the rank of the best task waiting for a slot (see `set_waiting`)
+        self.waiting = None
+
+    def time(self):
+        "The current time, according to the runner's event loop"
+        return self.deadlines.time()
 
     def add_done_callback(self, callback):
         """
@@ -47,15 +161,35 @@ class PriorityRunner:
         """
         self.callbacks.append(callback)
 
+    def set_waiting(self, best_rank):
+        """
+        Tells the runner how to find out the rank of the best task waiting for
+        a slot elsewhere (eg. in a bin's pending queue): `best_rank()` returns
+        it, or None if there's none. A suspended job is not resumed as a slot
+        is freed if that task outranks it: it would only be evicted again.
+        """
+        self.waiting = best_rank
+
     async def terminated_job(self, job, ptask):
         """
         Called when a job has finished.
 
-        Runs any added callbacks in order to notify that a new slot is free
-        for scheduling.
+        Resumes a suspended job, if there's any, and then runs any added
+        callbacks in order to notify that a new slot is free for scheduling.
         """
         res = ptask.result
-        if res != Result.TERMINATED:
+        if job.cpus is not None:
+            self._unplace(job)
+        if job.deadline is not None:
+            self.deadlines.cancel(job.deadline)
+        if self.metrics is not None:
+            self._record_end(job, ptask)
+        self.by_process.pop(ptask, None)
+        if job in self.suspended:
+            # Killed while suspended. It wasn't holding a slot
+            logging.info(f"  - Suspended task {job} is done")
+            self.suspended.remove(job)
+        elif res != Result.TERMINATED:
             # Terminated jobs had been evicted earlier (see maybe_evict) and we
             # don't need to do anything else about them.
             # The others need a bit more of work
@@ -65,65 +199,437 @@ class PriorityRunner:
                 logging.info(f"  - Task {job} is done")
 
             try:
-                del self.jobs[self.jobs.index(job)]
+                self._remove_running(job)
             except ValueError:
+                # Exited right before being evicted, which freed its slot already
                 logging.warning(f"  - Job {job} was not in the heap any longer!")
+                return
+
+            if not self.draining:
+                self._slot_freed()
+
+    def _slot_freed(self):
+        """
+        Resumes a suspended job, if there's any and no waiting task outranks
+        it, and then lets the callbacks know that there's a free slot. If they
+        leave it free (eg. the waiting task was dropped instead), the suspended
+        job is resumed after all.
+
+        Only internal use.
+        """
+        deferred = None
+        if self.suspended and self._fits(self.suspended.peek().demand):
+            best = self.suspended.peek()
+            waiting = self.waiting() if self.waiting is not None else None
+            if waiting is not None and waiting < best.rank:
+                deferred = best
+            else:
+                self._resume_suspended(best)
+
+        # Notify that we're ready to queue something new
+        for callback in self.callbacks:
+            callback()
+
+        if deferred is not None and deferred in self.suspended and self._fits(deferred.demand):
+            self._resume_suspended(deferred)
 
-            # Notify that we're ready to queue something new
-            for callback in self.callbacks:
-                callback()
+    def _resume_suspended(self, job):
+        "Only internal use"
+        self.suspended.remove(job)
+        logging.info(f"  - Resuming job {job}")
+        self._resume(job)
 
-    def _run_job(self, proc, priority, timeout):
+    def _record_end(self, job, ptask):
+        """
+        Records the metrics about a finished job.
+
+        Only internal use.
+        """
+        now = self.time()
+        if ptask.result == Result.TIMEOUT:
+            self.metrics.timeouts.inc(job.priority)
+        if ptask.started_at is not None:
+            self.metrics.run_time.observe(job.priority, now - ptask.started_at)
+        if ptask.exited_at is not None:
+            self.metrics.exit_lag.observe(job.priority, now - ptask.exited_at)
+        if ptask.usage is not None:
+            self.metrics.cpu_time.observe(job.priority, ptask.usage.cpu_time)
+            self.metrics.max_rss.observe(job.priority, ptask.usage.max_rss)
+        elif isinstance(ptask, ProcessTask) and hasattr(os, 'wait4'):
+            # Reaped by someone else (see ProcessWatcher). Not observed by the
+            # UsageEstimator either, which keeps its last estimate
+            self.metrics.missing_usage.inc(job.priority)
+
+    def _run_job(self, proc, priority, timeout, rank=None, demand=None):
         """
         Prepares a job and starts its associated process.
 
         Only internal use.
         """
-        ptask = ProcessTask(proc)
-        job = Job(priority, ptask)
-        proc.name = f'Job-{job.sequence}'
+        if isinstance(proc, BaseProcess):
+            ptask = ProcessTask(proc)
+            job = Job(priority, ptask, rank=rank, demand=demand)
+            proc.name = f'Job-{job.sequence}'
+        else:
+            # Anything else is expected to offer the same interface as ProcessTask
+            ptask = proc
+            job = Job(priority, ptask, rank=rank, demand=demand)
+            self.by_process[ptask] = job
         ptask.add_done_callback(functools.partial(self.terminated_job, job))
-        ptask.start(timeout=timeout)
+        ptask.start()
+        if self.placer is not None:
+            self._place(job)
+        if self.metrics is not None and ptask.spawn_time is not None:
+            self.metrics.spawn_latency.observe(priority, ptask.spawn_time)
+        if timeout is not None:
+            job.deadline = self.deadlines.add(timeout, ptask.terminate, Result.TIMEOUT)
+
+        return job
+
+    def _place(self, job):
+        """
+        Pins the job's process to the CPUs chosen by the placer.
+
+        Only internal use.
+        """
+        pid = job.process.pid
+        if pid is None:
+            return
+        cpus = self.placer.acquire()
+        if self.placer.pin(pid, cpus):
+            job.cpus = cpus
+        else:
+            self.placer.release(cpus)
+
+    def _unplace(self, job):
+        self.placer.release(job.cpus)
+        job.cpus = None
+
+    def _suspend(self, job):
+        """
+        Pauses a job, along with its timeout clock.
+
+        Only internal use.
+        """
+        job.process.suspend()
+        if job.cpus is not None:
+            self._unplace(job)
+        if job.deadline is not None:
+            job.time_left = self.deadlines.remaining(job.deadline)
+            self.deadlines.cancel(job.deadline)
+            job.deadline = None
+        self.suspended.push(job)
+
+    def _resume(self, job):
+        """
+        Resumes a suspended job, restarting its timeout clock where it was left.
+
+        Only internal use.
+        """
+        job.process.resume()
+        if self.placer is not None:
+            self._place(job)
+        if job.time_left is not None:
+            job.deadline = self.deadlines.add(job.time_left, job.process.terminate, Result.TIMEOUT)
+            job.time_left = None
+        self._add_running(job)
+
+    def _add_running(self, job):
+        """
+        Adds a job to the running ones, taking its share of the budget.
+
+        Only internal use.
+        """
+        self.jobs.push(job)
+        if self.budget is not None:
+            self.budget.acquire(job.demand)
+
+    def _remove_running(self, job):
+        """
+        Removes a job from the running ones, giving its share of the budget back.
+        Raises ValueError if it's not running. Returns the job.
 
+        Only internal use.
+        """
+        self.jobs.remove(job)
+        if self.budget is not None:
+            self.budget.release(job.demand)
         return job
 
-    def maybe_evict(self, priority):
+    def _fits(self, demand, admitted=0):
+        """
+        True if a job with `demand` fits in the free slots and budget, besides
+        `admitted` more jobs that are about to be run.
+
+        Only internal use.
+        """
+        return (len(self.jobs) + admitted < self.max_jobs
+                and (self.budget is None or self.budget.fits(demand)))
+
+    def _victims(self, rank, demand, admitted=0):
+        """
+        Takes out of the heap the running jobs that need to be evicted to make
+        room for a job with `rank` and `demand` (see `_fits`), highest rank
+        first. Returns them, or None if evicting all the jobs with a higher
+        rank is not enough, leaving them all running.
+
+        Only internal use.
+        """
+        victims = []
+        while not self._fits(demand, admitted):
+            if not self.jobs or self.jobs.peek().rank <= rank:
+                for job in victims:
+                    self._add_running(job)
+                return None
+            victims.append(self._remove_running(self.jobs.peek()))
+        return victims
+
+    def free_slots(self):
+        """
+        How many jobs can be scheduled right now without evicting anyone. 0
+        if any of the resources in the budget is used up.
+        """
+        if self.draining or (self.budget is not None and self.budget.exhausted()):
+            return 0
+        return max(self.max_jobs - len(self.jobs), 0)
+
+    def can_schedule(self, priority, rank=None, demand=None):
         """
-        Evict and kill the lowest priority job if the specified
-        priority is higher.
+        True if a job with the specified priority (or rank) and demand would be
+        accepted right now, either because there's room for it, or by evicting
+        other jobs.
         """
+        rank = priority if rank is None else rank
+        if self.draining:
+            return False
+        victims = self._victims(rank, demand)
+        if victims is None:
+            return False
+        for job in victims:
+            self._add_running(job)
+        return True
+
+    def maybe_evict(self, priority, rank=None):
+        """
+        Evict and kill (or suspend, depending on the preemption policy) the
+        lowest priority (highest rank) job if the specified one is higher.
+        """
+        rank = priority if rank is None else rank
         try:
             # Assume that lower priority number means higher priority
-            lowest = max(self.jobs)
-            if lowest.priority > priority:
-                logging.warning(f"  - Evicting job {lowest}")
-                lowest.process.terminate()
-                del self.jobs[self.jobs.index(lowest)]
-        except ValueError:
+            lowest = self.jobs.peek()
+            if lowest.rank > rank:
+                self._evict(self._remove_running(lowest))
+        except IndexError:
             # No jobs...
             ...
 
-    def schedule(self, process, priority, timeout):
+    def _evict(self, job):
+        """
+        Kills or suspends a job that has already been taken out of the heap.
+
+        Only internal use.
+        """
+        if self.metrics is not None:
+            self.metrics.evictions.inc(job.priority)
+        if self.preemption == Preemption.SUSPEND and getattr(job.process, 'suspendable', False):
+            logging.warning(f"  - Suspending job {job}")
+            self._suspend(job)
+        else:
+            logging.warning(f"  - Evicting job {job}")
+            job.process.terminate()
+
+    def schedule(self, process, priority, timeout, rank=None, demand=None):
         """
-        Attempts scheduling a new job.
+        Attempts scheduling a new job. `process` is either a multiprocessing.Process,
+        or an object offering the same interface as ProcessTask. `rank`, if
+        given, is used instead of the priority to decide on evictions. `demand`
+        is what the job takes from the budget, if there's one.
 
         Returns True if the task was successfully scheduled,
         False otherwise.
         """
-        if len(self.jobs) >= self.max_jobs:
-            self.maybe_evict(priority)
-        if len(self.jobs) < self.max_jobs:
-            self.jobs.append(self._run_job(process, priority, timeout))
-            return True
+        if self.draining:
+            return False
+        victims = self._victims(priority if rank is None else rank, demand)
+        if victims is None:
+            if self.metrics is not None:
+                self.metrics.rejections.inc(priority)
+            return False
+        for job in victims:
+            self._evict(job)
+        self._add_running(self._run_job(process, priority, timeout, rank, demand))
+        return True
+
+    def schedule_many(self, batch):
+        """
+        Attempts scheduling a batch of jobs at once. `batch` is a sequence of
+        (process, priority, timeout), (process, priority, timeout, rank) or
+        (process, priority, timeout, rank, demand) tuples, as the arguments
+        to `schedule`.
+
+        The outcome is the same as scheduling the jobs one by one in order
+        of rank, except that evictions are decided for the whole batch
+        upfront: the jobs that end up running are the best ones among the
+        batch and the jobs already running, and no job from the batch is
+        started only to be evicted by a later one.
+
+        Returns a list with True for each job that was scheduled, and False
+        for the rejected ones, in the same order as `batch`.
+        """
+        batch = [(process, priority, timeout, priority if rank is None else rank, demand)
+                 for process, priority, timeout, rank, demand
+                 in (tuple(entry) + (None,) * (5 - len(entry)) for entry in batch)]
+        accepted = [False] * len(batch)
+        if self.draining:
+            return accepted
+        evicted = []
+        admitted = 0
+        # Stable sort: among jobs of the same rank, the first ones win
+        for index in sorted(range(len(batch)), key=lambda k: batch[k][3]):
+            _, _, _, rank, demand = batch[index]
+            victims = self._victims(rank, demand, admitted)
+            if victims is None:
+                if self.budget is None:
+                    # The rest of the batch has an even higher rank
+                    break
+                # But a smaller one may still fit
+                continue
+            evicted.extend(victims)
+            admitted += 1
+            if self.budget is not None:
+                # Taken right away, so that the rest of the batch counts it
+                self.budget.acquire(demand)
+            accepted[index] = True
+
+        for job in evicted:
+            self._evict(job)
+        for (process, priority, timeout, rank, demand), ok in zip(batch, accepted):
+            if ok:
+                # Its share of the budget was taken already
+                self.jobs.push(self._run_job(process, priority, timeout, rank, demand))
+            elif self.metrics is not None:
+                self.metrics.rejections.inc(priority)
+
+        return accepted
+
+    def job_of(self, process):
+        """
+        Returns the Job for `process`, as given to `schedule`, or None if there's
+        none. Jobs are known until they are done, even if they were evicted.
+        """
+        return self.by_process.get(process)
+
+    def cancel(self, process):
+        """
+        Terminates the job for `process`, as given to `schedule`, and frees
+        its slot right away (resuming a suspended job, or notifying the
+        callbacks, as if it had finished).
+
+        Returns False if there's no such job running or suspended (e.g. it's
+        been evicted, and it's on its way out).
+        """
+        job = self.by_process.get(process)
+        if job is None:
+            return False
+        if job in self.suspended:
+            logging.info(f"  - Cancelling suspended job {job}")
+            self.suspended.remove(job)
+            job.process.terminate()
+        elif job in self.jobs:
+            logging.info(f"  - Cancelling job {job}")
+            self._remove_running(job)
+            if job.deadline is not None:
+                self.deadlines.cancel(job.deadline)
+            job.process.terminate()
+            self._slot_freed()
         else:
             return False
+        return True
 
     def terminate_all(self):
         """
-        Ends all running processes.
+        Ends all running (and suspended) processes.
         """
-        for job in self.jobs:
+        for job in [*self.jobs, *self.suspended]:
             logging.debug(f"> Terminating {job}")
+            if job.deadline is not None:
+                self.deadlines.cancel(job.deadline)
             job.process.terminate()
 
-        self.jobs = []
+        self.jobs.clear()
+        self.suspended.clear()
+        if self.budget is not None:
+            self.budget.clear()
+
+    async def drain(self, grace=0, kill_after=DEFAULT_KILL_AFTER):
+        """
+        Shuts the runner down, waiting for all the jobs to be gone. No more jobs
+        are accepted (nor resumed) from here on.
+
+        The running jobs are given `grace` seconds to finish on their own. Then,
+        all the ones left (and the suspended ones) are terminated at once, and
+        the ones still alive `kill_after` seconds later are killed. Processes are
+        reaped concurrently, as they exit.
+
+        Returns a DrainReport, with how long it took and how every job ended.
+        """
+        start = self.time()
+        self.draining = True
+        outcomes = []
+        running = list(self.jobs)
+        remaining = list(self.suspended)
+
+        if grace > 0 and running:
+            logging.info(f"  - Waiting up to {grace}s for {len(running)} jobs to finish")
+            running = await self._wait_jobs(running, grace, DrainOutcome.FINISHED, outcomes)
+        remaining += running
+
+        if remaining:
+            logging.info(f"  - Terminating {len(remaining)} jobs")
+            for job in remaining:
+                job.process.terminate()
+            remaining = await self._wait_jobs(remaining, kill_after, DrainOutcome.TERMINATED, outcomes)
+
+        if remaining:
+            logging.warning(f"  - Killing {len(remaining)} jobs that didn't exit after {kill_after}s")
+            for job in remaining:
+                job.process.kill()
+            remaining = await self._wait_jobs(remaining, kill_after, DrainOutcome.KILLED, outcomes)
+            outcomes.extend((job, DrainOutcome.ALIVE) for job in remaining)
+
+        for job in [*self.jobs, *self.suspended]:
+            if job.deadline is not None:
+                self.deadlines.cancel(job.deadline)
+        self.jobs.clear()
+        self.suspended.clear()
+        if self.budget is not None:
+            self.budget.clear()
+
+        report = DrainReport(self.time() - start, outcomes)
+        logging.info(f"  - {report}")
+        for job, outcome in outcomes:
+            logging.debug(f"    {job}: {outcome.name.lower()}")
+        return report
+
+    async def _wait_jobs(self, jobs, timeout, outcome, outcomes):
+        """
+        Waits for the jobs to be done, for `timeout` seconds at most. The ones
+        that are done are added to `outcomes` with the specified `outcome`.
+        Returns the list of jobs that are not done yet.
+
+        Only internal use.
+        """
+        waiters = [asyncio.create_task(job.process.done.wait())
+                   for job in jobs if not job.process.done.is_set()]
+        if waiters:
+            _, pending = await asyncio.wait(waiters, timeout=timeout)
+            for waiter in pending:
+                waiter.cancel()
+        left = []
+        for job in jobs:
+            if job.process.done.is_set():
+                outcomes.append((job, outcome))
+            else:
+                left.append(job)
+        return left
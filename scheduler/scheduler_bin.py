@@ -1,66 +1,662 @@
 import asyncio
-import heapq
 import logging
 import dataclasses
+import functools
 import types
+from enum import Enum
 from multiprocessing import Process
 
-@dataclasses.dataclass(order=True)
+from .batching import Batch, BatchTask, Coalescer
+from .inprocess import CoroutineTask, ThreadTask
+from .pending import CompactPendingQueue, PendingQueue
+from .policies import PriorityPolicy
+from .process import ProcessTask, Result
+from .runner import DEFAULT_KILL_AFTER
+
+class Backend(Enum):
+    "How to run the target of a task"
+    # On a process of its own (or a pooled worker, if the bin has a pool)
+    PROCESS = 0
+    # On a thread of the bin's executor
+    THREAD = 1
+    # As a coroutine on the event loop. The target must be an async callable
+    COROUTINE = 2
+
+@dataclasses.dataclass(order=True, slots=True)
 class TaskDescription:
     priority: int
-    timeout: float
+    timeout: float=dataclasses.field(compare=False)
     target: callable=dataclasses.field(compare=False)
+    queued_at: float=dataclasses.field(compare=False, default=None, repr=False)
+    backend: Backend=dataclasses.field(compare=False, default=Backend.PROCESS, repr=False)
+    # If not None, a SharedChannel that is passed to the target as its argument
+    channel: object=dataclasses.field(compare=False, default=None, repr=False)
+    # Identifies the task, to look it up or cancel it, and across restarts
+    # (see the `journal` module)
+    job_id: str=dataclasses.field(compare=False, default=None, repr=False)
+    # Hints for the scheduling policies: expected run time (seconds), and
+    # deadline (in loop time)
+    runtime: float=dataclasses.field(compare=False, default=None, repr=False)
+    deadline: float=dataclasses.field(compare=False, default=None, repr=False)
+    # Given by the bin's policy, as the task arrives
+    rank: object=dataclasses.field(compare=False, default=None, repr=False)
+    # What the job takes from the runner's budget (eg. {'cpu': 1, 'memory': 2**30}).
+    # If None, estimated from the previous jobs of the same `kind`, if any
+    demand: dict=dataclasses.field(compare=False, default=None, repr=False)
+    kind: str=dataclasses.field(compare=False, default=None, repr=False)
 
     def __repr__(self):
         return f"{self.target} <- {{prio={self.priority}, timeout={self.timeout}}}"
 
+@dataclasses.dataclass(frozen=True)
+class Route:
+    """
+    The tasks that a bin takes (see SchedulerManager): those with a priority
+    in `priorities` (eg. a range) and a kind in `kinds`. None stands for any.
+    """
+    priorities: object=None
+    kinds: frozenset=None
+
+    def matches(self, priority, kind):
+        return ((self.priorities is None or priority in self.priorities)
+                and (self.kinds is None or kind in self.kinds))
+
+class DropPolicy(Enum):
+    "What to do with a new task when the pending queue is full"
+    # Reject the new task
+    REJECT_NEWEST = 0
+    # Drop the lowest priority task, if the new one has a higher priority
+    DROP_LOWEST = 1
+    # Drop the tasks that have been queued for longer than the maximum age
+    EXPIRE = 2
+
+class TaskEvent(Enum):
+    "The events in the life of a task, as reported to the bin's listeners"
+    # The task has been either scheduled or queued
+    ACCEPTED = 0
+    # The task's job has been handed to the runner
+    STARTED = 1
+    # The job is done, whatever its result, other than timed out or evicted
+    FINISHED = 2
+    # The job was terminated by a higher priority one
+    EVICTED = 3
+    # The task was dropped from the pending queue, or not admitted to it
+    DROPPED = 4
+    # The task was cancelled, either while pending or running
+    CANCELLED = 5
+    # The job was terminated for exceeding its timeout
+    TIMED_OUT = 6
+    # The task had to wait in the pending queue (reported right after ACCEPTED)
+    QUEUED = 7
+
+# The last event of a task
+FINAL_EVENTS = frozenset({TaskEvent.FINISHED, TaskEvent.EVICTED, TaskEvent.DROPPED,
+                          TaskEvent.CANCELLED, TaskEvent.TIMED_OUT})
+
+class TaskStatus(Enum):
+    "Where a task is, as reported by SchedulerBin.status"
+    PENDING = 0
+    RUNNING = 1
+    SUSPENDED = 2
+
 class SchedulerBin:
     """
     Example Bin class using a PriorityRunner and featuring an asynchronous
     queue handler.
 
-    Initialized with an optional "pool size" defining the maximum amount
-    of concurrent processes that will be handled by the Bin.
+    Initialized with the runner that will handle its processes and,
+    optionally, a WorkerPool. If a pool is given, the tasks will be run
+    by its warm workers instead of by a new process each.
+
+    Tasks with a THREAD or COROUTINE backend run within this process
+    instead (see the `inprocess` module), but share the runner's slots with
+    the rest. Threads run on `executor` or, if None, on the loop's default one.
+
+    Tasks with a `channel` get their input from it, and can return output
+    through it, with no copies (see the `channel` module).
+
+    The queue of pending tasks is unbounded, unless `max_pending` is given.
+    In that case, `drop_policy` decides what to do when a task arrives and the
+    queue is full: reject it, drop a lower priority task to make room, or
+    drop any tasks older than `max_age` seconds. If `max_age` is given, tasks
+    that exceed it are also dropped instead of being run, as they leave the queue.
+
+    The order in which pending tasks are run, and which running jobs are
+    evicted to make room for new ones, is decided by `policy` (see the
+    `policies` module). By default, the one with the lowest priority number
+    goes first.
+
+    Listeners added with `add_listener` are told about every TaskEvent. Jobs
+    terminated by `shutdown` don't report an event: they were cut short, but
+    not finished.
+
+    Tasks with a `job_id` are indexed by it while pending or running, so that
+    they can be looked up (`status`) and cancelled (`cancel`, `cancel_many`)
+    without going through the queue or the runner's jobs. Cancelled pending
+    tasks are left in the queue as tombstones (see PendingQueue.remove).
+
+    With `compact`, pending tasks are kept in a CompactPendingQueue, which takes
+    a fraction of the memory for large backlogs, but needs integer ranks (ie.
+    the default policy), and hands out copies of the tasks as they leave the queue.
+
+    If a UsageEstimator is passed as `estimator` (see the `resources` module),
+    it learns from the jobs that finish what every `kind` of task needs, and
+    tasks that don't declare their `demand` are given its estimate.
+
+    If a BatchWindow is passed as `coalesce` (see the `batching` module), the
+    short tasks that would run on a process of their own (and have no channel)
+    are gathered into batches while the runner has no free slot for them.
+    Batches run on a single process, and go through the queue and the runner
+    as a single task. Listeners are still told about every task, though.
+    Tasks can be cancelled until their batch starts, and those that don't get
+    to start before their batch is cut short are queued again.
+
+    The `route` (a Route) tells which tasks the bin is meant for, when it's
+    one of several. By default, it's meant for any.
     """
-    def __init__(self, runner):
-        self.pending_tasks = []
+    def __init__(self, runner, pool=None, max_pending=None,
+                 drop_policy=DropPolicy.REJECT_NEWEST, max_age=None, executor=None,
+                 policy=None, estimator=None, compact=False, coalesce=None, route=None):
+        self.route = route if route is not None else Route()
+        self.policy = policy if policy is not None else PriorityPolicy()
+        if compact:
+            self.pending_tasks = CompactPendingQueue(TaskDescription, key=self._rank)
+        else:
+            self.pending_tasks = PendingQueue(key=self._rank)
         self.accepting = True
         runner.add_done_callback(self._schedule_pending)
+        runner.set_waiting(self._best_pending_rank)
         self.runner = runner
+        self.pool = pool
+        self.executor = executor
+        self.metrics = runner.metrics
+        self.max_pending = max_pending
+        self.drop_policy = drop_policy
+        self.max_age = max_age
+        self.estimator = estimator
+        self.listeners = []
+        # Job id -> handle in the pending queue (see PendingQueue.push)
+        self.queued = {}
+        # Job id -> (TaskDescription, the task given to the runner), for the running ones
+        self.running = {}
+        # Job ids of the running tasks cancelled, but not done yet
+        self.cancelled = set()
+        # Job id -> Batch, for the tasks in one that isn't done yet
+        self.batches = {}
+        self.coalescer = (Coalescer(coalesce, self._run_batch, runner.deadlines)
+                          if coalesce is not None else None)
+        if drop_policy == DropPolicy.EXPIRE and max_age is None:
+            raise ValueError("DropPolicy.EXPIRE requires a max_age")
+
+    def _make_task(self, task):
+        """
+        Returns what will be handed to the runner to execute the task.
+        """
+        if isinstance(task.target, Batch):
+            ptask = BatchTask(task.target.tasks)
+            ptask.add_result_callback(self._batched_task_done)
+            ptask.add_done_callback(functools.partial(self._batch_done, task.target))
+            return ptask
+
+        if task.channel is None:
+            target = task.target
+        else:
+            target = functools.partial(task.target, task.channel)
+
+        if task.backend == Backend.THREAD:
+            ptask = ThreadTask(target, self.executor)
+        elif task.backend == Backend.COROUTINE:
+            ptask = CoroutineTask(target)
+        elif self.pool is not None:
+            ptask = self.pool.task(target)
+        else:
+            # Not a bare Process: we need to know when the task is done
+            ptask = ProcessTask(Process(target=target))
+
+        if task.channel is not None:
+            ptask.add_done_callback(task.channel.completed)
+        ptask.add_done_callback(functools.partial(self._task_done, task))
+        return ptask
+
+    def add_listener(self, callback):
+        """
+        Adds a callback to be invoked as `callback(event, task)` for every
+        TaskEvent, `task` being the TaskDescription.
+        """
+        self.listeners.append(callback)
+
+    def add_done_callback(self, callback):
+        """
+        Adds a callback to be invoked (with no arguments) whenever a job is
+        done, once the bin has taken the freed slot for its pending tasks.
+        """
+        self.runner.add_done_callback(callback)
+
+    def _notify(self, event, task):
+        if isinstance(task.target, Batch):
+            # The tasks in it were accepted one by one, as they joined it
+            if event != TaskEvent.ACCEPTED:
+                for member in task.target.tasks:
+                    self._notify(event, member)
+            return
+        for listener in self.listeners:
+            listener(event, task)
+
+    def _task_done(self, task, ptask):
+        if (self.estimator is not None and task.kind is not None and ptask.success()
+                and ptask.usage is not None):
+            self.estimator.observe(task.kind, ptask.usage, ptask.exited_at - ptask.started_at)
+        if task.job_id is not None:
+            self.running.pop(task.job_id, None)
+            if task.job_id in self.cancelled:
+                # Reported already, when cancelled
+                self.cancelled.discard(task.job_id)
+                return
+        if not self.listeners:
+            return
+        if ptask.result == Result.TIMEOUT:
+            self._notify(TaskEvent.TIMED_OUT, task)
+        elif ptask.result != Result.TERMINATED:
+            self._notify(TaskEvent.FINISHED, task)
+        elif self.accepting:
+            self._notify(TaskEvent.EVICTED, task)
+
+    def _batched_task_done(self, ptask, task, result):
+        self.batches.pop(task.job_id, None)
+        self._notify(TaskEvent.FINISHED, task)
+
+    def _batch_done(self, batch, ptask):
+        """
+        Reports the end of the task of the batch that was running when it
+        ended, as the batch did, and queues again the ones that never started.
+        """
+        for index, (task, result) in enumerate(zip(ptask.tasks, ptask.results)):
+            if result is not None:
+                continue
+            self.batches.pop(task.job_id, None)
+            if index > ptask.received:
+                self._queue(task, requeued=True)
+            elif ptask.result == Result.TIMEOUT:
+                self._notify(TaskEvent.TIMED_OUT, task)
+            elif ptask.result != Result.TERMINATED:
+                # The process died while running it
+                self._notify(TaskEvent.FINISHED, task)
+            elif self.accepting:
+                self._notify(TaskEvent.EVICTED, task)
+
+    def _rank(self, task):
+        "Returns the rank of the task, as given by the policy when first asked"
+        if task.rank is None:
+            task.rank = self.policy.rank(task, self.runner.time())
+        return task.rank
+
+    def _best_pending_rank(self):
+        "The rank of the best pending task, or None. Only internal use, for the runner"
+        return self._rank(self.pending_tasks.peek()) if self.pending_tasks else None
+
+    def _demand(self, task):
+        "Returns the demand of the task, estimating it if it didn't declare any"
+        if task.demand is None and task.kind is not None and self.estimator is not None:
+            return self.estimator.estimate(task.kind)
+        return task.demand
+
+    def _started(self, task, ptask):
+        "Indexes a task that the runner accepted"
+        if task.job_id is not None:
+            self.running[task.job_id] = (task, ptask)
+        elif isinstance(task.target, Batch):
+            task.target.handle = None
+            task.target.ptask = ptask
 
     def _schedule_with_runner(self, task):
-        return self.runner.schedule(Process(target=task.target),
-                                    task.priority, task.timeout)
+        ptask = self._make_task(task)
+        if not self.runner.schedule(ptask, task.priority, task.timeout, self._rank(task),
+                                    self._demand(task)):
+            return False
+        self._started(task, ptask)
+        return True
+
+    def _schedule_many_with_runner(self, tasks):
+        ptasks = [self._make_task(task) for task in tasks]
+        scheduled = self.runner.schedule_many([(ptask, task.priority, task.timeout, self._rank(task),
+                                                self._demand(task))
+                                               for task, ptask in zip(tasks, ptasks)])
+        for task, ptask, ok in zip(tasks, ptasks, scheduled):
+            if ok:
+                self._started(task, ptask)
+        return scheduled
+
+    def _drop(self, task, reason):
+        logging.warning(f"  - Dropping task {task}: {reason}")
+        if self.metrics is not None:
+            self.metrics.dropped_tasks.inc(task.priority)
+        self.queued.pop(task.job_id, None)
+        if task.channel is not None:
+            task.channel.set_status(Result.TERMINATED)
+        if isinstance(task.target, Batch):
+            for member in task.target.tasks:
+                self.batches.pop(member.job_id, None)
+        self._notify(TaskEvent.DROPPED, task)
+
+    def _has_room(self, task):
+        """
+        True if `task` can be queued, once the drop policy has been applied.
+        Doesn't change the queue.
+        """
+        if self.max_pending is None or len(self.pending_tasks) < self.max_pending:
+            return True
+        elif self.drop_policy == DropPolicy.DROP_LOWEST:
+            return self._rank(task) < self.pending_tasks.worst().rank
+        elif self.drop_policy == DropPolicy.EXPIRE:
+            return self.pending_tasks.oldest().queued_at < self.runner.time() - self.max_age
+        return False
+
+    def _make_room(self, task):
+        """
+        Applies the drop policy, if the queue is full. Returns True if `task`
+        can be queued.
+        """
+        if not self._has_room(task):
+            return False
+        elif self.max_pending is not None and len(self.pending_tasks) >= self.max_pending:
+            if self.drop_policy == DropPolicy.DROP_LOWEST:
+                self._drop(self.pending_tasks.pop_worst(), "evicted from a full queue")
+            else:
+                for expired in self.pending_tasks.expire(self.runner.time() - self.max_age):
+                    self._drop(expired, "queued for too long")
+        return True
 
     def schedule(self, task):
         """
         Attempts scheduling a task. In case it's not possible right now,
         because other higher priority tasks are holding all the available
         slots, the task will be queued for later scheduling.
+
+        Returns False if the task had to be dropped because the queue is full,
+        and True otherwise. Tasks that join a batch are not dropped (but their
+        batch may be, later on).
         """
+        if self._coalescable(task, self._free()):
+            self._coalesce(task)
+            return True
         if not self._schedule_with_runner(task):
-            logging.info("  - Had to queue the task, because it can't be scheduled")
-            heapq.heappush(self.pending_tasks, task)
+            return self._queue(task)
+        self._notify(TaskEvent.ACCEPTED, task)
+        self._notify(TaskEvent.STARTED, task)
+        return True
+
+    def schedule_many(self, tasks):
+        """
+        Attempts scheduling a batch of tasks at once (see
+        PriorityRunner.schedule_many), queueing the ones that can't be
+        scheduled right now.
+
+        Returns a list with the outcome for each task, as `schedule` would.
+        """
+        tasks = list(tasks)
+        results = [None] * len(tasks)
+        free = self._free()
+        for index, task in enumerate(tasks):
+            if self._coalescable(task, free):
+                self._coalesce(task)
+                results[index] = True
+            else:
+                free -= 1
+        unbatched = [index for index, result in enumerate(results) if result is None]
+        for index, ok in zip(unbatched, self._schedule_many_with_runner([tasks[k] for k in unbatched])):
+            task = tasks[index]
+            if ok:
+                self._notify(TaskEvent.ACCEPTED, task)
+                self._notify(TaskEvent.STARTED, task)
+                results[index] = True
+            else:
+                results[index] = self._queue(task)
+        return results
+
+    def _free(self):
+        "How many slots are left once the pending tasks take theirs. Only internal use"
+        return self.runner.free_slots() - len(self.pending_tasks)
+
+    def _coalescable(self, task, free):
+        """
+        True if the task should join a batch: it can, and there are no `free`
+        slots for it to run on its own.
+        """
+        return (self.coalescer is not None and free <= 0 and task.backend == Backend.PROCESS
+                and task.channel is None and self.coalescer.eligible(task))
+
+    def _coalesce(self, task):
+        "Adds the task to a batch. Its batch will be run once it's closed"
+        batch = self.coalescer.add(task)
+        if task.job_id is not None:
+            self.batches[task.job_id] = batch
+        self._notify(TaskEvent.ACCEPTED, task)
+        if self.coalescer.full(batch):
+            self.coalescer.close(batch)
+
+    def _run_batch(self, batch):
+        """
+        Schedules (or queues) a batch that has just been closed.
+
+        Only for internal use, as the coalescer's callback.
+        """
+        tasks = batch.tasks
+        timeouts = [task.timeout for task in tasks]
+        runtimes = [task.runtime for task in tasks]
+        deadlines = [task.deadline for task in tasks if task.deadline is not None]
+        demand = {}
+        for member in tasks:
+            # They run one after the other: the batch needs as much as the largest one
+            for resource, amount in (self._demand(member) or {}).items():
+                demand[resource] = max(demand.get(resource, 0), amount)
+        task = TaskDescription(priority=min(task.priority for task in tasks),
+                               timeout=None if None in timeouts else sum(timeouts),
+                               target=batch,
+                               runtime=None if None in runtimes else sum(runtimes),
+                               deadline=min(deadlines) if deadlines else None,
+                               demand=demand or None)
+        logging.info(f"  - Running {batch} {{prio={task.priority}, timeout={task.timeout}}}")
+        if self._schedule_with_runner(task):
+            self._notify(TaskEvent.STARTED, task)
+        else:
+            self._queue(task)
+
+    def _queue(self, task, requeued=False):
+        """
+        Queues a task that couldn't be scheduled, applying the drop policy
+        if needed. Returns False if the task was dropped.
+
+        Tasks `requeued` (from a batch that was cut short) were accepted already.
+        """
+        if not self._make_room(task):
+            self._drop(task, "the queue is full")
+            return False
+        logging.info("  - Had to queue the task, because it can't be scheduled")
+        if self.metrics is not None or self.max_age is not None:
+            task.queued_at = self.runner.time()
+        self._push_pending(task)
+        if not requeued:
+            self._notify(TaskEvent.ACCEPTED, task)
+        self._notify(TaskEvent.QUEUED, task)
+        return True
+
+    def _push_pending(self, task):
+        handle = self.pending_tasks.push(task)
+        if task.job_id is not None:
+            self.queued[task.job_id] = handle
+        elif isinstance(task.target, Batch):
+            task.target.handle = handle
+
+    def _pop_pending(self):
+        """
+        Returns the highest priority pending task, dropping on the way any that
+        exceeded the maximum age. Returns None if there are none left.
+        """
+        while self.pending_tasks:
+            task = self.pending_tasks.pop()
+            self.queued.pop(task.job_id, None)
+            if self.max_age is not None and task.queued_at < self.runner.time() - self.max_age:
+                self._drop(task, "queued for too long")
+            else:
+                return task
 
     def _schedule_pending(self):
         """
-        Schedules the highest priority pending task.
+        Schedules as many pending tasks as there are free slots, highest
+        priority first.
 
         Only for internal use, and meant to be a callback for the runner, which
-        ensures there will be an available slot. DO NOT invoke this method
-        directly, at the risk of silently losing task.
+        ensures there will be at least an available slot (unless it's been used
+        to resume a suspended job, in which case the highest priority pending
+        task can still try to evict some lower priority one). Several slots
+        may be free at once, e.g. if jobs finished while the runner was being
+        torn down, or after a batch of evictions.
+        """
+        batch = []
+        while len(batch) < max(self.runner.free_slots(), 1):
+            task = self._pop_pending()
+            if task is None:
+                break
+            batch.append(task)
+        if not batch:
+            return
+
+        logging.info(f"  - Scheduling {len(batch)} pending, {len(self.pending_tasks)} left")
+        scheduled = self._schedule_many_with_runner(batch)
+        for task, ok in zip(batch, scheduled):
+            if not ok:
+                # The slot was taken by a resumed job that has higher priority
+                self._push_pending(task)
+            else:
+                self._notify(TaskEvent.STARTED, task)
+                if self.metrics is not None and task.queued_at is not None:
+                    self.metrics.queue_wait.observe(task.priority, self.runner.time() - task.queued_at)
+
+    def status(self, job_id):
+        """
+        Returns the TaskStatus of the task with the given job id, or None if
+        the bin doesn't have it (any longer).
+        """
+        if job_id in self.queued:
+            return TaskStatus.PENDING
+        batch = self.batches.get(job_id)
+        if batch is not None:
+            if batch.ptask is None:
+                return TaskStatus.PENDING
+            ptask = batch.ptask
+        else:
+            entry = self.running.get(job_id)
+            if entry is None or job_id in self.cancelled:
+                return None
+            ptask = entry[1]
+        job = self.runner.job_of(ptask)
+        if job is None:
+            return None
+        elif job in self.runner.suspended:
+            return TaskStatus.SUSPENDED
+        elif job in self.runner.jobs:
+            return TaskStatus.RUNNING
+        # Evicted, and on its way out
+        return None
+
+    def cancel(self, job_id):
         """
-        if self.pending_tasks:
-            task = heapq.heappop(self.pending_tasks)
-            logging.info(f"  - Scheduling pending: {task}, {len(self.pending_tasks)} left")
-            self._schedule_with_runner(task)
+        Cancels the task with the given job id, either removing it from the
+        queue (or its batch), or terminating its job.
+
+        Returns False if the bin doesn't have such task (any longer), or if it's
+        running as part of a batch.
+        """
+        handle = self.queued.pop(job_id, None)
+        batch = self.batches.get(job_id)
+        if batch is not None:
+            if batch.ptask is not None:
+                return False
+            del self.batches[job_id]
+            task = next(task for task in batch.tasks if task.job_id == job_id)
+            if self.coalescer.is_open(batch):
+                self.coalescer.remove(batch, task)
+            else:
+                batch.remove(task)
+                if not batch.tasks:
+                    self.pending_tasks.remove(batch.handle)
+                    batch.handle = None
+        elif handle is not None:
+            task = self.pending_tasks.remove(handle)
+            if task.channel is not None:
+                task.channel.set_status(Result.TERMINATED)
+        else:
+            entry = self.running.get(job_id)
+            if entry is None or job_id in self.cancelled:
+                return False
+            task, ptask = entry
+            if not self.runner.cancel(ptask):
+                return False
+            self.cancelled.add(job_id)
+        logging.info(f"  - Cancelled task {task}")
+        self._notify(TaskEvent.CANCELLED, task)
+        return True
+
+    def cancel_many(self, job_ids):
+        """
+        Cancels several tasks by their job id. Returns a list with the outcome
+        for each one, as `cancel` would.
+
+        Pending tasks are cancelled first, so that the slots freed by the
+        running ones are not taken by tasks that were about to be cancelled.
+        """
+        job_ids = list(job_ids)
+        results = [False] * len(job_ids)
+        for pending in (True, False):
+            for index, job_id in enumerate(job_ids):
+                if (self.status(job_id) == TaskStatus.PENDING) == pending and not results[index]:
+                    results[index] = self.cancel(job_id)
+        return results
+
+    def free_slots(self):
+        """
+        How many more tasks the bin can run right now, taking into account
+        the ones that are waiting for a slot already.
+        """
+        free = max(self._free(), 0)
+        if self.coalescer is not None:
+            # Only the tasks that can be coalesced fit in the open batches
+            free += self.coalescer.room()
+        return free
 
     def shutdown(self):
         """
         Attempt to "gracefully" terminate all running tasks.
         """
         self.accepting = False
+        if self.coalescer is not None:
+            self.coalescer.stop()
         self.runner.terminate_all()
+        if self.pool is not None:
+            self.pool.close()
+
+    async def drain(self, grace=0, kill_after=DEFAULT_KILL_AFTER):
+        """
+        Like `shutdown`, but letting the running tasks finish within `grace`
+        seconds, and waiting for them all to be gone (see PriorityRunner.drain).
+        Pending tasks are left where they are.
+
+        Returns the runner's DrainReport.
+        """
+        self.accepting = False
+        if self.coalescer is not None:
+            self.coalescer.stop()
+        report = await self.runner.drain(grace, kill_after)
+        if self.pool is not None:
+            self.pool.close()
+        return report
 
     def accepts(self, task):
-        return True
+        """
+        True if the task would be either run right away, or queued (maybe
+        dropping some other task, according to the policy).
+        """
+        if not self.accepting:
+            return False
+        return (self.runner.can_schedule(task.priority, self._rank(task), self._demand(task))
+                or self._has_room(task))
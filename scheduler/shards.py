@@ -0,0 +1,378 @@
+"""
+Bins that run on an event loop of their own, either on a thread or on a
+process, so that a single scheduler can supervise jobs from several loops
+(and, with processes, on several cores).
+
+A ShardedBin is the front of a SchedulerBin that runs on the shard: it's
+what the SchedulerManager and the listeners see, on their loop, and it talks
+to the shard through messages. The SchedulerBin (and its PriorityRunner) is
+built on the shard by the `make_bin` callable. Between threads, messages go
+through deques, whose appends and pops need no locks, and the receiving loop
+is woken up with `call_soon_threadsafe`. Between processes, they're pickled
+through a socket pair.
+
+The front never waits for the shard: it follows the status of the jobs from
+the events that the shard reports (once per iteration of its loop, along with
+its free slots), and decides whether the bin `accepts` a task from there. So
+it lags a bit behind: see ShardedBin.
+"""
+
+import asyncio
+import collections
+import copy
+import dataclasses
+import logging
+import multiprocessing
+import pickle
+import signal
+import socket
+import struct
+import threading
+from enum import Enum
+
+from .process import spawning
+from .runner import DEFAULT_KILL_AFTER, DrainReport
+from .scheduler_bin import FINAL_EVENTS, DropPolicy, Route, TaskEvent, TaskStatus
+
+# Length of the pickled messages between processes
+LENGTH = struct.Struct('!I')
+
+class ShardMode(Enum):
+    "Where a ShardedBin runs its SchedulerBin"
+    THREAD = 0
+    PROCESS = 1
+
+@dataclasses.dataclass
+class ShardState:
+    "What a shard last reported about its bin"
+    free_slots: int=0
+    # False if the bin takes no more tasks: it's shutting down, or its queue is
+    # full and new tasks are rejected
+    room: bool=True
+
+class QueueLink:
+    """
+    Messages from a thread to another: `send` appends them to a deque, and
+    wakes up the loop of the other thread to hand them to `receive`.
+
+    Only internal use.
+    """
+    def __init__(self, loop, receive=None):
+        self.loop = loop
+        self.receive = receive
+        self.messages = collections.deque()
+
+    def send(self, message):
+        self.messages.append(message)
+        try:
+            self.loop.call_soon_threadsafe(self._deliver)
+        except RuntimeError:
+            # The loop of the other end is closed (eg. the shard is drained):
+            # no one is going to take them
+            self.messages.clear()
+
+    def attach(self, receive):
+        "Starts handing the messages to `receive`, including those sent already"
+        self.receive = receive
+        self._deliver()
+
+    def _deliver(self):
+        while self.receive is not None and self.messages:
+            self.receive(self.messages.popleft())
+
+class SocketLink:
+    """
+    Messages between processes, both ways: `send` pickles them into a socket,
+    and those coming from the other end are handed to `receive` (and then None,
+    once the other end is gone).
+
+    Only internal use.
+    """
+    def __init__(self, sock, receive=None):
+        self.sock = sock
+        self.receive = receive
+        self.writer = None
+        # Sent before being connected
+        self.unsent = []
+        self.reading = None
+
+    def attach(self, receive=None):
+        "Starts sending and receiving, on the running loop"
+        if receive is not None:
+            self.receive = receive
+        self.reading = asyncio.get_running_loop().create_task(self._read())
+
+    def send(self, message):
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        if self.writer is None:
+            self.unsent.append(LENGTH.pack(len(data)) + data)
+        else:
+            self.writer.write(LENGTH.pack(len(data)) + data)
+
+    async def close(self):
+        "Stops, once everything sent so far is on its way"
+        if self.writer is not None:
+            await self.writer.drain()
+            self.writer.close()
+        if self.reading is not None:
+            self.reading.cancel()
+
+    async def _read(self):
+        reader, self.writer = await asyncio.open_connection(sock=self.sock)
+        self.writer.writelines(self.unsent)
+        self.unsent = []
+        while True:
+            try:
+                length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+                message = pickle.loads(await reader.readexactly(length))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            self.receive(message)
+        self.receive(None)
+
+class Shard:
+    """
+    The end of a ShardedBin that runs the actual bin, built with `make_bin`.
+    Handles the messages of the front, and reports back through `send` the
+    events of the tasks and the state of the bin.
+
+    Only internal use.
+    """
+    def __init__(self, make_bin, send):
+        self.bin = make_bin()
+        self.send = send
+        self.events = []
+        self.reporting = False
+        self.done = asyncio.get_running_loop().create_future()
+        self.bin.add_listener(self._record)
+        self.bin.add_done_callback(self._report_soon)
+        self._report_soon()
+
+    def _record(self, event, task):
+        self.events.append((event, task.job_id))
+        self._report_soon()
+
+    def _report_soon(self):
+        "Reports once per iteration of the loop, at most"
+        if not self.reporting:
+            self.reporting = True
+            asyncio.get_running_loop().call_soon(self._report)
+
+    def _report(self):
+        self.reporting = False
+        events, self.events = self.events, []
+        self.send(('events', events, self._state()))
+
+    def _state(self):
+        a_bin = self.bin
+        full = (a_bin.max_pending is not None and len(a_bin.pending_tasks) >= a_bin.max_pending
+                and a_bin.drop_policy == DropPolicy.REJECT_NEWEST and a_bin.runner.free_slots() == 0)
+        return ShardState(a_bin.free_slots(), a_bin.accepting and not full)
+
+    def handle(self, message):
+        if message is None:
+            logging.error("The front of the shard is gone. Shutting it down")
+            message = ('shutdown',)
+        command = message[0]
+        if command == 'schedule':
+            self.bin.schedule_many(message[1])
+        elif command == 'cancel':
+            self.bin.cancel_many(message[1])
+            self._report_soon()
+        elif command == 'drain':
+            asyncio.create_task(self._drain(*message[1:]))
+        elif command == 'shutdown':
+            self.bin.shutdown()
+            self._stop()
+
+    async def _drain(self, grace, kill_after):
+        report = await self.bin.drain(grace, kill_after)
+        self._report()
+        # The jobs stay here
+        self.send(('drained', DrainReport(report.elapsed, [(repr(job), outcome)
+                                                           for job, outcome in report.outcomes])))
+        self._stop()
+
+    def _stop(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+async def _run_shard(make_bin, send, attach):
+    shard = Shard(make_bin, send)
+    attach(shard.handle)
+    await shard.done
+
+def _serve_thread(make_bin, loop, inbox, send):
+    "Only internal use, as the target of the thread of a shard"
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_run_shard(make_bin, send, inbox.attach))
+    finally:
+        loop.close()
+
+def _serve_process(make_bin, sock, other):
+    "Only internal use, as the target of the process of a shard"
+    other.close()
+
+    async def serve():
+        # The front stops it (see ShardedBin.drain), even if the signals to stop
+        # are sent to the whole process group. The jobs get the default handlers
+        # back (see the `process` module)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, lambda: None)
+        link = SocketLink(sock)
+        await _run_shard(make_bin, link.send, link.attach)
+        await link.close()
+    asyncio.run(serve())
+
+class ShardedBin:
+    """
+    A SchedulerBin (built by `make_bin`) running on its own event loop, on a
+    thread or on a process as given by `mode`. It offers what the
+    SchedulerManager needs from a bin, on the loop that creates it, but:
+
+      - Tasks need a job id, and with processes, they have to be picklable
+        (eg. no channel). The shard runs copies of them, so that the threads
+        don't share them, and the listeners are given the tasks scheduled
+        here.
+      - It `accepts` tasks as long as the shard last reported that it has
+        room for them, and `free_slots` is the one that it reported, minus the
+        tasks scheduled since. The shard applies its drop policy anyway.
+      - The `status` of a job is PENDING until it's reported to start, and
+        RUNNING (even if suspended) until it's done.
+      - Cancelling returns True for any job that is still pending or running
+        as far as the front knows. The final event of the job tells whether it
+        was actually cancelled.
+      - Callbacks added with `add_done_callback` are invoked whenever the shard
+        reports (which includes every time that a job is done) until it's
+        drained.
+
+    Thread shards start the processes of their jobs one at a time (see
+    `process.spawning`), not to leak their pipes into each other's children.
+    """
+    def __init__(self, make_bin, mode=ShardMode.THREAD, route=None, name='shard'):
+        self.route = route if route is not None else Route()
+        self.mode = mode
+        self.name = name
+        self.accepting = True
+        self.gone = False
+        self.state = ShardState()
+        self.listeners = []
+        self.callbacks = []
+        # Job id -> [TaskDescription, TaskStatus], for the pending and running ones
+        self.jobs = {}
+        self.drained = None
+        loop = asyncio.get_running_loop()
+        if mode == ShardMode.THREAD:
+            shard_loop = asyncio.new_event_loop()
+            self.link = QueueLink(shard_loop)
+            back = QueueLink(loop, self._receive)
+            self.worker = threading.Thread(target=_serve_thread, name=name, daemon=True,
+                                           args=(make_bin, shard_loop, self.link, back.send))
+            self.worker.start()
+        else:
+            # The shard takes the bin as it is: nothing to pickle
+            context = multiprocessing.get_context('fork')
+            with spawning():
+                sock, other = socket.socketpair()
+                self.worker = context.Process(target=_serve_process, name=name, args=(make_bin, other, sock))
+                self.worker.start()
+                other.close()
+            self.link = SocketLink(sock, self._receive)
+            self.link.attach()
+
+    def __repr__(self):
+        return f"ShardedBin({self.name}, {self.mode.name.lower()})"
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def _receive(self, message):
+        if message is None:
+            # The shard is gone: fine only once it's been drained
+            if self.drained is None or not self.drained.done():
+                logging.error(f"{self} is gone")
+                self.accepting = False
+                if self.drained is not None:
+                    self.drained.set_result(DrainReport(0, []))
+            self.gone = True
+            return
+        kind = message[0]
+        if kind == 'events':
+            _, events, self.state = message
+            for event, job_id in events:
+                entry = self.jobs.get(job_id)
+                if entry is None:
+                    continue
+                if event in FINAL_EVENTS:
+                    del self.jobs[job_id]
+                elif event == TaskEvent.STARTED:
+                    entry[1] = TaskStatus.RUNNING
+                for listener in self.listeners:
+                    listener(event, entry[0])
+            if self.accepting:
+                for callback in self.callbacks:
+                    callback()
+        elif kind == 'drained':
+            self.drained.set_result(message[1])
+
+    def accepts(self, task):
+        return self.accepting and self.state.room
+
+    def schedule(self, task):
+        return self.schedule_many([task])[0]
+
+    def schedule_many(self, tasks):
+        tasks = list(tasks)
+        for task in tasks:
+            if task.job_id is None:
+                raise ValueError(f"{self} needs tasks with a job id: {task}")
+            self.jobs[task.job_id] = [task, TaskStatus.PENDING]
+        self.state.free_slots -= len(tasks)
+        if self.mode == ShardMode.THREAD:
+            # Pickling makes copies for processes
+            tasks = [copy.copy(task) for task in tasks]
+        self.link.send(('schedule', tasks))
+        return [True] * len(tasks)
+
+    def status(self, job_id):
+        entry = self.jobs.get(job_id)
+        return entry[1] if entry is not None else None
+
+    def cancel(self, job_id):
+        return self.cancel_many([job_id])[0]
+
+    def cancel_many(self, job_ids):
+        results = [job_id in self.jobs for job_id in job_ids]
+        cancelled = [job_id for job_id, ok in zip(job_ids, results) if ok]
+        if cancelled:
+            self.link.send(('cancel', cancelled))
+        return results
+
+    def free_slots(self):
+        return max(self.state.free_slots, 0)
+
+    def shutdown(self):
+        "Terminates the running tasks of the shard (see SchedulerBin.shutdown), and stops it"
+        self.accepting = False
+        self.link.send(('shutdown',))
+
+    async def drain(self, grace=0, kill_after=DEFAULT_KILL_AFTER):
+        """
+        Drains the bin of the shard (see SchedulerBin.drain), and stops it. The
+        jobs in the DrainReport are just their description.
+        """
+        self.accepting = False
+        if self.gone:
+            return DrainReport(0, [])
+        self.drained = asyncio.get_running_loop().create_future()
+        self.link.send(('drain', grace, kill_after))
+        report = await self.drained
+        await asyncio.to_thread(self.worker.join)
+        if self.mode == ShardMode.PROCESS:
+            await self.link.close()
+        return report
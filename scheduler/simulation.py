@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""
+Discrete-event simulation of a SchedulerBin and its PriorityRunner.
+
+The actual scheduling code is driven by a VirtualLoop, which offers the
+subset of the event loop interface that it needs, but runs on virtual time:
+instead of waiting for the next timer, the clock jumps straight to it. Jobs
+are VirtualTasks, that "run" for as long as their runtime says without
+running anything at all. This makes it possible to replay long workloads in
+a fraction of the time they'd take for real, although not for free: every
+job goes through the actual scheduling code, which takes most of the time
+(some 30-40µs of real time per job, ie. a few seconds per 100,000 jobs).
+"""
+
+import argparse
+import csv
+import heapq
+import logging
+import time
+from collections import defaultdict
+from itertools import count
+from random import Random
+
+from .policies import AgingPolicy, EarliestDeadlineFirst, PriorityPolicy, ShortestRuntimeFirst
+from .process import BaseTask, Result
+from .runner import PriorityRunner, Preemption
+from .scheduler_bin import SchedulerBin, TaskDescription
+
+DEFAULT_JOBS = 100000
+DEFAULT_RATE = 1.0
+DEFAULT_POOL_SIZE = 5
+DEFAULT_TIMEOUT = 10
+DEFAULT_AGING_RATE = 0.1
+POLICIES = {
+    'priority': PriorityPolicy,
+    'edf': EarliestDeadlineFirst,
+    'srf': ShortestRuntimeFirst,
+    'aging': lambda: AgingPolicy(DEFAULT_AGING_RATE),
+}
+
+def run_sync(coro):
+    """
+    Runs a coroutine that is not expected to ever suspend (like the callbacks
+    used by the runner and the tasks) to completion.
+    """
+    try:
+        coro.send(None)
+    except StopIteration:
+        return
+    coro.close()
+    raise RuntimeError("The coroutine can't be run on virtual time")
+
+class VirtualHandle:
+    "Returned by VirtualLoop.call_at, to allow cancelling the call"
+    __slots__ = ('_when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self._when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def when(self):
+        return self._when
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualLoop:
+    """
+    A stand-in for the asyncio event loop, with the methods used by the
+    scheduling classes, running on virtual time.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.sequence = count()
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback, *args):
+        handle = VirtualHandle(when, callback, args)
+        heapq.heappush(self.events, (when, next(self.sequence), handle))
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(self.now, callback, *args)
+
+    def run(self):
+        "Runs until there are no more events"
+        events = self.events
+        while events:
+            when, _, handle = heapq.heappop(events)
+            if not handle.cancelled:
+                self.now = when
+                handle.callback(*handle.args)
+
+class SimJob:
+    """
+    The target of a simulated task. Besides the runtime, it keeps the times
+    that are needed for the statistics.
+    """
+    __slots__ = ('priority', 'runtime', 'arrival', 'started')
+
+    def __init__(self, priority, runtime, arrival):
+        self.priority = priority
+        self.runtime = runtime
+        self.arrival = arrival
+        self.started = None
+
+    def __repr__(self):
+        return f"SimJob({self.runtime})"
+
+class VirtualTask(BaseTask):
+    """
+    Offers the ProcessTask interface for a SimJob, which is done after running
+    (not being suspended) for its whole runtime.
+    """
+    def __init__(self, sim, job):
+        super().__init__()
+        self.sim = sim
+        self.loop = sim.loop
+        self.job = job
+        self.remaining = job.runtime
+        self.running_since = None
+        self.completion = None
+
+    pid = None
+
+    async def wait(self):
+        await self.done.wait()
+
+    def start(self):
+        if self.job.started is None:
+            self.job.started = self.loop.now
+            self.sim.job_started(self.job)
+        self._run()
+
+    def suspend(self):
+        if self.running_since is not None:
+            self._pause()
+            self.suspended = True
+            self.sim.suspensions += 1
+
+    def resume(self):
+        if self.suspended:
+            self.suspended = False
+            self._run()
+
+    def terminate(self, result=Result.TERMINATED):
+        if self.result is None:
+            self._finish(result)
+
+    def _run(self):
+        self.running_since = self.loop.now
+        self.completion = self.loop.call_later(self.remaining, self._finish, Result.SUCCESS)
+
+    def _pause(self):
+        self.completion.cancel()
+        elapsed = self.loop.now - self.running_since
+        self.remaining -= elapsed
+        self.running_since = None
+        self.sim.busy_time += elapsed
+        return elapsed
+
+    def _finish(self, result):
+        if self.running_since is not None:
+            self._pause()
+        self.result = result
+        self.sim.job_finished(self)
+        # Like a real task would, notify on a later iteration of the loop
+        self.loop.call_soon(run_sync, self._set_done())
+
+class SimulatedBin(SchedulerBin):
+    "A SchedulerBin that runs VirtualTasks"
+    def __init__(self, sim, runner, policy=None):
+        super().__init__(runner, policy=policy)
+        self.sim = sim
+
+    def _make_task(self, task):
+        return VirtualTask(self.sim, task.target)
+
+class Simulation:
+    """
+    Feeds a SimulatedBin with jobs arriving at the specified times, and
+    collects statistics on how they were scheduled.
+
+    `jobs` is an iterable of (arrival time, priority, runtime) tuples, sorted
+    by arrival time. The tasks are given their runtime as a hint for the
+    scheduling `policy`, and their timeout as deadline.
+    """
+    def __init__(self, jobs, size, timeout, preemption=Preemption.TERMINATE, policy=None):
+        self.loop = VirtualLoop()
+        self.size = size
+        self.timeout = timeout
+        self.runner = PriorityRunner(size, preemption=preemption, loop=self.loop)
+        self.bin = SimulatedBin(self, self.runner, policy)
+        self.jobs = iter(jobs)
+
+        self.submitted = 0
+        self.results = defaultdict(int)
+        self.suspensions = 0
+        self.busy_time = 0.0
+        self.wasted_time = 0.0
+        self.waits = defaultdict(list)
+
+    def job_started(self, job):
+        self.waits[job.priority].append(job.started - job.arrival)
+
+    def job_finished(self, task):
+        self.results[task.result] += 1
+        if task.result != Result.SUCCESS:
+            self.wasted_time += task.job.runtime - task.remaining
+
+    def _next_arrival(self):
+        try:
+            arrival, priority, runtime = next(self.jobs)
+        except StopIteration:
+            return
+        self.loop.call_at(arrival, self._arrive, priority, runtime)
+
+    def _arrive(self, priority, runtime):
+        self.submitted += 1
+        job = SimJob(priority, runtime, self.loop.now)
+        self.bin.schedule(TaskDescription(priority=priority, timeout=self.timeout, target=job,
+                                          runtime=runtime, deadline=self.loop.now + self.timeout))
+        self._next_arrival()
+
+    def run(self):
+        self._next_arrival()
+        self.loop.run()
+
+    def report(self):
+        duration = self.loop.now
+        completed = self.results[Result.SUCCESS]
+        print(f"Simulated {duration:,.0f}s, {self.submitted} jobs")
+        print(f"  Completed:   {completed} ({completed / duration:.3f} jobs/s)")
+        print(f"  Timed out:   {self.results[Result.TIMEOUT]}")
+        print(f"  Evicted:     {self.results[Result.TERMINATED]}")
+        print(f"  Suspended:   {self.suspensions}")
+        print(f"  Utilization: {self.busy_time / (self.size * duration):.1%} of {self.size} slots")
+        print(f"  Wasted CPU:  {self.wasted_time:,.0f}s")
+        print("  Queue wait per priority (s):")
+        print(f"    {'prio':>4} {'started':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for prio, waits in sorted(self.waits.items()):
+            waits.sort()
+            p50, p90, p99 = (waits[int(q * (len(waits) - 1))] for q in (0.5, 0.9, 0.99))
+            print(f"    {prio:>4} {len(waits):>9} {p50:>9.2f} {p90:>9.2f} {p99:>9.2f} {waits[-1]:>9.2f}")
+
+def poisson_jobs(njobs, rate, seed=None):
+    """
+    Generates jobs arriving as a Poisson process with the specified rate (jobs/s),
+    with the same priorities and runtimes as the ones issued by the producer.
+    """
+    rnd = Random(seed)
+    arrival = 0.0
+    for _ in range(njobs):
+        arrival += rnd.expovariate(rate)
+        yield arrival, rnd.randint(0, 10), rnd.randint(3, 15)
+
+def trace_jobs(path):
+    "Reads the jobs from a CSV file with arrival time, priority and runtime per row"
+    with open(path, newline='') as trace:
+        for arrival, priority, runtime in csv.reader(trace):
+            yield float(arrival), int(priority), float(runtime)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='jobs', type=int, default=DEFAULT_JOBS,
+            help=f"number of jobs to simulate. Default: {DEFAULT_JOBS}")
+    parser.add_argument('-r', dest='rate', type=float, default=DEFAULT_RATE,
+            help=f"average arrival rate, in jobs/s. Default: {DEFAULT_RATE}")
+    parser.add_argument('-s', dest='size', type=int, default=DEFAULT_POOL_SIZE,
+            help=f"maximum number of concurrent tasks. Default: {DEFAULT_POOL_SIZE}")
+    parser.add_argument('-t', dest='timeout', type=float, default=DEFAULT_TIMEOUT,
+            help=f"timeout for the jobs. Default: {DEFAULT_TIMEOUT}s")
+    parser.add_argument('-S', dest='suspend', action='store_true',
+            help="suspend evicted jobs, instead of terminating them")
+    parser.add_argument('-p', dest='policy', choices=POLICIES, default='priority',
+            help="scheduling policy. Default: priority")
+    parser.add_argument('--seed', dest='seed', type=int,
+            help="seed for the random job generator")
+    parser.add_argument('--trace', dest='trace',
+            help="replay the jobs from a CSV file (arrival, priority, runtime), instead of generating them")
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    # The scheduler logs every event, and we're going to simulate quite a few
+    logging.disable(logging.CRITICAL)
+    jobs = trace_jobs(args.trace) if args.trace else poisson_jobs(args.jobs, args.rate, args.seed)
+    preemption = Preemption.SUSPEND if args.suspend else Preemption.TERMINATE
+    sim = Simulation(jobs, args.size, args.timeout, preemption, POLICIES[args.policy]())
+    start = time.perf_counter()
+    sim.run()
+    elapsed = time.perf_counter() - start
+    sim.report()
+    print(f"(took {elapsed:.2f}s of real time)")
@@ -1,15 +1,35 @@
+import asyncio
 import signal
 import logging
+import threading
 import time
 
 class Sleeper:
+    __slots__ = ('runtime',)
+
     def __init__(self, runtime):
         self.runtime = runtime
 
     def __call__(self):
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if threading.current_thread() is threading.main_thread():
+            # Only possible on the main thread of a (worker) process
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
         logging.info(f'Sleeping for {self.runtime}s')
         time.sleep(self.runtime)
 
     def __repr__(self):
         return f"Sleeper({self.runtime})"
+
+class AsyncSleeper:
+    "Like Sleeper, but sleeps on the event loop"
+    __slots__ = ('runtime',)
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    async def __call__(self):
+        logging.info(f'Sleeping for {self.runtime}s')
+        await asyncio.sleep(self.runtime)
+
+    def __repr__(self):
+        return f"AsyncSleeper({self.runtime})"
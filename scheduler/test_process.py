@@ -9,6 +9,7 @@ import time
 from multiprocessing import Process
 
 from . import process
+from .deadlines import Deadlines
 
 def sleep_for(name, seconds):
     time.sleep(seconds)
@@ -53,7 +54,8 @@ async def launch_process_task_and_timeout():
 
     task = process.ProcessTask(create_process('pt-3', 300))
     logging.info(" - Will timeout in 5 seconds")
-    task.start(timeout=5)
+    Deadlines().add(tout, task.terminate, process.Result.TIMEOUT)
+    task.start()
     await task.wait()
 
 async def launch_process_task_and_terminate():
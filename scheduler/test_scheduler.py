@@ -2,71 +2,443 @@
 
 import argparse
 import asyncio
+import functools
 import json
 import logging
+import os
 import signal
+import time
+import uuid
 import websockets
+from concurrent.futures import ThreadPoolExecutor
 
-from .runner import PriorityRunner
-from .scheduler_bin import SchedulerBin, TaskDescription
-from .sleeper import Sleeper
-from . import bus
+from .affinity import CpuPlacer
+from .batching import DEFAULT_BATCH_LATENCY, DEFAULT_MAX_RUNTIME, BatchWindow
+from .journal import Journal
+from .metrics import Metrics
+from .policies import AgingPolicy, EarliestDeadlineFirst, PriorityPolicy, ShortestRuntimeFirst
+from .pool import WorkerPool
+from .resources import CPU, MEMORY, Budget, UsageEstimator
+from .runner import DEFAULT_KILL_AFTER, PriorityRunner, Preemption
+from .scheduler_bin import FINAL_EVENTS, Backend, DropPolicy, Route, SchedulerBin, TaskDescription
+from .shards import ShardedBin, ShardMode
+from .sleeper import AsyncSleeper, Sleeper
+from . import bus, wire
 
 DEFAULT_PERIOD = 5
 DEFAULT_POOL_SIZE = 5
 DEFAULT_TIMEOUT = 10
+DEFAULT_AGING_RATE = 0.1
+# Seconds to coalesce job events for, before publishing them
+DEFAULT_EVENT_INTERVAL = 0.05
+DROP_POLICIES = {
+    'reject-newest': DropPolicy.REJECT_NEWEST,
+    'drop-lowest': DropPolicy.DROP_LOWEST,
+    'expire': DropPolicy.EXPIRE,
+}
+POLICIES = {
+    'priority': PriorityPolicy,
+    'edf': EarliestDeadlineFirst,
+    'srf': ShortestRuntimeFirst,
+    'aging': lambda: AgingPolicy(DEFAULT_AGING_RATE),
+}
+BACKENDS = {
+    'process': Backend.PROCESS,
+    'thread': Backend.THREAD,
+    'coroutine': Backend.COROUTINE,
+}
+SHARD_MODES = {
+    'thread': ShardMode.THREAD,
+    'process': ShardMode.PROCESS,
+}
+# Priorities of the jobs, as made by the producer. Shards split them
+PRIORITIES = range(0, 11)
 
 class SchedulerManager:
-    def __init__(self):
+    """
+    Hands the tasks to the first bin that accepts them, among those whose
+    route matches (see scheduler_bin.Route). The matching bins are looked up
+    in an index by priority and kind, instead of going through all of them.
+    It's built from the priorities and kinds that the routes declare (which
+    have to be finite, like a range), as bins are added.
+
+    Every task gets a job id (unless it comes with one already), by which it
+    can be looked up and cancelled later on. The bin of every job is
+    remembered until its final event.
+    """
+    def __init__(self, metrics=None):
         self.bins = []
+        self.metrics = metrics
+        # (priority, kind) -> the bins whose route declares them, in order.
+        # None stands for any (see `_index`)
+        self.routes = {}
+        # Bin -> its position in `bins`
+        self.order = {}
+        # Job id -> the bin that has it
+        self.jobs = {}
 
     def add_bin(self, new_bin):
+        self.order[new_bin] = len(self.bins)
         self.bins.append(new_bin)
+        self._index(new_bin)
+        new_bin.add_listener(self._forget)
 
-    def handle(self, task):
-        for a_bin in self.bins:
+    def _index(self, a_bin):
+        "Adds the bin to the index of routes. Only internal use"
+        route = a_bin.route
+        for priority in (route.priorities if route.priorities is not None else (None,)):
+            for kind in (route.kinds if route.kinds is not None else (None,)):
+                self.routes.setdefault((priority, kind), []).append(a_bin)
+
+    def _candidates(self, priority, kind):
+        "Returns the bins whose route matches, in the order they were added"
+        keys = {(priority, kind), (priority, None), (None, kind), (None, None)}
+        found = [self.routes[key] for key in keys if key in self.routes]
+        if len(found) == 1:
+            return found[0]
+        return sorted((a_bin for bins in found for a_bin in bins), key=self.order.get)
+
+    def _forget(self, event, task):
+        "Listener for the bins' events"
+        if event in FINAL_EVENTS:
+            self.jobs.pop(task.job_id, None)
+
+    def _identify(self, task):
+        """
+        Gives the task a job id, if it has none. Returns False if the id is
+        taken by some other live task.
+        """
+        if task.job_id is None:
+            task.job_id = uuid.uuid4().hex
+        elif self.status(task.job_id) is not None:
+            logging.warning(f"Ignoring task {task}: job id {task.job_id} is in use")
+            return False
+        return True
+
+    def _route(self, task):
+        "Returns the bin that takes the task, or None if none does"
+        for a_bin in self._candidates(task.priority, task.kind):
             if a_bin.accepts(task):
-                logging.info(f"Scheduling task: {task}")
-                a_bin.schedule(task)
-                break
-        else:
-            logging.warning(f"Rejected task: {task}")
+                # Before scheduling it: it may be dropped right away
+                self.jobs[task.job_id] = a_bin
+                return a_bin
+        logging.warning(f"Rejected task: {task}")
+        if self.metrics is not None:
+            self.metrics.rejected_tasks.inc(task.priority)
+        return None
+
+    def handle(self, task):
+        """
+        Schedules a task. Returns its job id, or None if it was rejected.
+        """
+        if not self._identify(task):
+            return None
+        a_bin = self._route(task)
+        if a_bin is None:
+            return None
+        logging.info(f"Scheduling task: {task}")
+        a_bin.schedule(task)
+        return task.job_id
+
+    def handle_many(self, tasks):
+        """
+        Handles a batch of tasks, scheduling together all the ones that go to
+        the same bin, so that it can decide on evictions for all of them at once.
+
+        Returns a list with the job id of each task, as `handle` would.
+        """
+        batches = {}
+        results = []
+        for task in tasks:
+            results.append(None)
+            if not self._identify(task):
+                continue
+            a_bin = self._route(task)
+            if a_bin is not None:
+                batches.setdefault(a_bin, []).append(task)
+                results[-1] = task.job_id
+        for a_bin, batch in batches.items():
+            logging.info(f"Scheduling {len(batch)} tasks")
+            a_bin.schedule_many(batch)
+        return results
+
+    def status(self, job_id):
+        "Returns the TaskStatus of a job, or None if no bin has it"
+        a_bin = self.jobs.get(job_id)
+        return a_bin.status(job_id) if a_bin is not None else None
+
+    def cancel(self, job_id):
+        "Cancels a job, wherever it is. Returns False if no bin has it"
+        a_bin = self.jobs.get(job_id)
+        return a_bin is not None and a_bin.cancel(job_id)
+
+    def cancel_many(self, job_ids):
+        "Cancels several jobs. Returns the number of them actually cancelled"
+        by_bin = {}
+        for job_id in set(job_ids):
+            a_bin = self.jobs.get(job_id)
+            if a_bin is not None:
+                by_bin.setdefault(a_bin, []).append(job_id)
+        return sum(sum(a_bin.cancel_many(ids)) for a_bin, ids in by_bin.items())
+
+    async def shutdown_all(self, grace=0, kill_after=DEFAULT_KILL_AFTER):
+        """
+        Drains all the bins at once (see SchedulerBin.drain). Returns their
+        DrainReports.
+        """
+        return await asyncio.gather(*(a_bin.drain(grace, kill_after) for a_bin in self.bins))
+
+    def free_capacity(self):
+        return sum(a_bin.free_slots() for a_bin in self.bins)
+
+class CreditAdvertiser:
+    """
+    Lets the bus know how many more jobs this scheduler can take (see the bus'
+    dispatch mode), granting new credits as the manager's bins free slots.
+
+    Keeps count of the credits granted so far that haven't been used yet, so
+    that the capacity is not advertised twice.
+    """
+    def __init__(self, manager, websocket):
+        self.manager = manager
+        self.websocket = websocket
+        self.granted = 0
+        for a_bin in manager.bins:
+            a_bin.add_done_callback(self.update)
+
+    def job_received(self):
+        self.granted = max(self.granted - 1, 0)
 
-    async def shutdown_all(self):
-        for a_bin in self.bins:
-            a_bin.shutdown()
+    def update(self):
+        credits = self.manager.free_capacity() - self.granted
+        if credits > 0:
+            self.granted += credits
+            asyncio.create_task(self._send(bus.create_message('credit', credits=credits)))
 
-def get_configured_manager():
-    mng = SchedulerManager()
-    prun = PriorityRunner(args.size)
-    mng.add_bin(SchedulerBin(prun))
+    async def _send(self, frame):
+        try:
+            await self.websocket.send(frame)
+        except websockets.ConnectionClosed:
+            # Shutting down. Nobody would take more jobs anyway
+            ...
+
+class EventPublisher:
+    """
+    Publishes the events of the jobs through the bus, so that they reach the
+    producers that submitted them (see the `wire` module for the frames).
+
+    Add its `record` method as a listener to the bins. Events are coalesced
+    into a single frame every `interval` seconds, at most.
+    """
+    def __init__(self, websocket, interval=DEFAULT_EVENT_INTERVAL):
+        self.websocket = websocket
+        self.interval = interval
+        self.events = []
+        self.flush_handle = None
+
+    def record(self, event, task):
+        "Listener for the SchedulerBin events"
+        self.add(task.job_id, event.name.lower())
+
+    def add(self, job_id, event):
+        self.events.append([job_id, event, time.time()])
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.interval, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        events, self.events = self.events, []
+        if events:
+            asyncio.create_task(self._send(bus.create_message('job_events', events=events)))
+
+    async def _send(self, frame):
+        try:
+            await self.websocket.send(frame)
+        except websockets.ConnectionClosed:
+            # Shutting down. Nobody would listen anyway
+            ...
+
+async def serve_metrics(metrics, port):
+    """
+    Serves the metrics in Prometheus' text exposition format, on a minimal
+    HTTP endpoint at localhost:`port`
+    """
+    async def handle(reader, writer):
+        try:
+            # Just skip the request: whatever is asked, the answer is the same
+            while (await reader.readline()).strip():
+                ...
+            body = metrics.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, 'localhost', port)
+
+@functools.lru_cache(maxsize=1024)
+def get_sleeper(sleeper, runtime):
+    "Sleepers hold nothing but their runtime, so the jobs can share them"
+    return sleeper(runtime)
+
+def make_task(msg, job_id=None):
+    """
+    Returns a TaskDescription for the job described by a message from the bus.
+    The job is expected to be done within the timeout, unless the message has
+    its own `deadline` (in seconds from now). The job id is taken from the
+    message, unless given.
+
+    The message may also tell the `kind` of job, and its expected use of
+    `cpu` (cores) and `memory` (bytes).
+    """
+    backend = BACKENDS[args.backend]
+    sleeper = AsyncSleeper if backend == Backend.COROUTINE else Sleeper
+    deadline = asyncio.get_running_loop().time() + msg.get('deadline', args.timeout)
+    if job_id is None and msg.get('id') is not None:
+        job_id = str(msg['id'])
+    demand = {resource: msg[resource] for resource in (CPU, MEMORY) if resource in msg}
+    return TaskDescription(priority=msg['priority'],
+                           timeout=args.timeout,
+                           target=get_sleeper(sleeper, msg['runtime']),
+                           backend=backend,
+                           job_id=job_id,
+                           runtime=msg['runtime'],
+                           deadline=deadline,
+                           demand=demand or None,
+                           kind=msg.get('kind'))
+
+def encode_task(task):
+    "What the journal needs to recreate the task with `make_task`"
+    msg = {'priority': task.priority, 'runtime': task.target.runtime, **(task.demand or {})}
+    if task.kind is not None:
+        msg['kind'] = task.kind
+    return json.dumps(msg).encode()
+
+def make_bin(metrics=None, route=None, cpus=None):
+    """
+    Returns a SchedulerBin, with its own runner, as configured on the command
+    line. With --pin, its jobs go to `cpus` (by default, all of them).
+    """
+    preemption = Preemption.SUSPEND if args.suspend else Preemption.TERMINATE
+    placer = CpuPlacer(cpus, reserve=1) if args.pin else None
+    capacity = {}
+    if args.cpus is not None:
+        capacity[CPU] = args.cpus
+    if args.memory is not None:
+        capacity[MEMORY] = args.memory * 2**20
+    budget = Budget(capacity) if capacity else None
+    prun = PriorityRunner(args.size, preemption=preemption, metrics=metrics, placer=placer,
+                          budget=budget)
+    pool = WorkerPool(args.size) if args.pool else None
+    executor = ThreadPoolExecutor(args.size) if args.backend == 'thread' else None
+    coalesce = (BatchWindow(args.coalesce, args.coalesce_latency, max_runtime=args.coalesce_max_runtime)
+                if args.coalesce else None)
+    return SchedulerBin(prun, pool=pool, max_pending=args.max_pending,
+                        drop_policy=DROP_POLICIES[args.drop], max_age=args.max_age,
+                        executor=executor, policy=POLICIES[args.policy](),
+                        estimator=UsageEstimator() if budget is not None else None,
+                        compact=args.compact, coalesce=coalesce, route=route)
+
+def get_configured_manager(journal=None):
+    metrics = Metrics() if args.metrics_port else None
+    mng = SchedulerManager(metrics)
+    if args.shards:
+        # Every shard takes a band of priorities
+        bounds = [PRIORITIES[len(PRIORITIES) * k // args.shards] for k in range(args.shards)]
+        bounds.append(PRIORITIES.stop)
+        # With --pin, every shard places its jobs on CPUs of its own (and
+        # reserves one of them for its loop), not to collide with the others
+        cpus = sorted(os.sched_getaffinity(0)) if args.pin else None
+        bins = []
+        for k, (lo, hi) in enumerate(zip(bounds, bounds[1:])):
+            route = Route(range(lo, hi))
+            shard_cpus = (cpus[len(cpus) * k // args.shards:len(cpus) * (k + 1) // args.shards]
+                          if cpus is not None else None)
+            # Every shard updates metrics of its own, on its thread
+            part = None
+            if metrics is not None:
+                part = Metrics()
+                metrics.include(part)
+            bins.append(ShardedBin(functools.partial(make_bin, part, route, shard_cpus),
+                                   SHARD_MODES[args.shard_mode], route, name=f'shard-{k}'))
+    else:
+        bins = [make_bin(metrics)]
+    for sbin in bins:
+        if journal is not None:
+            sbin.add_listener(journal.record)
+        mng.add_bin(sbin)
 
     return mng
 
-def terminate(manager, websocket):
-    async def terminate_impl():
-        await websocket.close()
-        await manager.shutdown_all()
-    asyncio.create_task(terminate_impl())
+def handle_command(manager, message):
+    "Handles the messages from the bus that carry no jobs"
+    msg = json.loads(message)
+    if msg.get('cmd') == 'cancel':
+        job_ids = [str(job_id) for job_id in msg['ids']]
+        cancelled = manager.cancel_many(job_ids)
+        logging.info(f"Cancelled {cancelled} out of {len(job_ids)} jobs")
+
+def terminate(websocket):
+    "Stops listening to the bus. The jobs are drained as `main` finishes"
+    asyncio.create_task(websocket.close())
 
 async def main(args):
-    manager = get_configured_manager()
+    journal = Journal(args.journal, encode_task) if args.journal else None
+    manager = get_configured_manager(journal)
     term_signals = signal.SIGINT, signal.SIGTERM
+    if args.metrics_port:
+        await serve_metrics(manager.metrics, args.metrics_port)
+    if journal is not None:
+        recovered = journal.recover()
+        logging.info(f"Recovering {len(recovered)} jobs from the journal")
+        for job_id, payload, _ in recovered:
+            if manager.handle(make_task(json.loads(payload), job_id)) is None:
+                journal.discard(job_id)
+
+    try:
+        await serve_bus(manager, term_signals)
+    finally:
+        await manager.shutdown_all(args.grace, args.kill_after)
+        if journal is not None:
+            await journal.close()
 
+async def serve_bus(manager, term_signals):
+    "Handles the messages from the bus, until it goes away or we are told to stop"
     async with websockets.connect('ws://localhost:8101') as websocket:
         for s in term_signals:
-            asyncio.get_event_loop().add_signal_handler(s, terminate, manager, websocket)
+            asyncio.get_event_loop().add_signal_handler(s, terminate, websocket)
         # Register with the bus, letting it know that we'll be handling stuff
         await websocket.send(bus.create_message('register', type='scheduler'))
+        credits = CreditAdvertiser(manager, websocket)
+        credits.update()
+        events = EventPublisher(websocket)
+        for a_bin in manager.bins:
+            a_bin.add_listener(events.record)
         async for message in websocket:
-            msg = json.loads(message)
-            task = TaskDescription(priority=msg['priority'],
-                                   timeout=args.timeout,
-                                   target=Sleeper(msg['runtime']))
-            manager.handle(task)
-
-def set_logging(debug):
-    logging.basicConfig(level=logging.INFO if not debug else logging.DEBUG,
+            tasks = [make_task(msg) for msg in wire.decode_message(message)]
+            if not tasks:
+                if isinstance(message, str):
+                    handle_command(manager, message)
+                    # Cancelling queued tasks frees capacity too
+                    credits.update()
+                continue
+            for _ in tasks:
+                credits.job_received()
+            if len(tasks) == 1:
+                results = [manager.handle(tasks[0])]
+            else:
+                results = manager.handle_many(tasks)
+            for task, job_id in zip(tasks, results):
+                if job_id is None:
+                    events.add(task.job_id, 'rejected')
+            credits.update()
+
+def set_logging(debug, quiet=False):
+    level = logging.DEBUG if debug else logging.WARNING if quiet else logging.INFO
+    logging.basicConfig(level=level,
                         format="%(asctime)s: %(message)s")
     logging.getLogger('websockets.client').setLevel(logging.INFO)
 
@@ -74,16 +446,79 @@ def parse_cmdline():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', dest='debug', action='store_true',
             help="enables debugging output")
+    parser.add_argument('--quiet', dest='quiet', action='store_true',
+            help="only log warnings and errors")
     parser.add_argument('-s', dest='size', type=int, default=DEFAULT_POOL_SIZE,
             help=f"maximum number of concurrent tasks. Default: {DEFAULT_POOL_SIZE}")
     parser.add_argument('-t', dest='timeout', type=float, default=DEFAULT_TIMEOUT,
             help=f"timeout for the jobs. Default: {DEFAULT_TIMEOUT}s")
+    parser.add_argument('-p', dest='pool', action='store_true',
+            help="run the jobs on a pool of pre-forked workers")
+    parser.add_argument('--backend', dest='backend', choices=BACKENDS, default='process',
+            help="how to run the jobs: on processes, threads, or coroutines. Default: process")
+    parser.add_argument('-S', dest='suspend', action='store_true',
+            help="suspend evicted jobs, instead of terminating them")
+    parser.add_argument('--pin', dest='pin', action='store_true',
+            help="pin every job to a CPU, keeping one for the scheduler")
+    parser.add_argument('--policy', dest='policy', choices=POLICIES, default='priority',
+            help="scheduling policy: priority, earliest deadline first, shortest runtime first, "
+                 f"or priority with aging ({DEFAULT_AGING_RATE} levels/s). Default: priority")
+    parser.add_argument('--cpus', dest='cpus', type=float,
+            help="CPUs that the running jobs can use, as declared by them or estimated from "
+                 "previous jobs of the same kind. Default: unlimited")
+    parser.add_argument('--memory', dest='memory', type=float,
+            help="memory that the running jobs can use (MiB), as for --cpus. Default: unlimited")
+    parser.add_argument('--shards', dest='shards', type=int,
+            help="run this many bins, each one on its own event loop and with its own runner (and "
+                 "-s slots), for a band of priorities. Default: a single bin, on the main loop")
+    parser.add_argument('--shard-mode', dest='shard_mode', choices=SHARD_MODES, default='thread',
+            help="run the --shards on threads, or on processes. Default: thread")
+    parser.add_argument('-q', dest='max_pending', type=int,
+            help="maximum number of pending tasks. Default: unbounded")
+    parser.add_argument('--compact', dest='compact', action='store_true',
+            help="keep the pending tasks in a compact queue, for large backlogs. Only for the "
+                 "priority policy")
+    parser.add_argument('--coalesce', dest='coalesce', type=int,
+            help="run up to this many pending jobs of the same priority on a single process. "
+                 "Only for the process backend. Default: one process per job")
+    parser.add_argument('--coalesce-latency', dest='coalesce_latency', type=float,
+            default=DEFAULT_BATCH_LATENCY,
+            help="seconds that a batch of jobs waits for more, as for --coalesce. "
+                 f"Default: {DEFAULT_BATCH_LATENCY}s")
+    parser.add_argument('--coalesce-max-runtime', dest='coalesce_max_runtime', type=float,
+            default=DEFAULT_MAX_RUNTIME,
+            help="only coalesce the jobs that run for up to this many seconds, as for --coalesce. "
+                 f"Default: {DEFAULT_MAX_RUNTIME}s")
+    parser.add_argument('--drop', dest='drop', choices=DROP_POLICIES, default='reject-newest',
+            help="what to do when the pending queue is full. Default: reject-newest")
+    parser.add_argument('--max-age', dest='max_age', type=float,
+            help="drop pending tasks that have been queued for longer than this (seconds)")
+    parser.add_argument('-j', dest='journal',
+            help="journal the jobs on this file, and recover the unfinished ones from it on start")
+    parser.add_argument('-m', dest='metrics_port', type=int,
+            help="collect metrics, and serve them (Prometheus format) on this port")
+    parser.add_argument('--grace', dest='grace', type=float, default=0,
+            help="on shutdown, give the running jobs this many seconds to finish. Default: 0")
+    parser.add_argument('--kill-after', dest='kill_after', type=float, default=DEFAULT_KILL_AFTER,
+            help="on shutdown, kill the jobs that didn't exit this many seconds after being "
+                 f"terminated. Default: {DEFAULT_KILL_AFTER}s")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.compact and args.policy != 'priority':
+        parser.error("--compact needs integer ranks, that only the priority policy gives")
+    if args.shards is not None and not 1 <= args.shards <= len(PRIORITIES):
+        parser.error(f"--shards must be between 1 and {len(PRIORITIES)}")
+    if args.shards and args.shard_mode == 'process' and args.metrics_port:
+        parser.error("the metrics of process shards stay in their processes: -m needs thread shards")
+    if args.shards and args.pin and args.shards > len(os.sched_getaffinity(0)):
+        parser.error("--pin gives every shard CPUs of its own: --shards can't be more than the CPUs")
+    if args.coalesce and args.backend != 'process':
+        parser.error("--coalesce only applies to the process backend")
+    return args
 
 if __name__ == '__main__':
     args = parse_cmdline()
-    set_logging(args.debug)
+    set_logging(args.debug, args.quiet)
     try:
         asyncio.run(main(args))
     except RuntimeError:
@@ -0,0 +1,138 @@
+"""
+Encoding of the jobs travelling through the bus.
+
+Jobs can be sent as JSON messages, either one per frame:
+
+    {'cmd': 'job_request', 'payload': {'priority': PRIO, 'runtime': RTIME}}
+
+or several of them in a single frame:
+
+    {'cmd': 'job_batch', 'payloads': [{'priority': PRIO, 'runtime': RTIME}, ...]}
+
+JSON payloads may carry an 'id' too, that becomes the job id (see
+SchedulerBin.cancel). Jobs can then be cancelled with:
+
+    {'cmd': 'cancel', 'ids': [ID, ...]}
+
+They can also be sent as binary frames, made of BATCH_MAGIC followed by a
+fixed size record (JOB_RECORD) per job. Fixed records allow the bus to split
+a batch by just slicing it, without decoding it.
+
+Schedulers report what happens to the jobs with periodic frames of events:
+
+    {'cmd': 'job_events', 'events': [[ID, EVENT, TIME], ...]}
+
+where EVENT is the lowercase name of a scheduler_bin.TaskEvent, or 'rejected'
+for jobs that no bin accepted, and TIME is when it happened (as given by
+time.time(), on the scheduler). The ones in FINAL_EVENTS are the last event
+of a job. The bus adds 'lost' for the jobs that had started on a scheduler
+that went away before they were done (see Bus).
+"""
+
+import json
+import struct
+
+BATCH_MAGIC = b'JB'
+# Priority (int16) and runtime (float32)
+JOB_RECORD = struct.Struct('<hf')
+
+FINAL_EVENTS = frozenset({'finished', 'timed_out', 'evicted', 'dropped', 'cancelled', 'rejected', 'lost'})
+
+def encode_jobs(payloads):
+    "Returns a binary frame carrying all the `payloads`"
+    return BATCH_MAGIC + b''.join(JOB_RECORD.pack(p['priority'], p['runtime'])
+                                  for p in payloads)
+
+def decode_jobs(frame):
+    "Returns the list of payloads carried by a binary frame"
+    return [{'priority': prio, 'runtime': rtime}
+            for prio, rtime in JOB_RECORD.iter_unpack(memoryview(frame)[len(BATCH_MAGIC):])]
+
+def decode_message(message):
+    """
+    Returns the list of job payloads carried by a message received from the bus,
+    whatever its encoding. Messages that carry no jobs return an empty list.
+    """
+    if isinstance(message, bytes):
+        return decode_jobs(message)
+
+    msg = json.loads(message)
+    cmd = msg.get('cmd')
+    if cmd == 'job_request':
+        return [msg['payload']]
+    elif cmd == 'job_batch':
+        return msg['payloads']
+    elif cmd is None:
+        # A bare payload, as relayed by older versions of the bus
+        return [msg]
+    return []
+
+def batch_from_frame(frame):
+    "Returns the JsonBatch or BinaryBatch for a frame carrying jobs"
+    if isinstance(frame, bytes):
+        return BinaryBatch(frame)
+    return JsonBatch(decode_message(frame), frame)
+
+class JsonBatch:
+    """
+    A set of jobs received in a JSON frame (either a `job_request` or a
+    `job_batch`). The original frame is kept, to relay it as it is.
+    """
+    def __init__(self, payloads, frame=None):
+        self.payloads = payloads
+        self._frame = frame
+
+    def __len__(self):
+        return len(self.payloads)
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            if len(self.payloads) == 1:
+                self._frame = json.dumps({'cmd': 'job_request', 'payload': self.payloads[0]})
+            else:
+                self._frame = json.dumps({'cmd': 'job_batch', 'payloads': self.payloads})
+        return self._frame
+
+    def priorities(self):
+        return [p.get('priority', 0) for p in self.payloads]
+
+    def ids(self):
+        return [p.get('id') for p in self.payloads]
+
+    def split(self, count):
+        "Returns two batches: one with the first `count` jobs, and another with the rest"
+        return JsonBatch(self.payloads[:count]), JsonBatch(self.payloads[count:])
+
+    def singles(self):
+        "Returns a batch for each of the jobs"
+        return [JsonBatch([payload]) for payload in self.payloads]
+
+class BinaryBatch:
+    """
+    A set of jobs received in a binary frame. Only the priorities are ever
+    decoded, and splitting the batch is just slicing the frame.
+    """
+    def __init__(self, frame):
+        self.frame = frame
+
+    def __len__(self):
+        return (len(self.frame) - len(BATCH_MAGIC)) // JOB_RECORD.size
+
+    def priorities(self):
+        return [prio for prio, _ in JOB_RECORD.iter_unpack(self.frame[len(BATCH_MAGIC):])]
+
+    def ids(self):
+        "Binary jobs carry no id"
+        return [None] * len(self)
+
+    def split(self, count):
+        "Returns two batches: one with the first `count` jobs, and another with the rest"
+        cut = len(BATCH_MAGIC) + count * JOB_RECORD.size
+        return BinaryBatch(self.frame[:cut]), BinaryBatch(BATCH_MAGIC + self.frame[cut:])
+
+    def singles(self):
+        "Returns a batch for each of the jobs"
+        start, size = len(BATCH_MAGIC), JOB_RECORD.size
+        return [BinaryBatch(BATCH_MAGIC + self.frame[k:k + size])
+                for k in range(start, len(self.frame), size)]